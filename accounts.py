@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+# Accounts extracted at the same time, the requests per second each one may make, and the transaction
+# pages each fetches in parallel. Every account runs its own pages, so up to
+# ACCOUNT_WORKERS * ACCOUNT_PAGE_WORKERS requests are in flight
+ACCOUNT_WORKERS = int(os.getenv('ACCOUNT_WORKERS', '4'))
+ACCOUNT_RATE_LIMIT = float(os.getenv('ACCOUNT_RATE_LIMIT', '5'))
+ACCOUNT_PAGE_WORKERS = int(os.getenv('ACCOUNT_PAGE_WORKERS', '2'))
+
+
+class Account(object):
+    def __init__(self, user_id, pass_id, auth_secret, client_id, name=None):
+        self.user_id = user_id
+        self.pass_id = pass_id
+        self.auth_secret = auth_secret
+        self.client_id = client_id
+        # Names the account in logs and its watermarks. The single account from USER_ID etc. has none, so it
+        # keeps the watermarks runs before there were several accounts saved
+        self.name = name
+
+    def state_key(self, key) -> str:
+        return f'{key}:{self.name}' if self.name else key
+
+    def __repr__(self):
+        return f'Account({self.name or "default"})'
+
+
+def load_accounts(environ=os.environ) -> list:
+    """
+    The accounts ACCOUNTS lists as JSON, [{"name", "user_id", "pass_id", "auth_secret", "client_id"}, ...],
+    name defaulting to user_id. Otherwise the single account USER_ID, PASS_ID, AUTH_SECRET and CLIENT_ID
+    configure, if they're all set.
+    """
+    if environ.get('ACCOUNTS'):
+        return [Account(account['user_id'], account['pass_id'], account['auth_secret'], account['client_id'],
+                        name=account.get('name') or account['user_id'])
+                for account in json.loads(environ['ACCOUNTS'])]
+
+    credentials = [environ.get(key) for key in ('USER_ID', 'PASS_ID', 'AUTH_SECRET', 'CLIENT_ID')]
+    return [Account(*credentials)] if all(credentials) else []
+
+
+class RateLimiter(object):
+    """
+    Token bucket letting acquire() through rate times a second on average, with bursts of up to burst.
+    Thread safe, a caller that's over the rate sleeps until its turn.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Taken even when there's none left, which books the caller the next free turn
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def plutus_api(account: Account, rate_limit=ACCOUNT_RATE_LIMIT, token_store=None):
+    from api import PlutusApi
+
+    return PlutusApi(account.user_id, account.pass_id, account.auth_secret, account.client_id,
+                     token_store=token_store, rate_limiter=RateLimiter(rate_limit, burst=ACCOUNT_PAGE_WORKERS))
+
+
+def user_ids(df: pd.DataFrame) -> set:
+    """user_id values in df as the strings they're staged as."""
+    from schema import to_arrow
+
+    if df is None or df.empty or 'user_id' not in df:
+        return set()
+    return set(to_arrow(df['user_id'].drop_duplicates(), pa.string()).to_pylist()) - {None}
+
+
+class AccountResult(object):
+    def __init__(self, account, transactions_df=None, rewards_df=None, error=None, seconds=0.0):
+        self.account = account
+        self.transactions_df = transactions_df
+        self.rewards_df = rewards_df
+        self.error = error
+        self.seconds = seconds
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def user_ids(self) -> set:
+        return user_ids(self.transactions_df) | user_ids(self.rewards_df)
+
+
+class AccountExtractor(object):
+    """
+    Logs in and extracts the transactions and rewards of every account, max_workers accounts at a time.
+    Each account has its own client from api_factory, rate limited on its own, and its own watermarks.
+    An account that fails is logged and left out, the others carry on.
+    """
+
+    def __init__(self, accounts, api_factory=plutus_api, max_workers=ACCOUNT_WORKERS,
+                 page_workers=ACCOUNT_PAGE_WORKERS):
+        self.accounts = accounts
+        self.api_factory = api_factory
+        self.max_workers = max_workers
+        self.page_workers = page_workers
+        self.results = []
+
+    def _extract(self, account, state) -> AccountResult:
+        from ingest import records_to_frame
+        from schema import TRANSACTION_FIELDS, REWARD_FIELDS
+
+        transactions_since = state.get(account.state_key('transactions_watermark')) if state else None
+        rewards_since = state.get(account.state_key('rewards_watermark')) if state else None
+
+        start = time.perf_counter()
+        try:
+            api = self.api_factory(account)
+            api.login()
+            transactions_df = records_to_frame(api.iter_transactions(since=transactions_since,
+                                                                     max_workers=self.page_workers),
+                                               TRANSACTION_FIELDS)
+            rewards = api.get_rewards(since=rewards_since)
+            # get_rewards hands back the failed response rather than raising
+            if isinstance(rewards, dict):
+                raise RuntimeError(f"Fetching rewards failed with status {rewards.get('statusCode')}")
+            rewards_df = records_to_frame(rewards, REWARD_FIELDS)
+        except Exception as e:
+            logger.error(f"Extracting {account} failed after {time.perf_counter() - start:.2f}s: {e}")
+            return AccountResult(account, error=e, seconds=time.perf_counter() - start)
+
+        seconds = time.perf_counter() - start
+        logger.info(f"Extracted {len(transactions_df)} transaction(s) and {len(rewards_df)} reward(s) "
+                    f"for {account} in {seconds:.2f}s")
+        return AccountResult(account, transactions_df, rewards_df, seconds=seconds)
+
+    def extract(self, state=None):
+        """
+        Every account's records in one transactions and one rewards frame, each account's only since its
+        own watermarks when state is given. Raises when no account could be extracted.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            self.results = list(executor.map(lambda account: self._extract(account, state), self.accounts))
+
+        extracted = [result for result in self.results if result.ok]
+        if not extracted:
+            raise RuntimeError(f"Extracting failed for all {len(self.accounts)} account(s)")
+        if self.failed:
+            logger.warning(f"{len(self.failed)} of {len(self.accounts)} account(s) failed: "
+                           f"{', '.join(str(result.account) for result in self.failed)}")
+
+        return (pd.concat([result.transactions_df for result in extracted], ignore_index=True),
+                pd.concat([result.rewards_df for result in extracted], ignore_index=True))
+
+    @property
+    def failed(self) -> list:
+        return [result for result in self.results if not result.ok]
+
+    def save_user_ids(self, state) -> None:
+        # Which user_ids an account's rows are staged under is only known from its own records, so it's kept
+        # for the runs where the account fails
+        for result in self.results:
+            ids = result.user_ids() if result.ok else set()
+            if ids:
+                key = result.account.state_key('user_ids')
+                state.set(key, sorted(ids | set(state.get(key, []))))
+
+    def failed_user_ids(self, state) -> set:
+        """user_ids earlier runs staged the rows of the accounts that failed under."""
+        return set().union(*(state.get(result.account.state_key('user_ids'), []) for result in self.failed))
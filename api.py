@@ -1,47 +1,172 @@
+import base64
 import json
-import pandas as pd
-import numpy as np
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import requests
-from pyotp import TOTP
+from requests.adapters import HTTPAdapter
 
-from common_shared_library.captcha_bypass import CaptchaBypass
+from state import StateStore
 
-def monthly_count(data):
-    # Plu collected per month
-    data['amount'] = data['amount'].astype(float)
-    valids = data[data['reason'] != "Rejected by admin"]
-    valids['createdAt'] = pd.to_datetime(valids['createdAt'])
-    per = valids.createdAt.dt.to_period("M")
-    g = valids.groupby(per)
-    # print(g.sum()['amount']) # stopped working TypeError: datetime64 type does not support sum operations
+logger = logging.getLogger(__name__)
 
-    # print(g['amount'].sum())  # new syntax
-    # print(g['plu_price'].mean())
-    # print(g['plu_price'].max())
-    # print(g['plu_price'].min())
+TRANSACTIONS_VIEW_QUERY = "query transactions_view($offset: Int, $limit: Int, $from: timestamptz, $to: timestamptz, $type: String) {\n  transactions_view_aggregate(\n    where: {_and: [{date: {_gte: $from}}, {date: {_lte: $to}}]}\n  ) {\n    aggregate {\n      totalCount: count\n      __typename\n    }\n    __typename\n  }\n  transactions_view(\n    order_by: [{date: desc}, {id: asc}]\n    limit: $limit\n    offset: $offset\n    where: {_and: [{date: {_gte: $from}}, {date: {_lte: $to}}, {type: {_eq: $type}}]}\n  ) {\n    id\n    model\n    user_id\n    currency\n    amount\n    date\n    type\n    is_debit\n    description\n    __typename\n  }\n}\n"
 
-    return g.agg(Sum=('amount', np.sum), plu_mean=('plu_price', np.mean), plu_max=('plu_price', np.max),
-                 plu_min=('plu_price', np.min)).round(2)
 
+def monthly_count(data=None, store=None):
+    """
+    PLU collected per month with the mean, max and min plu_price, leaving out rejected rewards. Served from
+    the rollups either engine keeps up to date, so it's a merge of a few states per month instead of a pass
+    over every reward. data, a frame of rewards with amount, reason, createdAt and plu_price, is aggregated
+    instead when it's given.
+    """
+    import pandas as pd
+    from rollups import RollupStore, merge_states, partial_states
+
+    if data is not None:
+        states = partial_states(data.rename(columns={'amount': 'plu_amount', 'createdAt': 'created_at'}),
+                                grains=['month'])
+        monthly = merge_states(states, 'month')
+    else:
+        if store is None:
+            from staging import get_storage
+
+            store = RollupStore(get_storage('cashback-bucket'))
+        monthly = store.query('month')
+
+    monthly = monthly[monthly.index.notna()]
+    return pd.DataFrame({
+        'Sum': monthly['plu_amount_sum'].to_numpy(),
+        'plu_mean': monthly['plu_price_mean'].to_numpy(),
+        'plu_max': monthly['plu_price_max'].to_numpy(),
+        'plu_min': monthly['plu_price_min'].to_numpy(),
+    }, index=pd.PeriodIndex(monthly.index, freq='M', name='createdAt')).sort_index().round(2)
+
+
+# Re-login this long before the token runs out rather than have it expire mid run
+TOKEN_EXPIRY_MARGIN = 300
+# Used when the token doesn't say when it expires
+DEFAULT_TOKEN_TTL = 3600
+
+# Logged in sessions per user with their token expiry, kept for as long as the container stays warm
+_sessions = {}
+
+
+def token_expiry(id_token):
+    """exp claim of the JWT, read without verifying it, it only decides when to log in again."""
+    try:
+        claims = id_token.split('.')[1]
+        return float(json.loads(base64.urlsafe_b64decode(claims + '=' * (-len(claims) % 4)))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + DEFAULT_TOKEN_TTL
+
+
+def _is_rejected(response):
+    if response.status_code in (401, 403):
+        return True
+    # Hasura turns a bad JWT down with a 200 and an error code instead
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    errors = body.get('errors') if isinstance(body, dict) else None
+    return any(isinstance(error, dict)
+               and error.get('extensions', {}).get('code') in ('invalid-jwt', 'invalid-headers', 'access-denied')
+               for error in errors or [])
 
 
 class PlutusApi(object):
-    def __init__(self, user_id, pass_id, auth_id, client_id):
+    graphql_url = "https://hasura.plutus.it/v1alpha1/graphql"
+
+    def __init__(self, user_id, pass_id, auth_id, client_id, token_store=None, rate_limiter=None):
         self.user_field_id = user_id
         self.pass_field_id = pass_id
         self.auth_field_id = auth_id
         self.client_field_id = client_id
         self.session = None
-
-    def login(self):
+        # Anything with get/set, the token outlives the instance so the next run can skip the login. The default
+        # file under /tmp only lasts while the container is warm, a StateStore on S3 carries it over a cold start
+        self.token_store = token_store or StateStore(os.getenv('TOKEN_CACHE_PATH') or '/tmp/plutus_token.json')
+        self.login_timings = {}
+        self._login_lock = threading.Lock()
+        # Anything with acquire(), shared by every request of this account's, pages fetched in parallel included
+        self.rate_limiter = rate_limiter
+
+    @property
+    def _token_key(self):
+        return f'id_token:{self.user_field_id}'
+
+    def _use_token(self, id_token, expires_at):
+        # A warm container keeps the module loaded, so its session and open connections carry over too
+        session, _ = _sessions.get(self.user_field_id, (None, None))
+        if session is None:
+            session = requests.Session()
+        session.headers.update({
+            "Authorization": "Bearer " + id_token,
+            "Connection": "keep-alive",
+        })
+        _sessions[self.user_field_id] = (session, expires_at)
+        self.session = session
+
+    def _restore_session(self):
+        session, expires_at = _sessions.get(self.user_field_id, (None, None))
+        if session is not None and expires_at - TOKEN_EXPIRY_MARGIN > time.time():
+            self.session = session
+            logger.info("Reusing warm session")
+            return True
+
+        cached = self.token_store.get(self._token_key)
+        if cached and cached['expires_at'] - TOKEN_EXPIRY_MARGIN > time.time():
+            self._use_token(cached['id_token'], cached['expires_at'])
+            logger.info("Reusing cached id_token")
+            return True
+
+        return False
+
+    def login(self, force=False, rejected=None):
+        """
+        Logs in with captcha + TOTP, unless a token that hasn't expired is cached. force skips the
+        cache, for when the API has rejected the token in the rejected Authorization header.
+        """
+        with self._login_lock:
+            if force and rejected and self.session and self.session.headers.get('Authorization') != rejected:
+                # Another page already logged in again while this one waited on the lock
+                return
+
+            start = time.perf_counter()
+            if not force and self._restore_session():
+                self.login_timings = {'cache': time.perf_counter() - start}
+                return
+
+            logger.info("Logging in")
+            self.login_timings = {}
+            self._login()
+            self.login_timings['total'] = time.perf_counter() - start
+            logger.info("Logged in, " + ", ".join(f"{phase} {seconds:.2f}s"
+                                                  for phase, seconds in self.login_timings.items()))
+
+    def _timed(self, phase, run):
+        start = time.perf_counter()
+        result = run()
+        self.login_timings[phase] = self.login_timings.get(phase, 0.0) + time.perf_counter() - start
+        return result
+
+    def _login(self):
+        # Only needed when there's no cached token to use, so left out of the cold start
+        from common_shared_library.captcha_bypass import CaptchaBypass
+        from pyotp import TOTP
 
         url = "https://authenticate.plutus.it/auth/login"
         public_sitekey = '6Le9DsMUAAAAAErnFJQ9diHca8Y1asRRW5sE8sBX'
 
-        g_response = CaptchaBypass(public_sitekey, url).bypass()
+        g_response = self._timed('captcha', lambda: CaptchaBypass(public_sitekey, url).bypass())
 
         totp = TOTP(self.auth_field_id)
-        token = totp.now()
+        token = self._timed('totp', totp.now)
 
         payload = {
             "email": self.user_field_id,
@@ -59,13 +184,13 @@ class PlutusApi(object):
             "Origin": "https://dex.plutus.it",
         }
 
-        self.session = requests.Session()
-        response = self.session.post(url, json=payload, headers=headers)  # login
+        session = requests.Session()
+        response = self._timed('post', lambda: session.post(url, json=payload, headers=headers))  # login
 
         # Sometime request will fail because otp token timed out so retry once more
 
         if 'id_token' not in response.json():
-            token = totp.now()
+            token = self._timed('totp', totp.now)
 
             payload = {
                 "email": self.user_field_id,
@@ -74,24 +199,40 @@ class PlutusApi(object):
                 "captcha": g_response,
                 "client_id": self.client_field_id
             }
-            response = self.session.post(url, json=payload, headers=headers)
+            response = self._timed('retry', lambda: session.post(url, json=payload, headers=headers))
 
-        headers = {
-            "Authorization": "Bearer " + response.json()['id_token'],
-            "Connection": "keep-alive",
-        }
+        body = response.json()
+        id_token = body['id_token']
+        expires_at = time.time() + body['expires_in'] if 'expires_in' in body else token_expiry(id_token)
 
-        self.session.headers.update(headers)
+        _sessions[self.user_field_id] = (session, expires_at)
+        self._use_token(id_token, expires_at)
+        self.token_store.set(self._token_key, {'id_token': id_token, 'expires_at': expires_at})
 
-        # return session
-
-    # Rewards
-    def get_rewards(self):
+    def _wait_turn(self):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
 
+    def _request(self, method, url, **kwargs):
+        # A cached token can still be revoked before it expires, log in again once when it's turned down
         if not self.session:
             self.login()
 
-        response = self.session.get("https://api.plutus.it/platform/transactions/pluton")
+        authorization = self.session.headers.get('Authorization')
+        self._wait_turn()
+        response = self.session.request(method, url, **kwargs)
+        if _is_rejected(response):
+            logger.info("id_token rejected, logging in again")
+            self.login(force=True, rejected=authorization)
+            self._wait_turn()
+            response = self.session.request(method, url, **kwargs)
+
+        return response
+
+    # Rewards
+    def get_rewards(self, since=None):
+
+        response = self._request('GET', "https://api.plutus.it/platform/transactions/pluton")
 
         if response.status_code != 200:
             # push_notification(NOTIFICATION_TOKEN, "Plutus Rewards", "Lambda Failed to get transactions 💀")
@@ -102,7 +243,16 @@ class PlutusApi(object):
                 }
             }
 
-        return response.json()
+        rewards = response.json()
+
+        # The pluton endpoint has no date filter so the delta is cut out client side. Inclusive, like the
+        # transactions' $from, as a reward can share the watermark's timestamp and still be new. merge_delta
+        # drops the ones fetched twice
+        if since:
+            since = datetime.fromisoformat(since)
+            rewards = [reward for reward in rewards if datetime.fromisoformat(reward['updatedAt']) >= since]
+
+        return rewards
 
         # data = json.loads(response.text)
         # data = pd.json_normalize(data)
@@ -176,25 +326,69 @@ class PlutusApi(object):
     #         data = json.loads(response.text)
     #         return float(str(data['AvailableBalance'])[:-2] + '.' + str(data['AvailableBalance'])[-2:])
 
-    def get_transactions(self):
-
-        if not self.session:
-            print("Logging in")
-            self.login()
+    def _query_transactions(self, offset=0, limit=None, since=None):
 
-        url = "https://hasura.plutus.it/v1alpha1/graphql"
+        variables = {
+            "offset": offset,
+            "from": since,
+            "to": None
+        }
+        if limit is not None:
+            variables["limit"] = limit
 
         payload = json.dumps({
             "operationName": "transactions_view",
-            "variables": {
-                "offset": 0,
-                # "limit": limit,
-                "from": None,
-                "to": None
-            },
-            "query": "query transactions_view($offset: Int, $limit: Int, $from: timestamptz, $to: timestamptz, $type: String) {\n  transactions_view_aggregate(\n    where: {_and: [{date: {_gte: $from}}, {date: {_lte: $to}}]}\n  ) {\n    aggregate {\n      totalCount: count\n      __typename\n    }\n    __typename\n  }\n  transactions_view(\n    order_by: {date: desc}\n    limit: $limit\n    offset: $offset\n    where: {_and: [{date: {_gte: $from}}, {date: {_lte: $to}}, {type: {_eq: $type}}]}\n  ) {\n    id\n    model\n    user_id\n    currency\n    amount\n    date\n    type\n    is_debit\n    description\n    __typename\n  }\n}\n"
+            "variables": variables,
+            "query": TRANSACTIONS_VIEW_QUERY
         })
 
-        response = self.session.post(url, data=payload)
+        response = self._request('POST', self.graphql_url, data=payload)
+        response.raise_for_status()
+
+        return response.json()['data']
+
+    def _get_transactions_page(self, offset, limit, since, retries):
+
+        for attempt in range(retries + 1):
+            try:
+                return self._query_transactions(offset, limit, since)['transactions_view']
+            except (requests.RequestException, KeyError, ValueError) as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f"Page at offset {offset} failed ({e}), retrying")
+                time.sleep(2 ** attempt)
+
+    def get_transactions(self, since=None):
+
+        if not self.session:
+            self.login()
+
+        return self._query_transactions(since=since)['transactions_view']
+
+    def iter_transactions(self, since=None, page_size=1000, max_workers=4, retries=3):
+        """
+        Streams transactions_view a page at a time. totalCount is read first and the pages are then
+        fetched concurrently over the one session, but yielded in order with at most 2 * max_workers
+        pages held in memory.
+        """
+
+        if not self.session:
+            self.login()
+
+        total_count = self._query_transactions(limit=0, since=since)[
+            'transactions_view_aggregate']['aggregate']['totalCount']
+
+        # Default pool keeps 10 connections per host, size it to the workers so pages aren't queued on it
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            for offset in range(0, total_count, page_size):
+                pending.append(executor.submit(self._get_transactions_page, offset, page_size, since, retries))
+                if len(pending) >= 2 * max_workers:
+                    yield from pending.popleft().result()
 
-        return response.json()['data']['transactions_view']
+            while pending:
+                yield from pending.popleft().result()
@@ -0,0 +1,99 @@
+"""
+Cold start cost of each Lambda entry point, the way the Lambda runtime pays it on a new container: importing
+the handler module in a fresh interpreter (init) and then its first invocation, and which heavy libraries
+the two load between them.
+
+    python benchmarks/cold_start_benchmark.py --runs 5 --budget-ms 3000
+
+The pull and transform handlers are invoked for real against a local directory standing in for S3, the pull
+one on the shipped sample CSVs and the transform one on what the pull staged. The load and crawler handlers
+need Redshift and Glue, so only their init is timed and their first invocation is reported as '-'.
+
+Exits non-zero when the median init plus first invocation of a handler goes over --budget-ms, so a regression
+can fail a check.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Handler module and whether it can be invoked offline
+HANDLERS = {
+    'pull_data_glue_job_lambda': True,
+    'elt': True,
+    'load_to_redshift_lambda': False,
+    'glue_crawler_lambda': False,
+}
+HEAVY = ['pandas', 'numpy', 'pyarrow', 'boto3', 'botocore', 'psycopg2', 'requests', 's3fs', 'pyotp',
+         'common_shared_library']
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+init = time.perf_counter() - start
+invoke = None
+if {invoke}:
+    start = time.perf_counter()
+    {module}.lambda_handler({{}}, None)
+    invoke = time.perf_counter() - start
+print(json.dumps({{'init_ms': init * 1000, 'invoke_ms': invoke and invoke * 1000,
+                  'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def run(module, invoke, storage):
+    # AWS_LAMBDA_FUNCTION_NAME is set so the modules behave as they do in the runtime, e.g. skip .env
+    env = dict(os.environ, AWS_LAMBDA_FUNCTION_NAME=module, LOCAL_STORAGE_PATH=storage, METRICS_EMF='false',
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.path.join(ROOT, 'glue_job'),
+                                                        os.getenv('PYTHONPATH')])))
+    # No credentials, so the pull handler reads the sample CSVs rather than the API
+    for key in ('ACCOUNTS', 'USER_ID', 'PASS_ID', 'AUTH_SECRET', 'CLIENT_ID'):
+        env.pop(key, None)
+    output = subprocess.run([sys.executable, '-c', PROBE.format(module=module, invoke=invoke, heavy=HEAVY)],
+                            env=env, cwd=ROOT, capture_output=True, text=True)
+    if output.returncode:
+        raise RuntimeError(f"running {module} failed:\n{output.stderr}")
+    return json.loads(output.stdout.splitlines()[-1])
+
+
+def cold_start(module, invoke):
+    with tempfile.TemporaryDirectory() as storage:
+        # The transform's first invocation reads what a pull staged, which isn't part of its cold start
+        if module == 'elt':
+            run('pull_data_glue_job_lambda', True, storage)
+        return run(module, invoke, storage)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=None)
+    parser.add_argument('--handlers', nargs='+', default=list(HANDLERS))
+    args = parser.parse_args()
+
+    over_budget = []
+    print(f"{'handler':<28} {'init ms':>9} {'invoke ms':>10} {'total ms':>9}  loads")
+    for module in args.handlers:
+        invoke = HANDLERS.get(module, False)
+        results = [cold_start(module, invoke) for _ in range(args.runs)]
+        init = statistics.median(result['init_ms'] for result in results)
+        first = statistics.median(result['invoke_ms'] for result in results) if invoke else None
+        total = init + (first or 0)
+        print(f"{module:<28} {init:9.1f} {'-' if first is None else f'{first:.1f}':>10} {total:9.1f}  "
+              f"{', '.join(results[-1]['loaded']) or '-'}")
+        if args.budget_ms is not None and total > args.budget_ms:
+            over_budget.append(module)
+
+    if over_budget:
+        print(f"over the {args.budget_ms:.0f} ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Wall time of extracting several accounts through accounts.AccountExtractor, one account after another
+against max_workers at a time, with every account served by a mock of PlutusApi that sleeps for its
+login and for a round trip per request.
+
+    python benchmarks/fan_out_benchmark.py --accounts 1 2 4 8 16 --transactions 5000
+
+Each account's requests go through its own RateLimiter, as they would against the API. With --fail the
+first that many accounts fail to log in, which shows the others still being extracted.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+sys.path.insert(0, BENCHMARKS)
+
+os.environ.setdefault('AWS_LAMBDA_FUNCTION_NAME', 'fan_out_benchmark')
+os.environ.setdefault('METRICS_EMF', 'false')
+
+import synthetic_data  # noqa: E402
+from accounts import Account, AccountExtractor, RateLimiter  # noqa: E402
+
+
+def _own(value, index):
+    # The synthetic ids are the same for everyone, a field of each UUID is set to the account's index
+    return value if value is None else f'{value[:9]}{index:04x}{value[13:]}'
+
+
+class MockAccountApi(object):
+    """One account's PlutusApi, serving synthetic_data's records under its own user_id and ids."""
+
+    def __init__(self, index, transactions, latency, login_latency, rate_limiter, page_size=1000, fail=False):
+        self.index = index
+        self.transactions = transactions
+        self.latency = latency
+        self.login_latency = login_latency
+        self.rate_limiter = rate_limiter
+        self.page_size = page_size
+        self.fail = fail
+        self.requests = 0
+
+    def _request(self):
+        self.rate_limiter.acquire()
+        self.requests += 1
+        time.sleep(self.latency)
+
+    def login(self):
+        time.sleep(self.login_latency)
+        if self.fail:
+            raise RuntimeError('Login rejected')
+
+    def _page(self, offset):
+        self._request()
+        return [{**record, 'id': _own(record['id'], self.index), 'user_id': _own(record['user_id'], self.index)}
+                for record in (synthetic_data.transaction(index, self.transactions)
+                               for index in range(offset, min(offset + self.page_size, self.transactions)))]
+
+    def iter_transactions(self, since=None, max_workers=4):
+        # totalCount first, then the pages in parallel, as PlutusApi.iter_transactions does
+        self._request()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for page in executor.map(self._page, range(0, self.transactions, self.page_size)):
+                yield from page
+
+    def get_rewards(self, since=None):
+        self._request()
+        return [{**record, 'id': _own(record['id'], self.index), 'user_id': _own(record['user_id'], self.index),
+                 'reference_id': _own(record['reference_id'], self.index)}
+                for record in synthetic_data.rewards(self.transactions)]
+
+
+def run(count, workers, args):
+    accounts = [Account(f'user{index}@example.com', 'pass', 'secret', 'client', name=f'account{index}')
+                for index in range(count)]
+
+    def api_factory(account):
+        index = accounts.index(account)
+        return MockAccountApi(index, args.transactions, args.latency, args.login_latency,
+                              RateLimiter(args.rate_limit, burst=args.page_workers), fail=index < args.fail)
+
+    extractor = AccountExtractor(accounts, api_factory, max_workers=workers, page_workers=args.page_workers)
+    start = time.perf_counter()
+    transactions_df, rewards_df = extractor.extract()
+    elapsed = time.perf_counter() - start
+    users = transactions_df['user_id'].nunique()
+    return elapsed, len(transactions_df), len(rewards_df), users, len(extractor.failed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--transactions', type=int, default=5000, help='per account')
+    parser.add_argument('--workers', type=int, default=4, help='accounts extracted at a time')
+    parser.add_argument('--page-workers', type=int, default=2)
+    parser.add_argument('--rate-limit', type=float, default=5, help='requests per second per account')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds per request')
+    parser.add_argument('--login-latency', type=float, default=1.0, help='seconds per login')
+    parser.add_argument('--fail', type=int, default=0, help='accounts whose login fails')
+    args = parser.parse_args()
+
+    base = {}
+    for count in args.accounts:
+        for workers in (1, args.workers):
+            elapsed, transactions, rewards, users, failed = run(count, workers, args)
+            base.setdefault(workers, elapsed)
+            print(f"{count:>3} account(s) {workers:>2} at a time {elapsed:7.2f}s "
+                  f"({elapsed / base[workers]:5.2f}x one account) {transactions:>8,} transaction(s) "
+                  f"{rewards:>8,} reward(s) from {users} user(s), {failed} failed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Bytes per row of the transactions and rewards frames, column by column, held with the plain types
+against the compact ones from schema.py.
+
+    python benchmarks/frame_memory_report.py --transactions 100000
+
+The frames are built from synthetic API records by ingest.records_to_frame, the same way fetch_data does.
+"""
+import argparse
+import os
+import sys
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+sys.path.insert(0, BENCHMARKS)
+
+import synthetic_data  # noqa: E402
+from ingest import records_to_frame  # noqa: E402
+from schema import REWARD_FIELDS, TRANSACTION_FIELDS, expand  # noqa: E402
+
+
+def report(name, compact_df):
+    plain_df = expand(compact_df)
+    rows = max(len(compact_df), 1)
+    plain = plain_df.memory_usage(deep=True, index=False)
+    compact = compact_df.memory_usage(deep=True, index=False)
+
+    print(f"\n{name}, {len(compact_df):,} rows")
+    print(f"{'column':<28} {'plain':>8} {'compact':>8}  {'dtype':<}")
+    for column in compact_df.columns:
+        print(f"{column:<28} {plain[column] / rows:>8.1f} {compact[column] / rows:>8.1f}  {compact_df[column].dtype}")
+    print(f"{'bytes per row':<28} {plain.sum() / rows:>8.1f} {compact.sum() / rows:>8.1f}  "
+          f"{1 - compact.sum() / plain.sum():.0%} smaller")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=100_000)
+    args = parser.parse_args()
+
+    report('transactions', records_to_frame(synthetic_data.transactions(args.transactions), TRANSACTION_FIELDS))
+    report('rewards', records_to_frame(synthetic_data.rewards(args.transactions), REWARD_FIELDS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Throughput and peak memory of the single-shot get_transactions call against the paged iter_transactions,
+both run against benchmarks/mock_hasura.py.
+
+    python benchmarks/graphql_pagination_benchmark.py --rows 200000 --page-size 1000 --workers 4
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from api import PlutusApi  # noqa: E402
+
+
+def start_mock(port, rows, latency):
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_hasura.py'),
+                                '--port', str(port), '--rows', str(rows), '--latency', str(latency)])
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('mock Hasura did not start')
+
+
+def mock_api(port):
+    api = PlutusApi(None, None, None, None)
+    api.graphql_url = f'http://127.0.0.1:{port}/v1alpha1/graphql'
+    # Skip login, the mock doesn't check the bearer token
+    api.session = requests.Session()
+    return api
+
+
+def measure(name, run):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = run()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<12} {count:>10,} rows {elapsed:8.2f}s {count / elapsed:>12,.0f} rows/s "
+          f"peak {peak / 2 ** 20:8.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    process = start_mock(args.port, args.rows, args.latency)
+    try:
+        measure('single-shot', lambda: len(mock_api(args.port).get_transactions()))
+        measure('paged', lambda: sum(1 for _ in mock_api(args.port).iter_transactions(
+            page_size=args.page_size, max_workers=args.workers)))
+    finally:
+        process.kill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Peak memory of turning API records into the staged transactions frame, the old
+pd.read_json(json.dumps(records)) round trip against the chunked Arrow ingestion in ingest.py.
+
+    python benchmarks/ingest_memory_benchmark.py --records 500000
+
+Each path runs in its own process and reports peak RSS above what the imports alone take,
+Arrow allocates outside the python heap so tracemalloc would miss it.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from io import StringIO
+
+import pandas as pd
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+sys.path.insert(0, BENCHMARKS)
+
+from ingest import records_to_frame  # noqa: E402
+from mock_hasura import transaction  # noqa: E402
+from schema import TRANSACTION_FIELDS  # noqa: E402
+
+
+def peak_rss():
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def legacy(records):
+    # The API call returned the whole list before it was converted
+    transactions = list(records)
+    transactions_df = pd.read_json(StringIO(json.dumps(transactions)))
+    transactions_df.drop(columns=['is_debit', '__typename'], inplace=True)
+    transactions_df.rename(columns={'id': 'transaction_id'}, inplace=True)
+    return transactions_df
+
+
+def streamed(records):
+    return records_to_frame(records, TRANSACTION_FIELDS)
+
+
+def run(path, count):
+    baseline = peak_rss()
+    start = time.perf_counter()
+    df = {'legacy': legacy, 'streamed': streamed}[path](transaction(index) for index in range(count))
+    elapsed = time.perf_counter() - start
+    print(f"{path:<9} {len(df):>10,} rows {elapsed:7.2f}s peak {(peak_rss() - baseline) / 2 ** 20:8.1f} MiB "
+          f"frame {df.memory_usage(deep=True).sum() / 2 ** 20:8.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=500_000)
+    parser.add_argument('--path', choices=['legacy', 'streamed'])
+    args = parser.parse_args()
+
+    if args.path:
+        run(args.path, args.records)
+        return
+
+    for path in ('legacy', 'streamed'):
+        subprocess.run([sys.executable, __file__, '--records', str(args.records), '--path', path], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Peak memory and time of joining the staged rewards to their transactions, the old pd.merge of both
+whole files against joins.py's two streamed joins: the projected transactions indexed once with the rewards
+streamed through in parquet batches, and the rewards indexed with the transactions streamed past them.
+glue_job/elt.py indexes whichever staged file has fewer rows.
+
+    python benchmarks/join_memory_benchmark.py --transactions 1000000
+
+Staged files for that many synthetic transactions are written to --root first. Staging and each path run
+in their own process, the peak RSS a process reaches carries over to the ones it forks, and each path
+reports its peak above what the imports alone take.
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import pandas as pd
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..', 'glue_job'))
+sys.path.insert(0, BENCHMARKS)
+
+os.environ.setdefault('AWS_LAMBDA_FUNCTION_NAME', 'join_memory_benchmark')
+os.environ.setdefault('METRICS_EMF', 'false')
+
+from elt import REWARD_COLUMNS, TRANSACTION_COLUMNS, iter_parquet_from_s3, read_parquet_from_s3  # noqa: E402
+from joins import iter_left_join, iter_left_join_streamed_right  # noqa: E402
+
+BUCKET = 'cashback-bucket'
+
+
+def peak_rss():
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def stage_files(count):
+    from pull_data_glue_job_lambda import fetch_data, to_s3
+    from run_pipeline_locally import SyntheticApi
+    from schema import REWARD_SCHEMA, TRANSACTION_SCHEMA
+
+    transactions_df, rewards_df = fetch_data(SyntheticApi(count, 1000, 0), None, BUCKET)
+    to_s3(transactions_df, BUCKET, 'staging/transactions.parquet', TRANSACTION_SCHEMA)
+    to_s3(rewards_df, BUCKET, 'staging/rewards.parquet', REWARD_SCHEMA)
+
+
+def merged():
+    rewards_df = read_parquet_from_s3(BUCKET, 'staging/rewards.parquet')
+    transactions_df = read_parquet_from_s3(BUCKET, 'staging/transactions.parquet')
+    return pd.merge(rewards_df, transactions_df, left_on='reference_id', right_on='transaction_id', how='left')
+
+
+def streamed(batch_size):
+    transactions_df = read_parquet_from_s3(BUCKET, 'staging/transactions.parquet', TRANSACTION_COLUMNS)
+    chunks = iter_parquet_from_s3(BUCKET, 'staging/rewards.parquet', REWARD_COLUMNS, batch_size)
+    return pd.concat(iter_left_join(chunks, transactions_df, 'reference_id', 'transaction_id'), ignore_index=True)
+
+
+def streamed_right(batch_size):
+    rewards_df = read_parquet_from_s3(BUCKET, 'staging/rewards.parquet', REWARD_COLUMNS)
+    chunks = iter_parquet_from_s3(BUCKET, 'staging/transactions.parquet', TRANSACTION_COLUMNS, batch_size)
+    return pd.concat(iter_left_join_streamed_right(rewards_df, chunks, 'reference_id', 'transaction_id',
+                                                   chunk_size=batch_size), ignore_index=True)
+
+
+def run(path, batch_size):
+    baseline = peak_rss()
+    start = time.perf_counter()
+    df = {'merge': merged, 'streamed': lambda: streamed(batch_size),
+          'streamed_right': lambda: streamed_right(batch_size)}[path]()
+    elapsed = time.perf_counter() - start
+    print(f"{path:<14} {len(df):>10,} rows {elapsed:7.2f}s peak {(peak_rss() - baseline) / 2 ** 20:8.1f} MiB "
+          f"frame {df.memory_usage(deep=True).sum() / 2 ** 20:8.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=1_000_000)
+    parser.add_argument('--batch-size', type=int, default=100_000)
+    parser.add_argument('--root', default='/tmp/cashback_join')
+    parser.add_argument('--path', choices=['stage', 'merge', 'streamed', 'streamed_right'])
+    args = parser.parse_args()
+
+    os.environ['LOCAL_STORAGE_PATH'] = args.root
+
+    if args.path == 'stage':
+        stage_files(args.transactions)
+        return
+    if args.path:
+        run(args.path, args.batch_size)
+        return
+
+    for path in ('stage', 'merge', 'streamed', 'streamed_right'):
+        subprocess.run([sys.executable, __file__, '--transactions', str(args.transactions), '--root', args.root,
+                        '--batch-size', str(args.batch_size), '--path', path], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+A Glue catalog kept in a JSON file, with the boto3 Glue client methods glue_crawler_lambda.PartitionRegistrar
+and load_to_redshift_lambda call, so partition registration runs without AWS. Used by run_pipeline_locally.py,
+or on its own to see what a registration does to a catalog:
+
+    python benchmarks/local_catalog.py --catalog /tmp/cashback/glue_catalog.json
+
+The same request limits as Glue apply, and every request is counted.
+"""
+import argparse
+import copy
+import json
+import os
+from collections import Counter
+
+
+class EntityNotFoundException(Exception):
+    pass
+
+
+class _Exceptions(object):
+    EntityNotFoundException = EntityNotFoundException
+
+
+class LocalGlueCatalog(object):
+    """Tables and their partitions, saved to path after every change."""
+
+    exceptions = _Exceptions
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = Counter()
+        try:
+            with open(path) as f:
+                self.catalog = json.load(f)
+        except FileNotFoundError:
+            self.catalog = {'tables': {}, 'partitions': {}}
+
+    def _save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self.catalog, f, indent=2)
+
+    def _partitions(self, database, table_name):
+        return self.catalog['partitions'].setdefault(f'{database}.{table_name}', {})
+
+    def put_table(self, database, table) -> None:
+        self.catalog['tables'][f"{database}.{table['Name']}"] = table
+        self._save()
+
+    def get_table(self, DatabaseName, Name):
+        self.calls['get_table'] += 1
+        table = self.catalog['tables'].get(f'{DatabaseName}.{Name}')
+        if table is None:
+            raise EntityNotFoundException(f'Table {DatabaseName}.{Name} not found')
+        return {'Table': copy.deepcopy(table)}
+
+    def get_partitions(self, DatabaseName, TableName, ExcludeColumnSchema=False):
+        # A single page, there's no NextToken
+        self.calls['get_partitions'] += 1
+        partitions = list(copy.deepcopy(self._partitions(DatabaseName, TableName)).values())
+        if ExcludeColumnSchema:
+            for partition in partitions:
+                partition['StorageDescriptor'].pop('Columns', None)
+        return {'Partitions': partitions}
+
+    def batch_get_partition(self, DatabaseName, TableName, PartitionsToGet):
+        self.calls['batch_get_partition'] += 1
+        if len(PartitionsToGet) > 1000:
+            raise ValueError('PartitionsToGet takes at most 1000 entries')
+        partitions = self._partitions(DatabaseName, TableName)
+        return {'Partitions': [copy.deepcopy(partitions[entry['Values'][0]]) for entry in PartitionsToGet
+                               if entry['Values'][0] in partitions],
+                'UnprocessedKeys': []}
+
+    def batch_create_partition(self, DatabaseName, TableName, PartitionInputList):
+        self.calls['batch_create_partition'] += 1
+        if len(PartitionInputList) > 100:
+            raise ValueError('PartitionInputList takes at most 100 entries')
+        partitions = self._partitions(DatabaseName, TableName)
+        errors = []
+        for partition in PartitionInputList:
+            value = partition['Values'][0]
+            if value in partitions:
+                errors.append({'PartitionValues': partition['Values'],
+                               'ErrorDetail': {'ErrorCode': 'AlreadyExistsException',
+                                               'ErrorMessage': 'Partition already exists.'}})
+            else:
+                partitions[value] = copy.deepcopy(partition)
+        self._save()
+        return {'Errors': errors}
+
+    def batch_update_partition(self, DatabaseName, TableName, Entries):
+        self.calls['batch_update_partition'] += 1
+        if len(Entries) > 100:
+            raise ValueError('Entries takes at most 100 entries')
+        partitions = self._partitions(DatabaseName, TableName)
+        errors = []
+        for entry in Entries:
+            value = entry['PartitionValueList'][0]
+            if value in partitions:
+                partitions[value] = copy.deepcopy(entry['PartitionInput'])
+            else:
+                errors.append({'PartitionValueList': entry['PartitionValueList'],
+                               'ErrorDetail': {'ErrorCode': 'EntityNotFoundException',
+                                               'ErrorMessage': 'Partition not found.'}})
+        self._save()
+        return {'Errors': errors}
+
+    def batch_delete_partition(self, DatabaseName, TableName, PartitionsToDelete):
+        self.calls['batch_delete_partition'] += 1
+        if len(PartitionsToDelete) > 25:
+            raise ValueError('PartitionsToDelete takes at most 25 entries')
+        partitions = self._partitions(DatabaseName, TableName)
+        errors = []
+        for entry in PartitionsToDelete:
+            if partitions.pop(entry['Values'][0], None) is None:
+                errors.append({'PartitionValues': entry['Values'],
+                               'ErrorDetail': {'ErrorCode': 'EntityNotFoundException',
+                                               'ErrorMessage': 'Partition not found.'}})
+        self._save()
+        return {'Errors': errors}
+
+    def create_table(self, DatabaseName, TableInput):
+        self.calls['create_table'] += 1
+        if f"{DatabaseName}.{TableInput['Name']}" in self.catalog['tables']:
+            raise ValueError(f"Table {DatabaseName}.{TableInput['Name']} already exists")
+        self.put_table(DatabaseName, {**copy.deepcopy(TableInput), 'DatabaseName': DatabaseName})
+
+    def update_table(self, DatabaseName, TableInput):
+        self.calls['update_table'] += 1
+        if f"{DatabaseName}.{TableInput['Name']}" not in self.catalog['tables']:
+            raise EntityNotFoundException(f"Table {DatabaseName}.{TableInput['Name']} not found")
+        self.put_table(DatabaseName, {**copy.deepcopy(TableInput), 'DatabaseName': DatabaseName})
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--catalog', default='/tmp/cashback/glue_catalog.json')
+    args = parser.parse_args()
+
+    catalog = LocalGlueCatalog(args.catalog)
+    for name, table in catalog.catalog['tables'].items():
+        partitions = catalog.catalog['partitions'].get(name, {})
+        print(f"{name}: {len(table['StorageDescriptor']['Columns'])} column(s), {len(partitions)} partition(s)")
+        for value in sorted(partitions)[-3:]:
+            print(f"  {value} -> {partitions[value]['StorageDescriptor']['Location']}")
+
+
+if __name__ == '__main__':
+    main()
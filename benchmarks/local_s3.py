@@ -0,0 +1,138 @@
+"""
+An S3 client kept in a directory, with the boto3 S3 client methods staging.MultipartWriter calls, so a
+streamed upload runs without AWS. Every request waits for a round trip and for its body to go through at
+the given bandwidth. As with S3, that's per connection, so parts in flight at the same time don't slow
+each other down. Used by upload_benchmark.py, or on its own to list what was uploaded:
+
+    python benchmarks/local_s3.py --root /tmp/cashback_s3
+
+The same part limits as S3 apply, and every request is counted.
+"""
+import argparse
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter
+from hashlib import md5
+
+# S3 takes parts of at least 5 MiB apart from the last, numbered 1 to 10,000
+MIN_PART_SIZE = 5 * 2 ** 20
+MAX_PART_NUMBER = 10_000
+
+
+class LocalS3Client(object):
+    def __init__(self, root, latency=0.02, bandwidth=20 * 2 ** 20):
+        self.root = root
+        # Seconds per request and bytes per second per request
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.calls = Counter()
+        self.uploads = {}
+        self._lock = threading.Lock()
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _transfer(self, size):
+        time.sleep(self.latency + (size / self.bandwidth if self.bandwidth else 0))
+
+    def _write(self, bucket, key, body):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(f'{path}.tmp', path)
+
+    def _part_path(self, upload_id, number):
+        # Parts are kept on disk rather than in memory, so they don't count towards the uploader's
+        return os.path.join(self.root, '.uploads', upload_id, str(number))
+
+    def put_object(self, Bucket, Key, Body):
+        with self._lock:
+            self.calls['put_object'] += 1
+        body = Body.encode() if isinstance(Body, str) else bytes(Body)
+        self._transfer(len(body))
+        self._write(Bucket, Key, body)
+        return {'ETag': f'"{md5(body).hexdigest()}"'}
+
+    def get_object(self, Bucket, Key):
+        from io import BytesIO
+
+        with self._lock:
+            self.calls['get_object'] += 1
+        with open(self._path(Bucket, Key), 'rb') as f:
+            return {'Body': BytesIO(f.read())}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.calls['create_multipart_upload'] += 1
+            self.uploads[upload_id] = {'Bucket': Bucket, 'Key': Key, 'Parts': {}}
+        os.makedirs(os.path.dirname(self._part_path(upload_id, 1)))
+        time.sleep(self.latency)
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if not 1 <= PartNumber <= MAX_PART_NUMBER:
+            raise ValueError(f'PartNumber must be between 1 and {MAX_PART_NUMBER}')
+        body = bytes(Body)
+        self._transfer(len(body))
+        etag = f'"{md5(body).hexdigest()}"'
+        with open(self._part_path(UploadId, PartNumber), 'wb') as f:
+            f.write(body)
+        with self._lock:
+            self.calls['upload_part'] += 1
+            self.uploads[UploadId]['Parts'][PartNumber] = (etag, len(body))
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self._lock:
+            self.calls['complete_multipart_upload'] += 1
+            upload = self.uploads.pop(UploadId)
+        uploaded = upload['Parts']
+        parts = MultipartUpload['Parts']
+        if [part['PartNumber'] for part in parts] != sorted(part['PartNumber'] for part in parts):
+            raise ValueError('Parts must be listed in ascending order')
+        for i, part in enumerate(parts):
+            etag, size = uploaded[part['PartNumber']]
+            if etag != part['ETag']:
+                raise ValueError(f"ETag of part {part['PartNumber']} doesn't match")
+            if i < len(parts) - 1 and size < MIN_PART_SIZE:
+                raise ValueError(f"Part {part['PartNumber']} is smaller than the minimum allowed size")
+        time.sleep(self.latency)
+
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f'{path}.tmp', 'wb') as f:
+            for part in parts:
+                with open(self._part_path(UploadId, part['PartNumber']), 'rb') as part_file:
+                    shutil.copyfileobj(part_file, f)
+        os.replace(f'{path}.tmp', path)
+        shutil.rmtree(os.path.dirname(self._part_path(UploadId, 1)))
+        return {'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self._lock:
+            self.calls['abort_multipart_upload'] += 1
+            self.uploads.pop(UploadId, None)
+        shutil.rmtree(os.path.dirname(self._part_path(UploadId, 1)), ignore_errors=True)
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default='/tmp/cashback_s3')
+    args = parser.parse_args()
+
+    for directory, directories, files in os.walk(args.root):
+        # Parts of uploads that weren't completed
+        directories[:] = sorted(name for name in directories if name != '.uploads')
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            print(f"s3://{os.path.relpath(path, args.root)} {os.path.getsize(path):,} bytes")
+
+
+if __name__ == '__main__':
+    main()
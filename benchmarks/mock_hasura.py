@@ -0,0 +1,87 @@
+"""
+Local stand-in for the Hasura transactions_view endpoint, serving synthetic transactions.
+
+    python benchmarks/mock_hasura.py --port 8765 --rows 200000 --latency 0.05
+
+Honours the $offset, $limit and $from variables and the totalCount aggregate the real query asks for.
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+START = datetime(2024, 3, 25, tzinfo=timezone.utc)
+USER_ID = 'ef2343ae-18f5-4dd5-894c-d9ac7705b2ca'
+
+
+def transaction(index):
+    # Index 0 is the newest, matching order_by: [{date: desc}, {id: asc}]
+    return {
+        'id': str(uuid.UUID(int=index + 1)),
+        'model': 'FiatTransaction',
+        'user_id': USER_ID,
+        'currency': 'GBP',
+        'amount': -(index % 5000 + 1),
+        'date': (START - timedelta(minutes=17 * index)).isoformat(),
+        'type': 'CARD_SETTLEMENT',
+        'is_debit': None,
+        'description': f'MERCHANT {index % 300}',
+        '__typename': 'transactions_view',
+    }
+
+
+def rows_since(rows, since):
+    if not since:
+        return rows
+    # Dates are spaced 17 minutes apart going back from START
+    minutes = (START - datetime.fromisoformat(since)).total_seconds() / 60
+    return min(rows, int(minutes // 17) + 1)
+
+
+class HasuraHandler(BaseHTTPRequestHandler):
+    rows = 0
+    latency = 0.0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        variables = body.get('variables', {})
+
+        total = rows_since(self.rows, variables.get('from'))
+        offset = variables.get('offset') or 0
+        limit = variables.get('limit')
+        end = total if limit is None else min(total, offset + limit)
+
+        time.sleep(self.latency)
+
+        payload = json.dumps({'data': {
+            'transactions_view_aggregate': {'aggregate': {'totalCount': total, '__typename': 'aggregate'},
+                                            '__typename': 'transactions_view_aggregate'},
+            'transactions_view': [transaction(index) for index in range(offset, end)],
+        }}).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every request')
+    args = parser.parse_args()
+
+    HasuraHandler.rows = args.rows
+    HasuraHandler.latency = args.latency
+    ThreadingHTTPServer(('127.0.0.1', args.port), HasuraHandler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Pulling the nested contis_transaction/fiat_transaction fields out of the shipped rewards.csv scaled up
+--scale times, the regex fast path in rewards.py against a full ast.literal_eval + json_normalize per row.
+
+    python benchmarks/nested_fields_benchmark.py --scale 1000
+
+The copies are processed --chunk at a time so the scaled set doesn't have to fit in memory at once,
+the full parse is timed on --parse-scale copies and scaled up.
+"""
+import argparse
+import ast
+import os
+import sys
+import time
+
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from rewards import flatten_nested_fields  # noqa: E402
+from schema import REWARD_NESTED_FIELDS  # noqa: E402
+
+
+def full_parse(rewards_df):
+    columns = {}
+    for blob in ('contis_transaction', 'fiat_transaction'):
+        parsed = [ast.literal_eval(value) if isinstance(value, str) else {} for value in rewards_df[blob]]
+        normalized = pd.json_normalize(parsed)
+        for source, column, _ in REWARD_NESTED_FIELDS:
+            if source[0] == blob:
+                columns[column] = normalized.get('.'.join(source[1:]))
+    return pd.DataFrame(columns)
+
+
+def timed(run, rewards_df, copies, chunk):
+    elapsed = 0.0
+    for start in range(0, copies, chunk):
+        scaled = pd.concat([rewards_df] * min(chunk, copies - start), ignore_index=True)
+        begin = time.perf_counter()
+        run(scaled)
+        elapsed += time.perf_counter() - begin
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, default=1000)
+    parser.add_argument('--parse-scale', type=int, default=20)
+    parser.add_argument('--chunk', type=int, default=50)
+    args = parser.parse_args()
+
+    rewards_df = pd.read_csv(os.path.join(ROOT, 'rewards.csv'))
+    blob_bytes = sum(rewards_df[blob].dropna().str.len().sum() for blob in ('contis_transaction', 'fiat_transaction'))
+
+    fast = timed(flatten_nested_fields, rewards_df, args.scale, args.chunk)
+    parse = timed(full_parse, rewards_df, args.parse_scale, args.chunk) * args.scale / args.parse_scale
+
+    rows = len(rewards_df) * args.scale
+    print(f"rows: {rows:,} ({blob_bytes * args.scale / 2 ** 20:,.0f} MiB of nested objects)")
+    print(f"regex fast path: {fast:.2f}s")
+    print(f"literal_eval + json_normalize: {parse:.2f}s (timed on {args.parse_scale}x)")
+    print(f"speedup: {parse / fast:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Scaling of the exchange_rate_id back-fill in rewards.normalize_rewards against the iterrows scan it replaces.
+
+    python benchmarks/normalize_rewards_benchmark.py --sizes 10000 100000 1000000
+
+The scan is quadratic, so it is only run up to --loop-max rows, where the outputs are also compared.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rewards import normalize_rewards  # noqa: E402
+
+
+def synthetic_rewards(rows, seed=0):
+    # Rewards come in small groups paid at the same exchange rate, one of them carrying the card details
+    rng = np.random.default_rng(seed)
+    exchange_rate_ids = rng.integers(0, max(rows // 3, 1), size=rows)
+    with_contis = rng.random(rows) < 0.6
+    with_card = ~with_contis & (rng.random(rows) < 0.5)
+    reward_type = np.where(rng.random(rows) < 0.05, 'REBATE_BONUS', 'DAILY_REBATE_DISTRIBUTION')
+    descriptions = np.array([f'MERCHANT {index}' for index in range(500)], dtype=object)
+
+    # A single account, so the legacy scan over exchange_rate_id alone finds the same rewards
+    return pd.DataFrame({
+        'user_id': 'ef2343ae-18f5-4dd5-894c-d9ac7705b2ca',
+        'reward_type': reward_type,
+        'exchange_rate_id': [f'rate-{index}' for index in exchange_rate_ids],
+        'fiat_amount_rewarded': rng.integers(0, 2000, size=rows).astype(float),
+        'contis_transaction_amount': np.where(with_contis, rng.integers(1, 50000, size=rows), np.nan),
+        'contis_description': np.where(with_contis, descriptions[rng.integers(0, 500, size=rows)], None),
+        'contis_currency': np.where(with_contis, 'GBP', None),
+        'card_description': np.where(with_card | (rng.random(rows) < 0.3), descriptions[0], None),
+        'card_transaction_amount': np.where(with_card, rng.uniform(1, 500, size=rows).round(2), np.nan),
+    })
+
+
+def legacy(data):
+    # The commented out back-fill from PlutusApi.get_rewards, on the flat columns, keeping every row
+    data = data.copy()
+
+    data['contis_description'] = data['contis_description'].fillna(data['card_description'])
+    data['contis_transaction_amount'] = data['contis_transaction_amount'].fillna(
+        data['card_transaction_amount'].mul(100))
+
+    nas = data[(data['contis_transaction_amount'].isna()) & (data['reward_type'] != 'REBATE_BONUS')]
+
+    for index, row in nas.iterrows():
+        rebate = data[(data['exchange_rate_id'] == row['exchange_rate_id']) & (
+            data['contis_transaction_amount'].notnull())].head(1)
+        row['contis_transaction_amount'] = row['fiat_amount_rewarded']
+        row['contis_description'] = rebate['contis_description'].iloc[0] if len(rebate) else None
+        row['contis_currency'] = rebate['contis_currency'].iloc[0] if len(rebate) else None
+        data.loc[index] = row
+
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--loop-max', type=int, default=10_000)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'lookup':>10} {'iterrows scan':>14}")
+    for rows in args.sizes:
+        df = synthetic_rewards(rows)
+
+        start = time.perf_counter()
+        result = normalize_rewards(df)
+        lookup = time.perf_counter() - start
+
+        scan = '-'
+        if rows <= args.loop_max:
+            start = time.perf_counter()
+            expected = legacy(df)
+            scan = f'{time.perf_counter() - start:.2f}s'
+            pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+        print(f"{rows:>10,} {lookup:>9.3f}s {scan:>14}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Prints the DDL the Redshift loader creates its table and summary views with, built from a Glue get_table
+description rather than a live Glue catalog.
+
+    python benchmarks/print_redshift_ddl.py --table benchmarks/fixtures/glue_table.json
+
+With --check, the summary view queries are also run in DuckDB against an empty table with the same
+columns, so a query that doesn't parse or names a missing column fails here rather than in the lambda.
+"""
+import argparse
+import json
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from load_to_redshift_lambda import (create_table_sql, glue_schema_to_redshift_ddl, redshift_ddl,  # noqa: E402
+                                     summary_view_queries, table_columns)
+
+
+def check(table):
+    import duckdb
+
+    cursor = duckdb.connect().cursor()
+    cursor.execute("CREATE SCHEMA IF NOT EXISTS public;")
+    # DuckDB has no DISTKEY/SORTKEY, the columns are all that's checked
+    cursor.execute(create_table_sql('cashback', glue_schema_to_redshift_ddl(table_columns(table))))
+    for name, query in summary_view_queries('cashback').items():
+        cursor.execute(query)
+        print(f"-- {name}: {', '.join(column[0] for column in cursor.description)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--table', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures',
+                                                         'glue_table.json'))
+    parser.add_argument('--check', action='store_true')
+    args = parser.parse_args()
+
+    with open(args.table) as f:
+        table = json.load(f)['Table']
+
+    for statement in redshift_ddl(table):
+        print(statement.strip())
+        print()
+
+    if args.check:
+        check(table)
+
+
+if __name__ == '__main__':
+    main()
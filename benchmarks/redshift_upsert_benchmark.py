@@ -0,0 +1,108 @@
+"""
+Runs the Redshift loaders against DuckDB standing in for Redshift, with a plain table in place of the
+Spectrum external table.
+
+    python benchmarks/redshift_upsert_benchmark.py --rows 1000000 --changed 10000
+
+Loads the full set, reloads it unchanged, then reloads it with --changed rewards updated, reporting
+what each mode inserted/updated and how long it took.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from load_to_redshift_lambda import (copy_data_to_redshift, create_redshift_table_from_spectrum,  # noqa: E402
+                                     glue_schema_to_redshift_ddl, upsert_data_to_redshift)
+
+GLUE_TABLE = 'transformed_data_parquet'
+
+# What get_table returns for the transformed table
+COLUMNS = [
+    {'Name': 'reward_id', 'Type': 'string'},
+    {'Name': 'transaction_id', 'Type': 'string'},
+    {'Name': 'plu_amount', 'Type': 'double'},
+    {'Name': 'available', 'Type': 'boolean'},
+    {'Name': 'reason', 'Type': 'string'},
+    {'Name': 'updated_at', 'Type': 'timestamp'},
+    {'Name': 'transaction_date', 'Type': 'string'},
+]
+
+
+def synthetic_rewards(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    start = datetime(2021, 1, 1)
+    dates = [start + timedelta(days=int(day)) for day in rng.integers(0, 1000, size=rows)]
+    return pd.DataFrame({
+        'reward_id': [f'reward-{index}' for index in range(rows)],
+        'transaction_id': [f'transaction-{index}' for index in range(rows)],
+        'plu_amount': rng.uniform(0.01, 10, size=rows),
+        'available': False,
+        'reason': None,
+        'updated_at': pd.to_datetime(dates),
+        'transaction_date': [date.strftime('%Y-%m-%d') for date in dates],
+    })
+
+
+def stand_in(rewards_df):
+    connection = duckdb.connect()
+    cursor = connection.cursor()
+    cursor.execute("CREATE SCHEMA spectrum_schema;")
+    cursor.execute("CREATE SCHEMA public;")
+    cursor.execute("SET schema = 'public';")
+    cursor.register('rewards_df', rewards_df)
+    cursor.execute(f"CREATE TABLE spectrum_schema.{GLUE_TABLE} AS SELECT * FROM rewards_df;")
+    create_redshift_table_from_spectrum(cursor, 'cashback', glue_schema_to_redshift_ddl(COLUMNS))
+    return cursor
+
+
+def change_rewards(cursor, changed):
+    # Rewards becoming available is the usual change, and moves updated_at to the time of the change
+    cursor.execute(f"""
+    UPDATE spectrum_schema.{GLUE_TABLE}
+    SET available = TRUE, updated_at = TIMESTAMP '2024-01-01'
+    WHERE reward_id IN (SELECT reward_id FROM spectrum_schema.{GLUE_TABLE} USING SAMPLE {changed} ROWS);
+    """)
+
+
+def timed(name, run):
+    start = time.perf_counter()
+    result = run()
+    print(f"{name:<32} {time.perf_counter() - start:7.2f}s {result}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--changed', type=int, default=10_000)
+    args = parser.parse_args()
+
+    rewards_df = synthetic_rewards(args.rows)
+    names = [col['Name'] for col in COLUMNS]
+
+    cursor = stand_in(rewards_df)
+    timed('upsert: initial load', lambda: upsert_data_to_redshift(cursor, 'cashback', GLUE_TABLE, names))
+    timed('upsert: unchanged reload', lambda: upsert_data_to_redshift(cursor, 'cashback', GLUE_TABLE, names))
+    change_rewards(cursor, args.changed)
+    timed('upsert: reload with changes', lambda: upsert_data_to_redshift(cursor, 'cashback', GLUE_TABLE, names))
+    cursor.execute("SELECT COUNT(*), SUM(CASE WHEN available THEN 1 ELSE 0 END) FROM cashback;")
+    print(f"loaded rows, available: {cursor.fetchone()}")
+
+    cursor = stand_in(rewards_df)
+    timed('insert: initial load', lambda: copy_data_to_redshift(cursor, 'cashback', GLUE_TABLE))
+    timed('insert: unchanged reload', lambda: copy_data_to_redshift(cursor, 'cashback', GLUE_TABLE))
+    change_rewards(cursor, args.changed)
+    timed('insert: reload with changes', lambda: copy_data_to_redshift(cursor, 'cashback', GLUE_TABLE))
+    cursor.execute("SELECT COUNT(*), SUM(CASE WHEN available THEN 1 ELSE 0 END) FROM cashback;")
+    print(f"loaded rows, available: {cursor.fetchone()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Runs extract -> stage -> transform -> load end to end on this machine: synthetic API records from
+benchmarks/synthetic_data.py in place of Plutus, a directory in place of S3 and DuckDB in place of Redshift.
+
+    python benchmarks/run_pipeline_locally.py --transactions 100000 --root /tmp/cashback
+
+and then, to see an incremental run pick up rewards that changed since,
+
+    python benchmarks/run_pipeline_locally.py --transactions 100000 --root /tmp/cashback --incremental --version 1
+
+--root keeps the staged files, the warehouse, the watermarks, the Glue catalog stand-in from
+benchmarks/local_catalog.py and the DuckDB database between runs.
+Prints the time, rows and bytes of every stage at the end.
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+from functools import partial
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'glue_job'))
+
+# Behave like the deployed functions, e.g. don't pick up .env
+os.environ.setdefault('AWS_LAMBDA_FUNCTION_NAME', 'run_pipeline_locally')
+os.environ.setdefault('METRICS_EMF', 'false')
+
+import duckdb  # noqa: E402
+
+import synthetic_data  # noqa: E402
+from metrics import stage, format_report  # noqa: E402
+from warehouse import WAREHOUSE_PREFIX  # noqa: E402
+
+BUCKET = 'cashback-bucket'
+GLUE_DATABASE = 'cashback_db'
+GLUE_TABLE = 'transformed_data_parquet'
+
+class SyntheticApi(object):
+    """Serves the synthetic records the way PlutusApi does, deltas included."""
+
+    def __init__(self, transactions, days, version):
+        self.transactions = transactions
+        self.days = days
+        self.version = version
+
+    def iter_transactions(self, since=None):
+        since = datetime.fromisoformat(since) if since else None
+        for record in synthetic_data.transactions(self.transactions, self.days):
+            if since is None or datetime.fromisoformat(record['date']) >= since:
+                yield record
+
+    def get_rewards(self, since=None):
+        since = datetime.fromisoformat(since) if since else None
+        for record in synthetic_data.rewards(self.transactions, self.days, self.version):
+            if since is None or datetime.fromisoformat(record['updatedAt']) >= since:
+                yield record
+
+
+def local_path(url):
+    # s3://<bucket>/<key> in the directory standing in for S3
+    return os.path.join(os.environ['LOCAL_STORAGE_PATH'], url[len('s3://'):])
+
+
+def register_partitions(root):
+    """Registers what the transform wrote in a local catalog, putting the table first when the columns change."""
+    from glue_crawler_lambda import PartitionRegistrar, WRITTEN_PARTITIONS_KEY
+    from local_catalog import LocalGlueCatalog
+    from staging import get_storage
+
+    catalog = LocalGlueCatalog(os.path.join(root, 'glue_catalog.json'))
+    with stage('register_partitions') as current:
+        written = json.loads(get_storage(BUCKET).get(WRITTEN_PARTITIONS_KEY))
+        result = PartitionRegistrar(catalog, GLUE_DATABASE, GLUE_TABLE,
+                                    f's3://{BUCKET}/{WAREHOUSE_PREFIX}/').register(written)
+        current.record(rows_in=len(written['partitions']), rows_out=result['created'] + result['updated'])
+    print(f"Catalog requests: {dict(catalog.calls)}")
+    return catalog, sorted(written['partitions'])
+
+
+def copy_files(cursor, raw_table, file_columns, partition, files):
+    # Stands in for Redshift's COPY FROM parquet with a partition's manifest, both match the file's columns by
+    # position
+    cursor.execute(f"INSERT INTO {raw_table} ({', '.join(file_columns)}) "
+                   f"SELECT * FROM read_parquet({files[partition]!r}, hive_partitioning = false);")
+
+
+def load(manifest, database, mode, source='auto', catalog=None):
+    from load_to_redshift_lambda import (RedshiftStateStore, SchemaManager, choose_load_source,
+                                         copy_data_to_redshift, drop_unpublished_partitions, glue_table_columns,
+                                         loaded_version, set_loaded_version, summary_view_queries,
+                                         upsert_data_to_redshift, warehouse_delta)
+
+    columns = glue_table_columns(catalog, GLUE_DATABASE, GLUE_TABLE)
+    files = [os.path.join(local_path(partition['StorageDescriptor']['Location']), '*.parquet')
+             for partition in catalog.get_partitions(DatabaseName=GLUE_DATABASE, TableName=GLUE_TABLE)['Partitions']]
+
+    conn = duckdb.connect(database)
+    cursor = conn.cursor()
+    # The Spectrum table is a view over the partitions registered in the catalog
+    cursor.execute("CREATE SCHEMA IF NOT EXISTS spectrum_schema;")
+    cursor.execute(f"""
+    CREATE OR REPLACE VIEW spectrum_schema.{GLUE_TABLE} AS
+    SELECT {', '.join(column['Name'] for column in columns)}
+    FROM read_parquet({files!r}, hive_partitioning = true, hive_types_autocast = false);
+    """)
+    cursor.execute("CREATE SCHEMA IF NOT EXISTS public;")
+    cursor.execute("SET schema = 'public';")
+    # DuckDB has no DISTKEY/SORTKEY, so the table is created without them. The schema fingerprint is kept
+    # in the database, as in Redshift, so a rerun against the same columns skips the DDL
+    schema = SchemaManager(state=RedshiftStateStore(conn))
+    with stage('ensure_schema') as current:
+        current.record(rows_out=len(schema.ensure(cursor, 'cashback', columns, spectrum=False,
+                                                  attributes=False)))
+
+    # The partitions rewritten since the version last loaded, which is kept in the database as in Redshift
+    loaded = loaded_version(cursor, 'cashback')
+    delta = warehouse_delta(manifest, loaded)
+    written = [file for files in delta.values() for file in files]
+    delta_bytes = sum(file['size'] for file in written)
+    if source == 'auto':
+        source = choose_load_source(delta_bytes) if written else 'spectrum'
+    print(f"Loading {len(delta)} partition(s), {delta_bytes:,} byte(s) written since version {loaded} "
+          f"through {source}")
+
+    with stage(f'{mode}_data_to_redshift') as current:
+        if delta and (mode == 'upsert' or source == 'copy'):
+            files = {value: [os.path.join(os.environ['LOCAL_STORAGE_PATH'], BUCKET, file['key']) for file in files]
+                     for value, files in delta.items()}
+            copy_into = partial(copy_files, files=files) if source == 'copy' else None
+            rows_inserted, rows_updated = upsert_data_to_redshift(cursor, 'cashback', GLUE_TABLE,
+                                                                  [column['Name'] for column in columns],
+                                                                  sorted(delta), copy_into=copy_into,
+                                                                  update=mode == 'upsert')
+            current.record(rows_out=rows_inserted + rows_updated)
+        elif delta:
+            copy_data_to_redshift(cursor, 'cashback', GLUE_TABLE, [column['Name'] for column in columns])
+        if mode == 'upsert':
+            drop_unpublished_partitions(cursor, 'cashback', manifest['partitions'])
+        set_loaded_version(cursor, 'cashback', manifest['version'])
+
+    # Nor materialized views, the summary views are rebuilt as tables from the same queries instead
+    with stage('refresh_summary_views') as current:
+        queries = summary_view_queries('cashback')
+        for name, query in queries.items():
+            cursor.execute(f"CREATE OR REPLACE TABLE public.{name} AS {query};")
+        current.record(rows_out=len(queries))
+
+    schema.applied('cashback', columns)
+    print(f"{schema.round_trips_saved} DDL round trip(s) saved")
+
+    cursor.execute("SELECT COUNT(*) FROM cashback;")
+    return cursor.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=100_000, help='10k up to 10M')
+    parser.add_argument('--days', type=int, default=1000, help='days the transactions are spread over')
+    parser.add_argument('--version', type=int, default=0, help='> 0 changes some rewards, see synthetic_data.py')
+    parser.add_argument('--root', default='/tmp/cashback')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--load-mode', choices=['insert', 'upsert'], default='upsert')
+    parser.add_argument('--load-source', choices=['auto', 'spectrum', 'copy'], default='auto',
+                        help='auto picks COPY for deltas of at least COPY_MIN_BYTES')
+    args = parser.parse_args()
+
+    os.makedirs(args.root, exist_ok=True)
+    os.environ['LOCAL_STORAGE_PATH'] = args.root
+
+    from elt import main as transform
+    from fingerprints import NO_CHANGES
+    from pull_data_glue_job_lambda import (PARTITION_BY, detect_changes, fetch_data, save_touched_partitions,
+                                           save_watermarks, to_s3)
+    from schema import REWARD_SCHEMA, TRANSACTION_SCHEMA
+    from state import StateStore
+
+    # Extract covers generating the records too, they're produced as the frames are built
+    state = StateStore(os.path.join(args.root, 'state.json')) if args.incremental else None
+    api = SyntheticApi(args.transactions, args.days, args.version)
+    transactions_df, rewards_df = fetch_data(api, state, BUCKET)
+
+    # Same as the deployed state machine, a run with nothing new stops before staging
+    detector, changes, _ = detect_changes(transactions_df, rewards_df, BUCKET, incremental=args.incremental)
+    if changes == NO_CHANGES:
+        print(format_report())
+        print("No changes since the last run, nothing transformed or loaded")
+        return
+
+    to_s3(transactions_df, BUCKET, 'staging/transactions.parquet', TRANSACTION_SCHEMA, PARTITION_BY)
+    to_s3(rewards_df, BUCKET, 'staging/rewards.parquet', REWARD_SCHEMA, PARTITION_BY)
+    if state:
+        save_watermarks(state, transactions_df, rewards_df)
+    detector.save('transactions')
+    detector.save('rewards')
+    save_touched_partitions(detector, transactions_df, rewards_df, changes, BUCKET)
+    del transactions_df, rewards_df
+
+    manifest = transform(BUCKET, incremental=args.incremental)
+    # Spectrum reads the partitions registered in the catalog, the load works out which to read from the manifest
+    catalog, _ = register_partitions(args.root)
+    loaded = load(manifest, os.path.join(args.root, 'redshift.duckdb'), args.load_mode, args.load_source, catalog)
+
+    print(format_report())
+    print(f"{loaded:,} reward(s) in the cashback table")
+
+
+if __name__ == '__main__':
+    main()
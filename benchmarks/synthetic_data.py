@@ -0,0 +1,195 @@
+"""
+Synthetic transactions and rewards shaped like the Plutus API records, at any scale. Every reward's
+reference_id is the id of a generated transaction, apart from the REBATE_BONUS ones which have none.
+
+    python benchmarks/synthetic_data.py --transactions 100000 --out /tmp/cashback_sample
+
+writes transactions.csv/rewards.csv in the layout of the shipped samples. Records are built from their index
+alone, so they stream without being held in memory and the same arguments always give the same data.
+"""
+import argparse
+import csv
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+START = datetime(2024, 3, 25, tzinfo=timezone.utc)
+USER_ID = 'ef2343ae-18f5-4dd5-894c-d9ac7705b2ca'
+
+TRANSACTION_TYPES = ['CARD_SETTLEMENT', 'CARD_SETTLEMENT', 'CARD_SETTLEMENT', 'DEPOSIT_FUNDS_RECEIVED', 'CARD_REFUND']
+REASONS = ['Automated approval. Trx below 500'] * 13 + ['Automated approval after 45 days'] * 4 + \
+          ['Rejected by admin', 'Rejected by admin', None]
+MERCHANTS = 300
+
+# Rewards per transaction, the shipped samples have about 0.6
+REWARD_SHARE = 60
+# One in this many rewards has a REBATE_BONUS added alongside it
+BONUS_EVERY = 200
+
+
+def _id(namespace, index):
+    return str(uuid.UUID(int=(namespace << 96) + index + 1))
+
+
+def _spread(index, count, days):
+    # Index 0 is the newest, the rest are spaced evenly back over days
+    return START - timedelta(minutes=days * 1440 * index / max(count, 1))
+
+
+def _mix(index):
+    # Cheap deterministic scramble so neighbouring records don't all look the same
+    return (index * 2654435761) % 2 ** 32
+
+
+def transaction(index, count, days=1000):
+    mixed = _mix(index)
+    return {
+        'id': _id(1, index),
+        'model': 'FiatTransaction',
+        'user_id': USER_ID,
+        'currency': 'GBP',
+        'amount': -(mixed % 20000 + 1),
+        'date': _spread(index, count, days).isoformat(),
+        'type': TRANSACTION_TYPES[mixed % len(TRANSACTION_TYPES)],
+        'is_debit': None,
+        'description': f'MERCHANT {mixed % MERCHANTS}',
+        '__typename': 'transactions_view',
+    }
+
+
+def has_reward(index):
+    return _mix(index) % 100 < REWARD_SHARE
+
+
+def transactions(count, days=1000):
+    for index in range(count):
+        yield transaction(index, count, days)
+
+
+def _reward(reward_index, index, count, days, version, changed_every):
+    parent = transaction(index, count, days)
+    mixed = _mix(reward_index + 7)
+    amount = abs(parent['amount'])
+    created_at = _spread(index, count, days) + timedelta(days=2)
+    # Rewards picked for a later version were updated that many days after the newest one was created
+    changed = version and changed_every and reward_index % changed_every == 0
+    updated_at = START + timedelta(days=2 + version) if changed else created_at
+
+    kind = mixed % 20
+    rebate_rate = 0 if kind == 19 else 5
+    fiat_amount_rewarded = float(amount * rebate_rate // 100 if rebate_rate else 1000)
+    reward = {
+        'id': _id(2, reward_index),
+        'user_id': USER_ID,
+        'amount': round(fiat_amount_rewarded / 100 / (0.2 + mixed % 100 / 100), 8),
+        'rebate_rate': rebate_rate,
+        'type': 'DAILY_REBATE_DISTRIBUTION',
+        'reference_type': None,
+        'reference_id': parent['id'],
+        'available': bool(changed) or created_at < START - timedelta(days=45),
+        'reason': REASONS[mixed % len(REASONS)],
+        'base_rate': 3,
+        'staking_rate': 2,
+        'subscription_plan': 'premium',
+        # Rewards paid out the same day share an exchange rate
+        'exchange_rate_id': _id(3, (START + timedelta(days=2) - created_at).days),
+        'fiat_amount_rewarded': fiat_amount_rewarded,
+        'approved_by': None,
+        'createdAt': created_at.isoformat().replace('+00:00', 'Z'),
+        'updatedAt': updated_at.isoformat().replace('+00:00', 'Z'),
+        'contis_transaction': None,
+        'fiat_transaction': None,
+    }
+
+    if kind < 13:
+        reward['reference_type'] = 'contis_transactions'
+        reward['contis_transaction'] = {'description': parent['description'], 'transaction_amount': amount,
+                                        'currency': 'GBP'}
+    elif kind < 19:
+        reward['reference_type'] = 'fiat_transactions'
+        reward['fiat_transaction'] = {
+            'id': parent['id'],
+            'type': parent['type'],
+            'fiat_amount': f'{-amount / 100:.2f}',
+            'card_transactions': {
+                'description': parent['description'],
+                'api_response': {
+                    'TransactionAmount': f'{amount / 100:.2f}',
+                    'TransactionCurrency': 'GBP',
+                    'MerchantDetails': {'merchantName': parent['description'].title()},
+                },
+            },
+        }
+    else:
+        # Perk rewards have no amount and get their details from another reward at the same rate
+        reward['reference_type'] = f'perk_{mixed % 20}_reward'
+        reward['fiat_transaction'] = {'id': parent['id'], 'card_transactions': {'description': parent['description']}}
+
+    return reward
+
+
+def _bonus(reward_index, created_at):
+    return {
+        'id': _id(4, reward_index),
+        'user_id': USER_ID,
+        'amount': 1.5,
+        'rebate_rate': 0,
+        'type': 'REBATE_BONUS',
+        'reference_type': 'manual_reward',
+        'reference_id': None,
+        'available': True,
+        'reason': 'Accepted by admin',
+        'base_rate': 0,
+        'staking_rate': 0,
+        'subscription_plan': None,
+        'exchange_rate_id': None,
+        'fiat_amount_rewarded': 500.0,
+        'approved_by': None,
+        'createdAt': created_at,
+        'updatedAt': created_at,
+        'contis_transaction': None,
+        'fiat_transaction': None,
+    }
+
+
+def rewards(count, days=1000, version=0, changed_every=100):
+    """
+    Rewards for transactions(count, days). version > 0 moves updatedAt on every changed_every-th reward
+    past the newest createdAt and makes it available, the way rewards change between two pulls.
+    """
+    reward_index = 0
+    for index in range(count):
+        if not has_reward(index):
+            continue
+        reward = _reward(reward_index, index, count, days, version, changed_every)
+        yield reward
+        if reward_index % BONUS_EVERY == 0:
+            yield _bonus(reward_index, reward['createdAt'])
+        reward_index += 1
+
+
+def write_csv(records, path):
+    # The shipped samples hold the nested objects as their python repr, the same is done here
+    with open(path, 'w', newline='') as f:
+        writer = None
+        for record in records:
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(record))
+                writer.writeheader()
+            writer.writerow({key: '' if value is None else value for key, value in record.items()})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=100_000)
+    parser.add_argument('--days', type=int, default=1000)
+    parser.add_argument('--out', default='.')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    write_csv(transactions(args.transactions, args.days), os.path.join(args.out, 'transactions.csv'))
+    write_csv(rewards(args.transactions, args.days), os.path.join(args.out, 'rewards.csv'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Checks that the pandas and Spark executors of transform_spec.WAREHOUSE give identical warehouse rows, and
+times both, which is what transform_spec.PANDAS_MAX_ROWS is set from. Needs pyspark, which Glue has and
+the lambdas don't.
+
+    python benchmarks/transform_parity.py --transactions 10000 100000 1000000
+
+Both run on the same staged files: synthetic data from benchmarks/synthetic_data.py for every size, and a
+handful of rewards made up to hit the edge cases, e.g. divisions by zero, nulls, rebate rates with a
+fraction and fiat amounts Spark writes in scientific notation. Rows are compared column by column after
+both are converted to the Arrow types the spec casts to, and the first rows that differ are printed.
+Spark runs on a local session with --cores cores.
+"""
+import argparse
+import os
+import sys
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'glue_job'))
+
+os.environ.setdefault('AWS_LAMBDA_FUNCTION_NAME', 'transform_parity')
+os.environ.setdefault('METRICS_EMF', 'false')
+
+from schema import REWARD_SCHEMA, TIMESTAMP, TRANSACTION_SCHEMA  # noqa: E402
+from transform_spec import WAREHOUSE  # noqa: E402
+
+BUCKET = 'cashback-bucket'
+EDGE_CASE_BUCKET = 'edge-cases'
+ARROW_TYPES = {'string': pa.string(), 'double': pa.float64(), 'int': pa.int32(), 'boolean': pa.bool_(),
+               'timestamp': pa.timestamp('us', tz='UTC')}
+
+
+def _id(kind, index):
+    return f'0000000{kind}-0000-0000-0000-{index:012x}'
+
+
+def edge_cases():
+    """Staged transactions and rewards, a reward per case."""
+    transactions = [
+        {'transaction_id': _id(1, 1), 'amount': -4227, 'date': '2024-03-24T21:36:00Z', 'description': 'SHOP',
+         'currency': 'GBP'},
+        {'transaction_id': _id(1, 2), 'amount': None, 'date': None, 'description': None, 'currency': None},
+        {'transaction_id': _id(1, 3), 'amount': 0, 'date': '2024-12-31T23:59:59.999999Z'},
+    ]
+    cases = [
+        # rebate_rate, plu_amount, fiat_amount_rewarded, available, reference_id
+        (5.0, 8.79, 211.0, True, _id(1, 1)),
+        # Without a rebate rate the fiat amount is the whole reward
+        (0.0, 2.0, 1234.0, False, _id(1, 1)),
+        # A null rebate rate isn't 0, so the rebate branch, which is null
+        (None, 2.0, 100.0, None, _id(1, 1)),
+        # Division by zero
+        (0.0, 0.0, 100.0, True, _id(1, 1)),
+        (5.0, 0.0, 100.0, True, _id(1, 1)),
+        # Below 1e-3 and from 1e7 Spark writes doubles as 5.0E-4 and 2.0E7
+        (5.0, 1.0, 0.05, True, _id(1, 1)),
+        (5.0, 1.0, 2e9, True, _id(1, 1)),
+        (5.0, 1.0, -0.0, True, _id(1, 1)),
+        # Truncated towards zero when cast to int
+        (2.7, 1.0, 100.0, True, _id(1, 1)),
+        (-2.7, 1.0, 100.0, True, _id(1, 1)),
+        # A transaction with nulls, one without an amount, and no transaction at all
+        (5.0, 1.0, 100.0, True, _id(1, 2)),
+        (5.0, 1.0, 100.0, True, _id(1, 3)),
+        (5.0, 1.0, None, True, _id(9, 9)),
+        (5.0, 1.0, 100.0, True, None),
+    ]
+    rewards = [{'reward_id': _id(2, index), 'rebate_rate': rebate_rate, 'plu_amount': plu_amount,
+                'fiat_amount_rewarded': fiat_amount_rewarded, 'available': available, 'reference_id': reference_id,
+                'reason': None if index % 2 else 'Automated approval', 'reward_type': 'DAILY_REBATE_DISTRIBUTION',
+                'reference_type': 'contis_transactions', 'createdAt': '2024-03-26T21:36:00Z',
+                'updatedAt': '2024-03-27T00:00:00Z'}
+               for index, (rebate_rate, plu_amount, fiat_amount_rewarded, available, reference_id)
+               in enumerate(cases)]
+
+    def table(rows, schema):
+        return pa.Table.from_pylist([{name: row.get(name) for name in schema.names} for row in rows],
+                                    schema=pa.schema([(field.name, pa.string() if field.type == TIMESTAMP
+                                                       else field.type) for field in schema])).cast(schema)
+
+    return table(transactions, TRANSACTION_SCHEMA), table(rewards, REWARD_SCHEMA)
+
+
+def stage_files(count):
+    from pull_data_glue_job_lambda import PARTITION_BY, fetch_data, to_s3
+    from run_pipeline_locally import SyntheticApi
+    from staging import storage_path
+
+    transactions_df, rewards_df = fetch_data(SyntheticApi(count, 1000, 0), None, BUCKET)
+    to_s3(transactions_df, BUCKET, 'staging/transactions.parquet', TRANSACTION_SCHEMA, PARTITION_BY)
+    to_s3(rewards_df, BUCKET, 'staging/rewards.parquet', REWARD_SCHEMA, PARTITION_BY)
+
+    transactions, rewards = edge_cases()
+    for key, table in (('staging/transactions.parquet', transactions), ('staging/rewards.parquet', rewards)):
+        path = storage_path(EDGE_CASE_BUCKET, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table, path)
+
+
+def run_pandas(bucket):
+    from elt import REWARD_COLUMNS, TRANSACTION_COLUMNS, iter_parquet_from_s3, read_parquet_from_s3, transform
+
+    start = time.perf_counter()
+    transactions_df = read_parquet_from_s3(bucket, 'staging/transactions.parquet', TRANSACTION_COLUMNS)
+    df = transform(iter_parquet_from_s3(bucket, 'staging/rewards.parquet', REWARD_COLUMNS), transactions_df)
+    return df, time.perf_counter() - start
+
+
+def run_spark(spark, bucket):
+    import spark_transforms
+    from staging import storage_path
+
+    start = time.perf_counter()
+    rewards_df = spark.read.parquet(storage_path(bucket, 'staging/rewards.parquet'))
+    transactions_df = spark.read.parquet(storage_path(bucket, 'staging/transactions.parquet'))
+    df = spark_transforms.join(rewards_df, transactions_df, WAREHOUSE)
+    df = spark_transforms.derive_columns(spark_transforms.rename_columns(df, WAREHOUSE), WAREHOUSE)
+    df = spark_transforms.cast_columns(df, WAREHOUSE).toPandas()
+    return df, time.perf_counter() - start
+
+
+def to_table(df) -> pa.Table:
+    """df with every column as the Arrow type the spec casts it to, sorted by reward_id."""
+    import pandas as pd
+
+    columns = {}
+    for name, data_type in WAREHOUSE.casts.items():
+        values = df[name]
+        if data_type == 'timestamp':
+            # Spark hands back naive timestamps in the session's time zone, which is UTC
+            values = pd.to_datetime(values, utc=True)
+        columns[name] = pa.array(values, type=ARROW_TYPES[data_type], from_pandas=True)
+    return pa.table(columns).sort_by('reward_id')
+
+
+def compare(expected: pa.Table, actual: pa.Table, show=5) -> bool:
+    if expected.num_rows != actual.num_rows:
+        print(f"  {expected.num_rows} row(s) on pandas, {actual.num_rows} on Spark")
+        return False
+    same = True
+    for name in expected.column_names:
+        left, right = expected[name].to_pylist(), actual[name].to_pylist()
+        differing = [i for i, (a, b) in enumerate(zip(left, right)) if a != b]
+        if differing:
+            same = False
+            print(f"  {name}: {len(differing)} row(s) differ, e.g. "
+                  + ', '.join(f"{left[i]!r} on pandas and {right[i]!r} on Spark" for i in differing[:show]))
+    return same
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--root', default='/tmp/cashback_parity')
+    parser.add_argument('--cores', type=int, default=2)
+    args = parser.parse_args()
+
+    try:
+        from pyspark.sql import SparkSession
+    except ImportError:
+        sys.exit("pyspark isn't installed, the Spark side can't run")
+
+    spark = SparkSession.builder.master(f'local[{args.cores}]').appName('transform_parity') \
+        .config('spark.sql.session.timeZone', 'UTC').getOrCreate()
+    spark.sparkContext.setLogLevel('ERROR')
+
+    failed = False
+    for count in args.transactions:
+        os.environ['LOCAL_STORAGE_PATH'] = os.path.join(args.root, str(count))
+        stage_files(count)
+        for bucket in (EDGE_CASE_BUCKET, BUCKET):
+            pandas_df, pandas_seconds = run_pandas(bucket)
+            spark_df, spark_seconds = run_spark(spark, bucket)
+            same = compare(to_table(pandas_df), to_table(spark_df))
+            failed |= not same
+            rows = 'edge cases' if bucket == EDGE_CASE_BUCKET else f'{count:,} transactions'
+            print(f"{rows:>22} {len(pandas_df):>10,} row(s) pandas {pandas_seconds:7.2f}s "
+                  f"Spark {spark_seconds:7.2f}s {'identical' if same else 'DIFFERENT'}")
+
+    spark.stop()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Compares the derived columns of transform_spec.WAREHOUSE, run by transforms.derive_columns, with the iterrows
+loop elt.py used to run.
+
+    python benchmarks/transforms_benchmark.py --rows 1000000
+
+The loop is far too slow to run on 1M rows so it is timed on --loop-rows and scaled up linearly.
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from transform_spec import WAREHOUSE  # noqa: E402
+from transforms import derive_columns  # noqa: E402
+
+
+def synthetic_rewards(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    rebate_rate = rng.choice([0, 1, 2, 3, 5, 8], size=rows)
+    amount = rng.integers(-50000, 50000, size=rows).astype(float)
+    # Rewards without a matching transaction come out of the left join with a null amount
+    amount[rng.random(rows) < 0.02] = np.nan
+    return pd.DataFrame({
+        'plu_amount': rng.uniform(0.01, 10, size=rows).round(8),
+        'rebate_rate': rebate_rate,
+        'fiat_amount_rewarded': rng.integers(0, 2000, size=rows).astype(float),
+        'amount': amount,
+        # The spec derives the timestamp and partition value from it too, days from 2024-01-01 on
+        'transaction_date': pd.to_datetime(19_723 + rng.integers(0, 1000, size=rows), unit='D', utc=True),
+    })
+
+
+def legacy_loop(df):
+    df = df.copy()
+    for index, row in df.iterrows():
+        if row['rebate_rate'] == 0.0:
+            df.loc[index, 'plu_price'] = row['fiat_amount_rewarded'] / row['plu_amount']
+        else:
+            df.loc[index, 'plu_price'] = ((abs(row['amount']) / 100) * row['rebate_rate']) / row['plu_amount']
+    df['transaction_amount'] = df['amount'].apply(lambda x: abs(x) / 100)
+    return df
+
+
+def spark_reference(row):
+    # Row at a time transcription of the spec's expressions
+    transaction_amount = abs(row['amount']) / 100
+    if row['rebate_rate'] == 0.0:
+        plu_price = row['fiat_amount_rewarded'] / row['plu_amount'] if row['plu_amount'] else math.nan
+    else:
+        plu_price = ((abs(transaction_amount) / 100) * row['rebate_rate']) / row['plu_amount'] \
+            if row['plu_amount'] else math.nan
+    return transaction_amount, plu_price, abs(row['fiat_amount_rewarded']) / 100
+
+
+def check(df, result, sample=5000):
+    for index in df.index[:sample]:
+        expected = spark_reference(df.loc[index])
+        actual = result.loc[index, ['transaction_amount', 'plu_price', 'fiat_amount_rewarded']].tolist()
+        np.testing.assert_allclose(actual, expected, equal_nan=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--loop-rows', type=int, default=20_000)
+    args = parser.parse_args()
+
+    df = synthetic_rewards(args.rows)
+
+    start = time.perf_counter()
+    result = derive_columns(df, WAREHOUSE)
+    vectorised = time.perf_counter() - start
+
+    check(df, result)
+
+    loop_rows = min(args.loop_rows, args.rows)
+    start = time.perf_counter()
+    legacy_loop(df.head(loop_rows))
+    loop = (time.perf_counter() - start) * args.rows / loop_rows
+
+    print(f"rows: {args.rows:,}")
+    print(f"vectorised: {vectorised:.3f}s")
+    print(f"iterrows loop: {loop:.3f}s (timed on {loop_rows:,} rows)")
+    print(f"speedup: {loop / vectorised:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Peak memory and throughput of uploading the staging files, the old serialize-everything-then-put_object
+against the multipart upload staging.MultipartWriter streams the file into, with each parquet codec and
+number of parallel parts. Uploads go to the S3 stand-in in benchmarks/local_s3.py, which adds a round trip
+to every request and sends each at --bandwidth MiB/s, the way a single S3 connection does.
+
+    python benchmarks/upload_benchmark.py --transactions 1000000
+
+The staged files for that many synthetic transactions are written to --root first. Every case then runs
+in its own process, reads them back and uploads them again. The frame being uploaded is read before the
+clock starts, so memory is sampled while the upload runs and reported above what the process held before
+it, Arrow allocates outside the python heap so tracemalloc would miss it. Every uploaded file is read back
+and checked against the frame.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pyarrow as pa
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+sys.path.insert(0, BENCHMARKS)
+
+os.environ.setdefault('AWS_LAMBDA_FUNCTION_NAME', 'upload_benchmark')
+os.environ.setdefault('METRICS_EMF', 'false')
+
+from local_s3 import LocalS3Client  # noqa: E402
+from schema import REWARD_SCHEMA, TRANSACTION_SCHEMA  # noqa: E402
+from staging import MultipartWriter, read_parquet_bytes, to_parquet_bytes, write_parquet  # noqa: E402
+
+BUCKET = 'cashback-bucket'
+FILES = {'staging/transactions.parquet': TRANSACTION_SCHEMA, 'staging/rewards.parquet': REWARD_SCHEMA}
+# (path, codec, parallel parts)
+CASES = [('put', 'snappy', 1), ('stream', 'snappy', 1), ('stream', 'snappy', 4), ('stream', 'zstd', 4)]
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+class RssSampler(object):
+    """Highest RSS the process reaches while in the block, sampled every interval seconds."""
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def _sample(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, rss())
+            self._done.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss())
+
+
+def stage_files(count):
+    from pull_data_glue_job_lambda import fetch_data, to_s3
+    from run_pipeline_locally import SyntheticApi
+
+    transactions_df, rewards_df = fetch_data(SyntheticApi(count, 1000, 0), None, BUCKET)
+    to_s3(transactions_df, BUCKET, 'staging/transactions.parquet', TRANSACTION_SCHEMA)
+    to_s3(rewards_df, BUCKET, 'staging/rewards.parquet', REWARD_SCHEMA)
+
+
+def upload(client, df, schema, key, path, codec, workers, part_size):
+    if path == 'put':
+        # What to_s3 did: the whole file serialized, then sent in one request
+        client.put_object(Bucket=BUCKET, Key=key, Body=to_parquet_bytes(df, schema))
+        return 1
+    with MultipartWriter(client, BUCKET, key, part_size=part_size, max_workers=workers) as writer:
+        write_parquet(df, schema, writer, compression=codec)
+    return max(len(writer.parts), 1)
+
+
+def run(path, codec, workers, args):
+    from pull_data_glue_job_lambda import read_staged
+
+    client = LocalS3Client(os.path.join(args.root, 's3'), latency=args.latency / 1000,
+                           bandwidth=args.bandwidth * 2 ** 20)
+    for file_name, schema in FILES.items():
+        df = read_staged(BUCKET, file_name)
+        key = f'{path}-{codec}-{workers}/{file_name}'
+        # What reading the file left in Arrow's pool would otherwise be reused by the upload unseen
+        pa.default_memory_pool().release_unused()
+        before = rss()
+        start = time.perf_counter()
+        with RssSampler() as sampler:
+            parts = upload(client, df, schema, key, path, codec, workers, args.part_size * 2 ** 20)
+        elapsed = time.perf_counter() - start
+
+        uploaded = client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+        assert read_parquet_bytes(uploaded).equals(df), f'{key} reads back differently'
+        name = os.path.basename(file_name)
+        print(f"{path:<6} {codec:<6} {workers} worker(s) {name:<20} {len(uploaded) / 2 ** 20:7.1f} MiB "
+              f"{parts:>4} part(s) {elapsed:6.2f}s {len(uploaded) / 2 ** 20 / elapsed:7.1f} MiB/s "
+              f"peak +{(sampler.peak - before) / 2 ** 20:7.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transactions', type=int, default=1_000_000)
+    parser.add_argument('--root', default='/tmp/cashback_upload')
+    parser.add_argument('--part-size', type=int, default=8, help='MiB')
+    parser.add_argument('--latency', type=float, default=20, help='ms per request')
+    parser.add_argument('--bandwidth', type=float, default=20, help='MiB/s per request')
+    parser.add_argument('--case', nargs=3, metavar=('PATH', 'CODEC', 'WORKERS'))
+    parser.add_argument('--stage', action='store_true')
+    args = parser.parse_args()
+
+    os.environ['LOCAL_STORAGE_PATH'] = args.root
+
+    if args.stage:
+        stage_files(args.transactions)
+        return
+    if args.case:
+        path, codec, workers = args.case
+        run(path, codec, int(workers), args)
+        return
+
+    common = ['--transactions', str(args.transactions), '--root', args.root, '--part-size', str(args.part_size),
+              '--latency', str(args.latency), '--bandwidth', str(args.bandwidth)]
+    subprocess.run([sys.executable, __file__, *common, '--stage'], check=True)
+    for path, codec, workers in CASES:
+        subprocess.run([sys.executable, __file__, *common, '--case', path, codec, str(workers)], check=True)
+
+
+if __name__ == '__main__':
+    main()
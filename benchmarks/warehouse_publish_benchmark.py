@@ -0,0 +1,85 @@
+"""
+Clearing a daily partitioned warehouse one DELETE per object against delete_objects batches, on the local
+storage stand-in with --latency seconds added to every request to play the part of the S3 round trip.
+
+    python benchmarks/warehouse_publish_benchmark.py --partitions 3000 --latency 0.02
+
+Then publishes the same partitions through WarehousePublisher a few times to show the manifest swap and
+the old versions being collected.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from staging import LocalStorage, delete_keys  # noqa: E402
+from warehouse import WarehousePublisher  # noqa: E402
+
+
+class SlowStorage(LocalStorage):
+    # Counts requests and makes each one cost a round trip
+    def __init__(self, root, bucket_name, latency):
+        super().__init__(root, bucket_name)
+        self.latency = latency
+        self.requests = 0
+
+    def delete(self, key):
+        self.requests += 1
+        time.sleep(self.latency)
+        os.remove(self.path(key))
+
+    def delete_batch(self, keys):
+        self.requests += 1
+        time.sleep(self.latency)
+        return super().delete_batch(keys)
+
+
+def fill(storage, partitions):
+    for day in pd.date_range('2020-01-01', periods=partitions).strftime('%Y-%m-%d'):
+        storage.put(f'datawarehouse/transaction_date={day}/part-0.parquet', b'')
+    return storage.keys('datawarehouse/')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--partitions', type=int, default=3000)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        storage = SlowStorage(root, 'cashback-bucket', args.latency)
+
+        keys = fill(storage, args.partitions)
+        start = time.perf_counter()
+        for key in keys:
+            storage.delete(key)
+        print(f"per object:    {len(keys)} object(s), {storage.requests:>5} request(s), "
+              f"{time.perf_counter() - start:6.2f}s")
+
+        keys = fill(storage, args.partitions)
+        storage.requests = 0
+        start = time.perf_counter()
+        delete_keys(storage, keys)
+        print(f"batched:       {len(keys)} object(s), {storage.requests:>5} request(s), "
+              f"{time.perf_counter() - start:6.2f}s")
+
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        df = pd.DataFrame({
+            'reward_id': [f'reward-{index}' for index in range(args.partitions)],
+            'updated_at': pd.Timestamp('2024-01-01', tz='UTC'),
+            'transaction_date': pd.date_range('2020-01-01', periods=args.partitions).strftime('%Y-%m-%d'),
+        })
+        publisher = WarehousePublisher(LocalStorage(root, 'cashback-bucket'), keep=1)
+        for _ in range(3):
+            publisher.publish(df)
+            publisher.collect_garbage()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import logging
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from joins import KeyIndex
+from transform_spec import WAREHOUSE
+from warehouse import NULL_PARTITION
+
+logger = logging.getLogger(__name__)
+
+# Columns that change whenever a record does. Rewards carry updatedAt, transactions don't, so the
+# fields of theirs that can be corrected are hashed instead
+CHANGE_COLUMNS = {
+    'transactions': ['transaction_id', 'date', 'amount', 'type', 'description', 'currency'],
+    'rewards': ['reward_id', 'updatedAt'],
+}
+
+NO_CHANGES = 'none'
+DELTA = 'delta'
+FULL = 'full'
+
+# A warehouse row per reward: a hash of everything the transform reads for it, from both sides of the join,
+# and the day of the partition it lands in. Days rather than strings keep the file at 12 bytes a reward
+ROW_DTYPE = [('row', '<u8'), ('day', '<i4')]
+NULL_DAY = np.iinfo(np.int32).min
+
+
+def digests(df: pd.DataFrame, columns) -> np.ndarray:
+    """A 64-bit hash of each record's columns, sorted. The hash is of the values, not of their dtype's codes."""
+    columns = [column for column in columns if column in df]
+    if df.empty or not columns:
+        return np.empty(0, dtype=np.uint64)
+    return np.sort(pd.util.hash_pandas_object(df[columns], index=False).to_numpy())
+
+
+def _hashes(df: pd.DataFrame, columns) -> np.ndarray:
+    return pd.util.hash_pandas_object(df[[column for column in columns if column in df]], index=False).to_numpy()
+
+
+def warehouse_rows(transactions_df: pd.DataFrame, rewards_df: pd.DataFrame, spec=WAREHOUSE) -> np.ndarray:
+    """The ROW_DTYPE of the warehouse row each reward becomes, joined to its transaction the way spec does."""
+    left_on, right_on = spec.join
+    rows = np.empty(len(rewards_df), dtype=ROW_DTYPE)
+    if rewards_df.empty:
+        return rows
+
+    index = KeyIndex(transactions_df[right_on])
+    if not index.unique:
+        # The merged staged transactions are unique already, the last one staged wins if they're not
+        transactions_df = transactions_df.drop_duplicates(right_on, keep='last')
+        index = KeyIndex(transactions_df[right_on])
+    positions = index.positions(rewards_df[left_on])
+    found = positions >= 0
+
+    transaction_hashes = np.zeros(len(rewards_df), dtype=np.uint64)
+    transaction_hashes[found] = _hashes(transactions_df, spec.transactions)[positions[found]]
+
+    # The staged column the partition value is derived from, as a UTC day
+    date_column = {new: old for old, new in spec.renames.items()}[spec.partition_by]
+    dates = pd.to_datetime(transactions_df[date_column], utc=True).dt.tz_convert(None).to_numpy()
+    days = np.where(np.isnat(dates), NULL_DAY, dates.astype('datetime64[D]').astype(np.int64)).astype(np.int32)
+    rows['day'] = NULL_DAY
+    rows['day'][found] = days[positions[found]]
+
+    rows['row'] = pd.util.hash_pandas_object(
+        pd.DataFrame({'reward': _hashes(rewards_df, spec.rewards), 'transaction': transaction_hashes}),
+        index=False).to_numpy()
+    return rows
+
+
+def partition_values(days) -> list:
+    """The transaction_date partition value of each of days."""
+    return sorted(NULL_PARTITION if day == NULL_DAY else str(np.datetime64(int(day), 'D')) for day in days)
+
+
+class ChangeSet(object):
+    def __init__(self, name, added, removed, first_run=False):
+        self.name = name
+        # Records that are new or changed since the last run, and those no longer there
+        self.added = added
+        self.removed = removed
+        self.first_run = first_run
+
+    @property
+    def changed(self) -> bool:
+        return self.first_run or bool(self.added or self.removed)
+
+
+class ChangeDetector(object):
+    """
+    Keeps the digests of the records staged by the last run next to them, so a run can tell which
+    records it would stage differently, if any, before uploading anything.
+    """
+
+    def __init__(self, storage, prefix='staging/fingerprints'):
+        self.storage = storage
+        self.prefix = prefix
+        self._digests = {}
+
+    def key(self, name):
+        return f'{self.prefix}/{name}.npy'
+
+    def previous(self, name):
+        """The last run's digests of name, None if there weren't any."""
+        key = self.key(name)
+        if key not in self.storage.keys(key):
+            return None
+        return np.load(BytesIO(self.storage.get(key)), allow_pickle=False)
+
+    def diff(self, name, df: pd.DataFrame) -> ChangeSet:
+        current = self._digests[name] = digests(df, CHANGE_COLUMNS[name])
+        previous = self.previous(name)
+        if previous is None:
+            return ChangeSet(name, len(current), 0, first_run=True)
+
+        added = int((~np.isin(current, previous)).sum())
+        removed = int((~np.isin(previous, current)).sum())
+        # A changed record is both, its new version is added and its old one removed
+        logger.info(f"{name}: {added} record(s) new or changed, {removed} previous version(s) no longer staged")
+        return ChangeSet(name, added, removed)
+
+    def touched_partitions(self, transactions_df, rewards_df, spec=WAREHOUSE):
+        """
+        The partitions holding a warehouse row that isn't the one the last run staged, whichever side of the
+        join it changed on. Both the partition a new or changed reward lands in and the one its previous
+        version was in count, so a reward whose transaction moved day is taken out of its old partition, and
+        a reward that's gone out of its only one. None without the last run's rows to compare with.
+        """
+        current = self._digests['warehouse'] = warehouse_rows(transactions_df, rewards_df, spec)
+        previous = self.previous('warehouse')
+        if previous is None:
+            return None
+
+        added = current[~np.isin(current['row'], previous['row'])]
+        removed = previous[~np.isin(previous['row'], current['row'])]
+        touched = partition_values(np.union1d(added['day'], removed['day']))
+        logger.info(f"warehouse: {len(added)} row(s) new or changed, {len(removed)} previous version(s) gone, "
+                    f"{len(touched)} partition(s) touched")
+        return touched
+
+    def save(self, name) -> None:
+        """Keeps the digests diff() computed for name, once what they describe is staged."""
+        buffer = BytesIO()
+        np.save(buffer, self._digests[name], allow_pickle=False)
+        self.storage.put(self.key(name), buffer.getvalue())
+
+
+def change_result(change_sets, incremental=False) -> str:
+    """What the downstream steps have to do: nothing, rewrite the touched partitions or rebuild."""
+    if not any(change_set.changed for change_set in change_sets):
+        return NO_CHANGES
+    if incremental and not any(change_set.first_run for change_set in change_sets):
+        return DELTA
+    return FULL
@@ -1,18 +1,201 @@
-import boto3
+import json
 import logging
+import os
+
+import boto3
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+
+BUCKET = os.getenv('BUCKET', 'cashback-bucket')
+GLUE_DATABASE = os.getenv('GLUE_DATABASE', 'cashback_db')
+GLUE_TABLE_NAME = os.getenv('GLUE_TABLE_NAME', 'transformed_data_parquet')
+# Where both engines publish the warehouse, see warehouse.WarehousePublisher
+WAREHOUSE_PREFIX = os.getenv('WAREHOUSE_PREFIX', 'datawarehouse')
+# Written by the transform next to the staged files: the partitions it wrote, where, and the columns they hold
+WRITTEN_PARTITIONS_KEY = 'staging/written_partitions.json'
+
+PARTITION_KEY = 'transaction_date'
+PARQUET_INPUT_FORMAT = 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat'
+PARQUET_OUTPUT_FORMAT = 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat'
+PARQUET_SERDE = 'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'
+
+# Most partitions batch_create_partition and batch_update_partition take per request, batch_get_partition
+# and batch_delete_partition
+CREATE_BATCH_SIZE = 100
+GET_BATCH_SIZE = 1000
+DELETE_BATCH_SIZE = 25
+
+# Kept for as long as the container is warm
+_glue_client = None
+_s3_client = None
+
+
+def get_glue_client():
+    global _glue_client
+    if _glue_client is None:
+        _glue_client = boto3.client('glue')
+    return _glue_client
+
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
+
+def read_written_partitions(bucket=BUCKET, key=WRITTEN_PARTITIONS_KEY):
+    try:
+        return json.loads(get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read())
+    except Exception as e:
+        logger.warning(f"Couldn't read the written partitions from s3://{bucket}/{key}: {e}")
+        return None
+
+
+def _batches(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+class PartitionRegistrar(object):
+    """
+    Registers the partitions a transform published straight into the Glue catalog. Each partition points
+    at the version directory its files are in, which a crawler can't work out from the warehouse's layout,
+    so the table itself is created and kept to the published columns here too.
+    glue_client is a boto3 Glue client or anything with the same methods.
+    """
+
+    def __init__(self, glue_client, database=GLUE_DATABASE, table_name=GLUE_TABLE_NAME,
+                 location=f's3://{BUCKET}/{WAREHOUSE_PREFIX}/'):
+        self.glue_client = glue_client
+        self.database = database
+        self.table_name = table_name
+        self.location = location
+
+    def table(self):
+        try:
+            return self.glue_client.get_table(DatabaseName=self.database, Name=self.table_name)['Table']
+        except self.glue_client.exceptions.EntityNotFoundException:
+            return None
+
+    @staticmethod
+    def schema_matches(table, columns) -> bool:
+        registered = [(col['Name'], col['Type']) for col in table['StorageDescriptor']['Columns']]
+        return registered == [(col['Name'], col['Type']) for col in columns]
+
+    def locations(self, values) -> dict:
+        """Location of each of values that's registered already."""
+        found = {}
+        for batch in _batches(values, GET_BATCH_SIZE):
+            response = self.glue_client.batch_get_partition(
+                DatabaseName=self.database, TableName=self.table_name,
+                PartitionsToGet=[{'Values': [value]} for value in batch])
+            # Keys Glue didn't get to are treated as new, creating one that exists only gives an AlreadyExists
+            found.update({partition['Values'][0]: partition['StorageDescriptor']['Location']
+                          for partition in response.get('Partitions', [])})
+        return found
+
+    def registered(self) -> list:
+        """Every partition value registered, a page at a time."""
+        values, page = [], {}
+        while True:
+            response = self.glue_client.get_partitions(DatabaseName=self.database, TableName=self.table_name,
+                                                       ExcludeColumnSchema=True, **page)
+            values.extend(partition['Values'][0] for partition in response.get('Partitions', []))
+            if not response.get('NextToken'):
+                return values
+            page = {'NextToken': response['NextToken']}
+
+    def _check(self, response, action, ignored='AlreadyExistsException'):
+        errors = [error for error in response.get('Errors', [])
+                  if error['ErrorDetail']['ErrorCode'] != ignored]
+        if errors:
+            raise RuntimeError(f"{action} failed for {len(errors)} partition(s), e.g. {errors[0]}")
+
+    def put_table(self, table, columns) -> dict:
+        """Creates the table, or replaces its columns, the way a crawler registers a parquet table."""
+        table_input = {
+            'Name': self.table_name,
+            'TableType': 'EXTERNAL_TABLE',
+            'Parameters': {'classification': 'parquet'},
+            'StorageDescriptor': {'Columns': columns, 'Location': self.location,
+                                  'InputFormat': PARQUET_INPUT_FORMAT, 'OutputFormat': PARQUET_OUTPUT_FORMAT,
+                                  'SerdeInfo': {'SerializationLibrary': PARQUET_SERDE}},
+            'PartitionKeys': [{'Name': PARTITION_KEY, 'Type': 'string'}],
+        }
+        if table is None:
+            self.glue_client.create_table(DatabaseName=self.database, TableInput=table_input)
+        else:
+            self.glue_client.update_table(DatabaseName=self.database, TableInput=table_input)
+        logger.info(f"{'Created' if table is None else 'Updated'} {self.database}.{self.table_name} "
+                    f"with {len(columns)} column(s)")
+        return table_input
+
+    def register(self, written) -> dict:
+        """
+        Creates the partitions in written that aren't registered and points the ones that are at their
+        new location, in as few requests as Glue allows. When the table doesn't exist yet or its columns
+        aren't the ones written, it's put first and every published partition registered, not only the
+        ones this run wrote. Registered partitions the warehouse no longer publishes are deleted, their
+        locations are about to be garbage collected.
+        """
+        table = self.table()
+        partitions = written['partitions']
+        table_changed = table is None or not self.schema_matches(table, written['columns'])
+        if table_changed:
+            table = self.put_table(table, written['columns'])
+            partitions = written.get('published', partitions)
+
+        registered = self.locations(list(partitions))
+        to_create = [value for value in partitions if value not in registered]
+        # A partition keeps the columns it was registered with, so after a schema change they all move
+        to_update = [value for value in partitions
+                     if value in registered and (table_changed or registered[value] != partitions[value])]
+
+        def partition_input(value):
+            # Same format, serde and columns as the table, only the location differs
+            return {'Values': [value],
+                    'StorageDescriptor': {**table['StorageDescriptor'], 'Location': partitions[value]}}
+
+        for batch in _batches(to_create, CREATE_BATCH_SIZE):
+            self._check(self.glue_client.batch_create_partition(
+                DatabaseName=self.database, TableName=self.table_name,
+                PartitionInputList=[partition_input(value) for value in batch]), 'batch_create_partition')
+        for batch in _batches(to_update, CREATE_BATCH_SIZE):
+            self._check(self.glue_client.batch_update_partition(
+                DatabaseName=self.database, TableName=self.table_name,
+                Entries=[{'PartitionValueList': [value], 'PartitionInput': partition_input(value)}
+                         for value in batch]), 'batch_update_partition')
+
+        published = written.get('published', partitions)
+        to_delete = [value for value in self.registered() if value not in published]
+        for batch in _batches(to_delete, DELETE_BATCH_SIZE):
+            self._check(self.glue_client.batch_delete_partition(
+                DatabaseName=self.database, TableName=self.table_name,
+                PartitionsToDelete=[{'Values': [value]} for value in batch]), 'batch_delete_partition',
+                ignored='EntityNotFoundException')
+
+        logger.info(f"Registered {len(partitions)} partition(s): {len(to_create)} created, {len(to_update)} moved, "
+                    f"{len(partitions) - len(to_create) - len(to_update)} unchanged, {len(to_delete)} deleted")
+        return {'table_changed': table_changed, 'created': len(to_create), 'updated': len(to_update),
+                'deleted': len(to_delete)}
+
+
 def lambda_handler(event, context):
-    glue_client = boto3.client('glue')
-    crawler_name = 'cashback_crawler'
-    glue_client.start_crawler(Name=crawler_name)
+    registrar = PartitionRegistrar(get_glue_client())
+    written = (event or {}).get('written_partitions') or read_written_partitions()
 
-    logger.info(f"Crawler {crawler_name} started successfully!")
+    # Loading without them would read whatever the catalog pointed at before this run
+    if written is None:
+        raise RuntimeError(f"No written partitions at s3://{BUCKET}/{WRITTEN_PARTITIONS_KEY} to register")
+    result = registrar.register(written)
 
     return {
         'statusCode': 200,
-        'body': f'Crawler {crawler_name} started successfully!'
+        'body': 'Partitions registered',
+        # The partitions the Redshift loader upserts from
+        'partitions': sorted(written['partitions']),
+        **result
     }
 
 
@@ -1,70 +1,154 @@
+import json
+import logging
+import os
 import pandas as pd
-import s3fs
-import pyarrow.parquet as pq
 import pyarrow as pa
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
 
-s3_filesystem = s3fs.S3FileSystem()
+from joins import iter_left_join, iter_left_join_streamed_right
+from metrics import stage, format_report, reset as reset_metrics
+from rollups import RollupStore, update_rollups
+from schema import expand, to_frame
+from staging import get_storage, storage_path
+from transform_spec import WAREHOUSE
+from transforms import cast_columns, derive_columns, rename_columns
+from warehouse import WarehousePublisher, read_touched_partitions, touched_partitions
 
+logger = logging.getLogger(__name__)
 
-def read_csv_from_s3(bucket, key):
-    file_path = f's3://{bucket}/{key}'
-    return pd.read_csv(file_path)
+# Only rewrite the transaction_date partitions the pull found touched
+INCREMENTAL = os.getenv('INCREMENTAL', 'false').lower() == 'true'
 
+BUCKET = 'cashback-bucket'
 
-# Function to write a DataFrame to a Parquet in S3
-def write_df_to_parquet_s3(df, bucket, key):
-    file_path = f's3://{bucket}/{key}'
-    with s3_filesystem.open(file_path, 'wb') as f:
-        table = pa.Table.from_pandas(df)
-        pq.write_table(table, f, compression='snappy')
+# Only the columns the warehouse is built from are read and joined
+REWARD_COLUMNS = WAREHOUSE.rewards
+TRANSACTION_COLUMNS = WAREHOUSE.transactions
 
 
-BUCKET = 'cashback-bucket'
+# Staged files are typed parquet, so nothing has to be inferred on read. They're held with the compact
+# types from schema.py until the join
+def read_parquet_from_s3(bucket, key, columns=None):
+    return to_frame(pq.read_table(storage_path(bucket, key), columns=columns))
+
+
+def parquet_rows(bucket, key) -> int:
+    # From the footer, no rows are read
+    filesystem, path = pafs.FileSystem.from_uri(storage_path(bucket, key))
+    with filesystem.open_input_file(path) as f:
+        return pq.ParquetFile(f).metadata.num_rows
+
 
-rewards_df = read_csv_from_s3(BUCKET, 'staging/rewards.csv')
-transactions_df = read_csv_from_s3(BUCKET, 'staging/transactions.csv')
+def iter_parquet_from_s3(bucket, key, columns=None, batch_size=100_000):
+    # A batch at a time, so the whole file never has to be in memory
+    filesystem, path = pafs.FileSystem.from_uri(storage_path(bucket, key))
+    with filesystem.open_input_file(path) as f:
+        for batch in pq.ParquetFile(f).iter_batches(batch_size=batch_size, columns=columns):
+            yield to_frame(pa.Table.from_batches([batch]))
 
-joined_df = pd.merge(rewards_df, transactions_df, left_on='reference_id', right_on='transaction_id', how='left')
 
-selected_fields_df = joined_df[["reward_id", "transaction_id", "description", "plu_amount", "date",
-                                "available", "reason", "createdAt", "updatedAt",
-                                "rebate_rate", "fiat_amount_rewarded", "currency",
-                                "reference_type", "reward_type", "amount"]]
+def transform(rewards, transactions, touched=None, spec=WAREHOUSE):
+    """
+    The warehouse rows for the staged rewards and transactions, spec run on pandas. glue_script.py runs the
+    same spec on Spark. Either side is a frame or an iterable of chunks of one, not both: the frame is indexed
+    and the chunks are joined to it one at a time. Each joined chunk is taken through the whole spec before
+    the next, so only the warehouse rows are ever held whole. With touched, only the rows of those
+    partitions are returned.
+    """
+    left_on, right_on = spec.join
+    rows_in = []
 
-selected_fields_df = selected_fields_df.rename(columns={'createdAt': 'created_at', 'updatedAt': 'updated_at',
-                                                        'date': 'transaction_date'})
+    def projected(chunks, columns):
+        for chunk in [chunks] if isinstance(chunks, pd.DataFrame) else chunks:
+            rows_in.append(len(chunk))
+            yield chunk[columns]
 
-# plu price at time of transaction in pence
-for index, row in selected_fields_df.iterrows():
-    if row['rebate_rate'] == 0.0:
-        # fiat_amount_rewarded is 100% of transaction so no need to /100
-        selected_fields_df.loc[index, 'plu_price'] = row['fiat_amount_rewarded'] / row['plu_amount']
+    if isinstance(transactions, pd.DataFrame):
+        # transaction_id is indexed once, then each chunk of rewards is looked up in it
+        rows_in.append(len(transactions))
+        joined = iter_left_join(projected(rewards, spec.rewards), transactions[spec.transactions], left_on, right_on)
     else:
-        selected_fields_df.loc[index, 'plu_price'] = ((abs(row['amount']) / 100) * row[
-            'rebate_rate']) / row['plu_amount']
-
-selected_fields_df['transaction_amount'] = selected_fields_df['amount'].apply(lambda x: abs(x) / 100)
-
-# Changing data types of columns
-selected_fields_df['reward_id'] = selected_fields_df['reward_id'].astype(str)
-selected_fields_df['transaction_id'] = selected_fields_df['transaction_id'].astype(str)
-selected_fields_df['amount'] = pd.to_numeric(selected_fields_df['amount'], errors='coerce')
-selected_fields_df['rebate_rate'] = pd.to_numeric(selected_fields_df['rebate_rate'], downcast='integer',
-                                                  errors='coerce')
-selected_fields_df['reward_type'] = selected_fields_df['reward_type'].astype(str)
-selected_fields_df['reference_type'] = selected_fields_df['reference_type'].astype(str)
-selected_fields_df['available'] = selected_fields_df['available'].astype(bool)
-selected_fields_df['reason'] = selected_fields_df['reason'].astype(str)
-selected_fields_df['fiat_amount_rewarded'] = selected_fields_df['fiat_amount_rewarded'].astype(str)
-# selected_fields_df['created_at'] = pd.to_datetime(selected_fields_df['created_at'])
-# selected_fields_df['updated_at'] = pd.to_datetime(selected_fields_df['updated_at'])
-selected_fields_df['currency'] = selected_fields_df['currency'].astype(str)
-# selected_fields_df['transaction_date'] = pd.to_datetime(selected_fields_df['transaction_date'])
-selected_fields_df['description'] = selected_fields_df['description'].astype(str)
-selected_fields_df['plu_amount'] = pd.to_numeric(selected_fields_df['plu_amount'], errors='coerce')
-selected_fields_df['transaction_amount'] = pd.to_numeric(selected_fields_df['transaction_amount'], errors='coerce')
-
-# Write the final DataFrame to a Parquet file in S3
-# write_df_to_parquet_s3(selected_fields_df, BUCKET, 'datawarehouse/transformed_data.parquet')
-
-selected_fields_df.to_csv('table.csv', index=False)
\ No newline at end of file
+        # Fewer rewards than transactions, so the rewards are indexed and the transactions streamed past them
+        rows_in.append(len(rewards))
+        joined = iter_left_join_streamed_right(rewards[spec.rewards], projected(transactions, spec.transactions),
+                                               left_on, right_on)
+
+    with stage('transform') as current:
+        chunks = []
+        for joined_df in joined:
+            # Back to plain strings and float64 amounts, the types the warehouse is written with. Then
+            # transaction_timestamp and the transaction_date partition value, transaction_amount, plu_price
+            # (price at time of transaction) and the fiat_amount_rewarded scaling
+            chunks.append(cast_columns(derive_columns(rename_columns(expand(joined_df), spec), spec), spec))
+        selected_fields_df = pd.concat(chunks, ignore_index=True)
+        current.record(rows_in=sum(rows_in), rows_out=len(selected_fields_df))
+
+    if touched is not None:
+        with stage('touched_partitions') as current:
+            current.record(rows_in=len(selected_fields_df))
+            selected_fields_df = touched_partitions(selected_fields_df, touched)
+            current.record(rows_out=len(selected_fields_df))
+
+    return selected_fields_df
+
+
+def main(bucket=BUCKET, incremental=INCREMENTAL):
+    publisher = WarehousePublisher(get_storage(bucket))
+    # The partitions the pull found touched, on either side of the join. Without them the whole warehouse
+    # is rewritten
+    touched = read_touched_partitions(publisher.storage) if incremental else None
+    previous = publisher.current() if touched is not None else None
+
+    # The smaller of the two staged files is read whole and indexed, the other is streamed through the join
+    rewards_key, transactions_key = 'staging/rewards.parquet', 'staging/transactions.parquet'
+    with stage('read_staged') as current:
+        if parquet_rows(bucket, rewards_key) < parquet_rows(bucket, transactions_key):
+            rewards = read_parquet_from_s3(bucket, rewards_key, REWARD_COLUMNS)
+            transactions = iter_parquet_from_s3(bucket, transactions_key, TRANSACTION_COLUMNS)
+            current.record(rows_out=len(rewards))
+        else:
+            transactions = read_parquet_from_s3(bucket, transactions_key, TRANSACTION_COLUMNS)
+            rewards = iter_parquet_from_s3(bucket, rewards_key, REWARD_COLUMNS)
+            current.record(rows_out=len(transactions))
+
+    selected_fields_df = transform(rewards, transactions, touched=touched)
+
+    # Write the final DataFrame to a new version of the warehouse in S3, then drop the versions no longer read
+    with stage('publish') as current:
+        manifest = publisher.publish(selected_fields_df, incremental=touched is not None, touched=touched or ())
+        current.record(rows_in=len(selected_fields_df),
+                       bytes_written=sum(file['size'] for files in publisher.written_by(manifest).values()
+                                         for file in files))
+
+    # Where the partitions just written are, for glue_crawler_lambda.py to register in the catalog
+    publisher.storage.put('staging/written_partitions.json', json.dumps(publisher.written_partitions(manifest)))
+
+    # Folds the partitions just written into the monthly/daily/merchant aggregates api.monthly_count reads
+    with stage('update_rollups') as current:
+        states = update_rollups(RollupStore(publisher.storage), publisher, selected_fields_df, manifest, previous,
+                                touched or ())
+        current.record(rows_in=len(selected_fields_df), rows_out=len(states))
+
+    with stage('collect_garbage') as current:
+        current.record(rows_out=publisher.collect_garbage())
+
+    return manifest
+
+
+def lambda_handler(event, context):
+    # The state machine runs the transform here rather than in the Glue job when the staged data is small,
+    # see transform_spec.choose_engine
+    reset_metrics()
+    manifest = main()
+    logger.info(f"Stage report:\n{format_report()}")
+    return {
+        'statusCode': 200,
+        'body': f"Warehouse version {manifest['version']} published",
+        'version': manifest['version'],
+    }
+
+
+if __name__ == '__main__':
+    main()
+    print(format_report())
@@ -1,10 +1,18 @@
+import json
 import sys
+import boto3
 from awsglue.transforms import *
 from awsglue.utils import getResolvedOptions
 from pyspark.context import SparkContext
 from awsglue.context import GlueContext
 from awsglue.job import Job
-from pyspark.sql.functions import col, when, abs as spark_abs, date_format
+
+# Shipped with the job through --extra-py-files
+from rollups import COLUMNS as ROLLUP_COLUMNS, RollupStore, update_rollups
+from spark_transforms import cast_columns, derive_columns, join, publish, rename_columns, touched_partitions
+from staging import S3Storage
+from transform_spec import WAREHOUSE
+from warehouse import WarehousePublisher, read_touched_partitions
 
 # Set up Glue context
 sc = SparkContext()
@@ -15,66 +23,51 @@ args = getResolvedOptions(sys.argv, ['JOB_NAME'])
 
 job.init(args['JOB_NAME'], args)
 
-# Read CSV files from S3
-rewards_df = spark.read.csv("s3://cashback-bucket/staging/rewards.csv", header=True)
-transactions_df = spark.read.csv("s3://cashback-bucket/staging/transactions.csv", header=True)
-
-# Perform join operation
-joined_df = rewards_df.join(transactions_df, rewards_df["reference_id"] == transactions_df["transaction_id"], "left")
-
-# Calculate transaction_amount
-joined_df = joined_df.withColumn("transaction_amount", spark_abs(col("amount")) / 100)
-
-# Select necessary fields
-selected_fields_df = joined_df.select("reward_id", "transaction_id", "description", "plu_amount", "date",
-                                      "available", "reason", "createdAt", "updatedAt",
-                                      "rebate_rate", "fiat_amount_rewarded", "currency",
-                                      "reference_type", "reward_type", "transaction_amount")
-
-# Rename columns using withColumnRenamed
-selected_fields_df = selected_fields_df.withColumnRenamed("createdAt", "created_at") \
-    .withColumnRenamed("updatedAt", "updated_at") \
-    .withColumnRenamed("date", "transaction_date")
-
-selected_fields_df = selected_fields_df.withColumn("transaction_timestamp", col("transaction_date").cast("timestamp"))
-selected_fields_df = selected_fields_df.withColumn("transaction_date", date_format(col("transaction_date"), "yyyy-MM-dd"))
-
-# Calculate plu_price based on rebate_rate and amount
-selected_fields_df = selected_fields_df.withColumn("plu_price",
-                                                   when(col("rebate_rate") == 0.0,
-                                                        col("fiat_amount_rewarded") / col("plu_amount")
-                                                        ).otherwise(
-                                                       ((spark_abs(col("transaction_amount")) / 100) * col("rebate_rate")) / col(
-                                                           "plu_amount")
-                                                   )
-                                                   )
-
-
-selected_fields_df = selected_fields_df.withColumn("fiat_amount_rewarded", spark_abs(col("fiat_amount_rewarded")) / 100)
-
-# Convert data types
-selected_fields_df = selected_fields_df.withColumn("reward_id", col("reward_id").cast("string"))
-selected_fields_df = selected_fields_df.withColumn("transaction_id", col("transaction_id").cast("string"))
-selected_fields_df = selected_fields_df.withColumn("rebate_rate", col("rebate_rate").cast("integer"))
-selected_fields_df = selected_fields_df.withColumn("reward_type", col("reward_type").cast("string"))
-selected_fields_df = selected_fields_df.withColumn("reference_type", col("reference_type").cast("string"))
-# selected_fields_df = selected_fields_df.withColumn("available",
-#                                                    when(col("available") == "TRUE", True)
-#                                                    .when(col("available") == "FALSE", False)
-#                                                    .otherwise(None)  # None is equivalent to null or NaN
-#                                                    )
-selected_fields_df = selected_fields_df.withColumn("available", col("available").cast("boolean"))
-selected_fields_df = selected_fields_df.withColumn("reason", col("reason").cast("string"))
-selected_fields_df = selected_fields_df.withColumn("fiat_amount_rewarded", col("fiat_amount_rewarded").cast("string"))
-selected_fields_df = selected_fields_df.withColumn("created_at", col("created_at").cast("timestamp"))
-selected_fields_df = selected_fields_df.withColumn("updated_at", col("updated_at").cast("timestamp"))
-selected_fields_df = selected_fields_df.withColumn("currency", col("currency").cast("string"))
-selected_fields_df = selected_fields_df.withColumn("description", col("description").cast("string"))
-selected_fields_df = selected_fields_df.withColumn("plu_amount", col("plu_amount").cast("double"))
-selected_fields_df = selected_fields_df.withColumn("transaction_amount", col("transaction_amount").cast("double"))
-
-# Write DataFrame to Parquet file in S3
-selected_fields_df.write.partitionBy("transaction_date").parquet("s3://cashback-bucket/datawarehouse/transformed_data"
-                                                                 ".parquet", mode="overwrite")
+BUCKET = "cashback-bucket"
+
+# --incremental true only rewrites the transaction_date partitions the pull found touched
+incremental = '--incremental' in sys.argv and \
+    getResolvedOptions(sys.argv, ['incremental'])['incremental'].lower() == 'true'
+
+# Timestamps are cast, and transaction_date formatted, in UTC, as the pandas transform does
+spark.conf.set("spark.sql.session.timeZone", "UTC")
+# and written as UTC microseconds, the type pandas writes, rather than INT96, so the versions either engine
+# publishes read back as the same type
+spark.conf.set("spark.sql.parquet.outputTimestampType", "TIMESTAMP_MICROS")
+
+# Published the same way glue_job/elt.py publishes on pandas: a new version under datawarehouse/versions/,
+# then the manifest pointed at it
+publisher = WarehousePublisher(S3Storage(BUCKET, resource=boto3.resource("s3")))
+
+# Read the staged parquet files from S3, types come from the schema the staging lambda wrote. The join,
+# renames, derived columns and casts are transform_spec.WAREHOUSE, the same spec glue_job/elt.py runs on
+# pandas when the staged data is small. Only the columns it uses are selected, so the rest are never read
+rewards_df = spark.read.parquet(f"s3://{BUCKET}/staging/rewards.parquet")
+transactions_df = spark.read.parquet(f"s3://{BUCKET}/staging/transactions.parquet")
+
+selected_fields_df = derive_columns(rename_columns(join(rewards_df, transactions_df, WAREHOUSE), WAREHOUSE),
+                                    WAREHOUSE)
+
+# The partitions the pull found touched, on either side of the join. Without them the whole warehouse is rewritten
+touched = read_touched_partitions(publisher.storage) if incremental else None
+previous = publisher.current() if touched is not None else None
+if touched is not None:
+    selected_fields_df = touched_partitions(selected_fields_df, touched, WAREHOUSE.partition_by)
+
+# Convert data types, the output columns in order. Cached, as it's written and then aggregated
+selected_fields_df = cast_columns(selected_fields_df, WAREHOUSE).cache()
+
+manifest = publish(selected_fields_df, publisher, WAREHOUSE.partition_by, incremental=touched is not None,
+                   touched=touched or ())
+
+# The partitions just written and the columns they hold, for glue_crawler_lambda.py to register in the catalog
+publisher.storage.put("staging/written_partitions.json", json.dumps(publisher.written_partitions(manifest)))
+
+# Folds the partitions just written into the rollups api.monthly_count reads, as glue_job/elt.py does. Only the
+# columns they're built from are read back, a partition at a time
+written_df = publisher.read({**manifest, 'partitions': publisher.written_by(manifest)}, columns=ROLLUP_COLUMNS)
+update_rollups(RollupStore(publisher.storage), publisher, written_df, manifest, previous, touched or ())
+
+publisher.collect_garbage()
 
 job.commit()
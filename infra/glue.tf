@@ -5,6 +5,15 @@ resource "aws_s3_object" "glue_job_script_s3" {
   etag   = filemd5("${local.glue_src_path}glue_script.py") # Checksum check on the file, does a deployment only if the file has changed
 }
 
+# The transform spec, its Spark executor and the warehouse publisher, imported by the job through --extra-py-files
+resource "aws_s3_object" "glue_job_modules_s3" {
+  for_each = toset(local.glue_job_modules)
+  bucket   = var.s3_bucket
+  key      = "glue-script/${each.value}"
+  source   = "${path.root}/../${each.value}"
+  etag     = filemd5("${path.root}/../${each.value}")
+}
+
 resource "aws_glue_job" "glue_job_script" {
   glue_version      = "4.0"                                                                       #optional
   max_retries       = 0                                                                           #optional
@@ -29,6 +38,8 @@ resource "aws_glue_job" "glue_job_script" {
     "--enable-glue-datacatalog" = "true"
     "--job-language"            = "python"
     "--job-bookmark-option"     = "job-bookmark-disable"
+    "--incremental"             = "false"
+    "--extra-py-files"          = join(",", [for module in local.glue_job_modules : "s3://${var.s3_bucket}/glue-script/${module}"])
     #    "--datalake-formats"        = "iceberg"
     #    "--conf"                    = "spark.sql.extensions=org.apache.iceberg.spark.extensions.IcebergSparkSessionExtensions  --conf spark.sql.catalog.glue_catalog=org.apache.iceberg.spark.SparkCatalog  --conf spark.sql.catalog.glue_catalog.warehouse=s3://tnt-erp-sql/ --conf spark.sql.catalog.glue_catalog.catalog-impl=org.apache.iceberg.aws.glue.GlueCatalog  --conf spark.sql.catalog.glue_catalog.io-impl=org.apache.iceberg.aws.s3.S3FileIO"
   }
@@ -41,21 +52,3 @@ resource "aws_glue_catalog_database" "cashback_db" {
     project = var.project
   }
 }
-
-
-resource "aws_glue_crawler" "cashback_data_crawler" {
-  name          = "cashback_data_crawler"
-  role          = aws_iam_role.glue_service_role.arn
-  database_name = aws_glue_catalog_database.cashback_db.name
-
-  s3_target {
-    path = "s3://${var.s3_bucket}/${var.glue_table_name}/"
-  }
-
-  recrawl_policy {
-    recrawl_behavior = "CRAWL_EVERYTHING" #default
-  }
-  tags = {
-    project = var.project
-  }
-}
\ No newline at end of file
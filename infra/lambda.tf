@@ -30,6 +30,16 @@ resource "aws_ecr_repository" "redshift_loader_ecr_repo" {
   force_delete = true
 }
 
+resource "aws_ecr_repository" "partition_registrar_ecr_repo" {
+  name = "partition-registrar-repo"
+  force_delete = true
+}
+
+resource "aws_ecr_repository" "transform_ecr_repo" {
+  name = "transform-repo"
+  force_delete = true
+}
+
 #https://hands-on.cloud/terraform-docker-lambda-example
 
 #A null resource is basically something that doesn't create anything on its own,
@@ -71,6 +81,43 @@ resource "null_resource" "redshift_ecr_image" {
   }
 }
 
+resource "null_resource" "partition_registrar_ecr_image" {
+  # rebuild and push the Docker image if the Python or Dockerfile changes (based on MD5 hash).
+  triggers = {
+    python_file = md5(file("${path.module}/../glue_crawler_lambda.py"))
+    docker_file = md5(file("${path.module}/../Dockerfile"))
+  }
+
+  provisioner "local-exec" {
+    #   logs into ECR, builds a Docker image from a local path, tags it, and pushes it to the created ECR repository.
+    command = <<EOF
+           aws ecr get-login-password --region ${var.aws_region} | docker login --username AWS --password-stdin ${local.account_id}.dkr.ecr.${var.aws_region}.amazonaws.com
+           cd ${path.module}/..
+           docker build -t ${aws_ecr_repository.partition_registrar_ecr_repo.repository_url}:${local.ecr_image_tag} -f Dockerfile .
+           docker push ${aws_ecr_repository.partition_registrar_ecr_repo.repository_url}:${local.ecr_image_tag}
+       EOF
+  }
+}
+
+resource "null_resource" "transform_ecr_image" {
+  # rebuild and push the Docker image if the Python or Dockerfile changes (based on MD5 hash).
+  triggers = {
+    python_file = md5(file("${path.module}/../glue_job/elt.py"))
+    spec_file   = md5(file("${path.module}/../transform_spec.py"))
+    docker_file = md5(file("${path.module}/../TransformDockerfile"))
+  }
+
+  provisioner "local-exec" {
+    #   logs into ECR, builds a Docker image from a local path, tags it, and pushes it to the created ECR repository.
+    command = <<EOF
+           aws ecr get-login-password --region ${var.aws_region} | docker login --username AWS --password-stdin ${local.account_id}.dkr.ecr.${var.aws_region}.amazonaws.com
+           cd ${path.module}/..
+           docker build -t ${aws_ecr_repository.transform_ecr_repo.repository_url}:${local.ecr_image_tag} -f TransformDockerfile .
+           docker push ${aws_ecr_repository.transform_ecr_repo.repository_url}:${local.ecr_image_tag}
+       EOF
+  }
+}
+
 #A data source is something which Terraform expects to exist.
 data "aws_ecr_image" "lambda_image" {
   depends_on = [
@@ -88,6 +135,22 @@ data "aws_ecr_image" "redshift_lambda_image" {
   image_tag       = local.ecr_image_tag
 }
 
+data "aws_ecr_image" "partition_registrar_image" {
+  depends_on = [
+    null_resource.partition_registrar_ecr_image
+  ]
+  repository_name = aws_ecr_repository.partition_registrar_ecr_repo.name
+  image_tag       = local.ecr_image_tag
+}
+
+data "aws_ecr_image" "transform_image" {
+  depends_on = [
+    null_resource.transform_ecr_image
+  ]
+  repository_name = aws_ecr_repository.transform_ecr_repo.name
+  image_tag       = local.ecr_image_tag
+}
+
 resource "aws_lambda_function" "data_pull_lambda" {
   depends_on = [
     null_resource.ecr_image
@@ -141,6 +204,50 @@ resource "aws_lambda_function" "redshift_loader_lambda" {
 
 }
 
+# Registers the partitions a transform published in the catalog, putting the table itself on a schema change
+resource "aws_lambda_function" "partition_registrar_lambda" {
+  depends_on = [
+    null_resource.partition_registrar_ecr_image
+  ]
+
+  function_name = "partition-registrar-lambda"
+  timeout       = 60 # seconds
+  image_uri    = "${aws_ecr_repository.partition_registrar_ecr_repo.repository_url}@${data.aws_ecr_image.partition_registrar_image.id}"
+  package_type = "Image"
+  role         = aws_iam_role.cashback_lambdas_function_role.arn
+
+  environment {
+    variables = {
+      BUCKET           = var.s3_bucket
+      GLUE_DATABASE    = aws_glue_catalog_database.cashback_db.name
+      GLUE_TABLE_NAME  = var.glue_table_name
+      WAREHOUSE_PREFIX = "datawarehouse"
+    }
+  }
+
+}
+
+# Runs the transform on pandas when the pull lambda staged too little to be worth starting the Glue job for
+resource "aws_lambda_function" "transform_lambda" {
+  depends_on = [
+    null_resource.transform_ecr_image
+  ]
+
+  function_name = "transform-lambda"
+  timeout       = 900 # seconds
+  memory_size   = 3008
+  image_uri    = "${aws_ecr_repository.transform_ecr_repo.repository_url}@${data.aws_ecr_image.transform_image.id}"
+  package_type = "Image"
+  role         = aws_iam_role.cashback_lambdas_function_role.arn
+
+  environment {
+    variables = {
+      INCREMENTAL = aws_glue_job.glue_job_script.default_arguments["--incremental"]
+    }
+  }
+
+}
+
 resource "aws_sfn_state_machine" "cashback_state_machine" {
   name     = "cashback-pipeline-orchestration"
   role_arn = aws_iam_role.cashback_lambdas_function_role.arn
@@ -171,47 +278,60 @@ resource "aws_sfn_state_machine" "cashback_state_machine" {
           "BackoffRate": 2
         }
       ],
-      "Next": "Glue StartJobRun"
+      "Next": "Changes"
     },
-    "Glue StartJobRun": {
+    "Changes": {
+      "Type": "Choice",
+      "Choices": [
+        {
+          "Variable": "$.changes",
+          "StringEquals": "none",
+          "Next": "No Changes"
+        }
+      ],
+      "Default": "Engine"
+    },
+    "No Changes": {
+      "Type": "Succeed"
+    },
+    "Engine": {
+      "Type": "Choice",
+      "Choices": [
+        {
+          "Variable": "$.engine",
+          "StringEquals": "pandas",
+          "Next": "Transform Lambda Invoke"
+        }
+      ],
+      "Default": "Glue StartJobRun"
+    },
+    "Transform Lambda Invoke": {
       "Type": "Task",
-      "Resource": "arn:aws:states:::glue:startJobRun.sync",
+      "Resource": "arn:aws:states:::lambda:invoke",
+      "OutputPath": "$.Payload",
       "Parameters": {
-        "JobName": "${aws_glue_job.glue_job_script.name}"
+        "Payload.$": "$",
+        "FunctionName": "${aws_lambda_function.transform_lambda.arn}"
       },
-      "Next": "StartCrawler"
+      "Next": "Register Partitions"
     },
-    "StartCrawler": {
+    "Glue StartJobRun": {
       "Type": "Task",
+      "Resource": "arn:aws:states:::glue:startJobRun.sync",
       "Parameters": {
-        "Name": "${aws_glue_crawler.cashback_data_crawler.name}"
+        "JobName": "${aws_glue_job.glue_job_script.name}"
       },
-      "Resource": "arn:aws:states:::aws-sdk:glue:startCrawler",
-      "Next": "GetCrawler"
+      "Next": "Register Partitions"
     },
-    "GetCrawler": {
+    "Register Partitions": {
       "Type": "Task",
-      "Next": "Choice",
+      "Resource": "arn:aws:states:::lambda:invoke",
+      "OutputPath": "$.Payload",
       "Parameters": {
-        "Name": "${aws_glue_crawler.cashback_data_crawler.name}"
+        "Payload.$": "$",
+        "FunctionName": "${aws_lambda_function.partition_registrar_lambda.arn}"
       },
-      "Resource": "arn:aws:states:::aws-sdk:glue:getCrawler"
-    },
-    "Choice": {
-      "Type": "Choice",
-      "Choices": [
-        {
-          "Variable": "$.Crawler.State",
-          "StringEquals": "RUNNING",
-          "Next": "Wait"
-        }
-      ],
-      "Default": "RedShift Load Lambda Invoke"
-    },
-    "Wait": {
-      "Type": "Wait",
-      "Seconds": 5,
-      "Next": "GetCrawler"
+      "Next": "RedShift Load Lambda Invoke"
     },
     "RedShift Load Lambda Invoke": {
       "Type": "Task",
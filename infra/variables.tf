@@ -1,5 +1,7 @@
 locals {
   glue_src_path = "${path.root}/../glue_job/"
+  # Modules from the repo root the Glue job imports
+  glue_job_modules = ["transform_spec.py", "spark_transforms.py", "warehouse.py", "staging.py", "schema.py", "rollups.py"]
 }
 
 variable "project" {
@@ -0,0 +1,59 @@
+from itertools import islice
+
+import pandas as pd
+import pyarrow as pa
+
+from schema import to_arrow_schema, to_frame
+
+
+def _to_arrow(values, arrow_type) -> pa.Array:
+    if pa.types.is_string(arrow_type):
+        # Anything that isn't a string already, e.g. an unexpected nested object, is kept as its repr
+        return pa.array([value if value is None or isinstance(value, str) else str(value) for value in values],
+                        type=arrow_type)
+
+    if not pa.types.is_timestamp(arrow_type):
+        try:
+            return pa.array(values, type=arrow_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+
+    # ISO timestamps, and numbers the API sent as strings, are parsed by Arrow's cast
+    return pa.array([None if value is None else str(value) for value in values], type=pa.string()).cast(arrow_type)
+
+
+def _get(record, source):
+    if isinstance(source, str):
+        return record.get(source)
+
+    # Path into nested objects, any missing level gives None
+    for key in source:
+        if not isinstance(record, dict):
+            return None
+        record = record.get(key)
+    return record
+
+
+def iter_record_batches(records, fields, chunk_size=50_000):
+    """
+    Builds typed record batches straight from an iterator of API records, chunk_size records at a time.
+    Only the declared fields are kept, nested ones are pulled out of their objects, and they come out
+    under their staged names.
+    """
+    schema = to_arrow_schema(fields)
+    records = iter(records)
+
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+
+        columns = [_to_arrow([_get(record, source) for record in chunk], arrow_type)
+                   for source, _, arrow_type in fields]
+        yield pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def records_to_frame(records, fields, chunk_size=50_000) -> pd.DataFrame:
+    table = pa.Table.from_batches(iter_record_batches(records, fields, chunk_size), schema=to_arrow_schema(fields))
+    # Held with the compact types from schema.py
+    return to_frame(table)
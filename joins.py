@@ -0,0 +1,186 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from schema import UUID, uuid_bytes, uuid_strings
+
+logger = logging.getLogger(__name__)
+
+
+def uuid_keys(keys: pd.Series):
+    """
+    Each UUID key, either string or already the binary(16) held by schema.compact, as the high and low
+    64 bits of its 128-bit value, with a mask of the keys that were UUIDs. The rest come back as zeros,
+    None for both halves if the keys aren't strings at all.
+    """
+    try:
+        array = pa.array(keys, from_pandas=True)
+        if isinstance(array, pa.ChunkedArray):
+            # Arrow backed columns come out chunked
+            array = array.combine_chunks()
+        if array.type == UUID:
+            valid = array.is_valid().to_numpy(zero_copy_only=False)
+        else:
+            array, valid = uuid_bytes(array.cast(pa.string()))
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return None, None, np.zeros(len(keys), dtype=bool)
+
+    # Big endian 16 byte values read back as two 64-bit integers, the null slots hold whatever bytes
+    packed = np.frombuffer(array.buffers()[1], dtype='>u8')[2 * array.offset:2 * (array.offset + len(array))]
+    packed = packed.reshape(-1, 2).astype(np.uint64)
+    packed[~valid] = 0
+    return packed[:, 0], packed[:, 1], valid
+
+
+def _plain(keys: pd.Series) -> pd.Series:
+    # Binary UUIDs as strings, so they match string keys in a pandas index
+    if keys.dtype == pd.ArrowDtype(UUID):
+        return pd.Series(uuid_strings(pa.array(keys)).to_pandas(), index=keys.index)
+    return keys
+
+
+def _combine_chunks(df: pd.DataFrame) -> pd.DataFrame:
+    # Arrow backed columns read in batches or concatenated are chunked, and taking rows from a chunked
+    # column is several times slower than from a contiguous one
+    columns = {}
+    for column in df.columns:
+        values = df[column].array
+        if isinstance(values, (pd.arrays.ArrowStringArray, pd.arrays.ArrowExtensionArray)):
+            array = pa.array(values)
+            if isinstance(array, pa.ChunkedArray) and array.num_chunks > 1:
+                values = pd.arrays.ArrowStringArray(array.combine_chunks(), dtype=values.dtype) \
+                    if isinstance(values, pd.arrays.ArrowStringArray) else \
+                    pd.arrays.ArrowExtensionArray(array.combine_chunks())
+        columns[column] = values
+    return pd.DataFrame(columns, index=df.index)
+
+
+class KeyIndex(object):
+    """
+    Row positions of the keys of one side of a join. UUID keys are hashed on their low 64 bits with the
+    high 64 bits checked on lookup, any other keys fall back to a pandas index of the strings.
+    """
+
+    def __init__(self, keys: pd.Series):
+        high, low, valid = uuid_keys(keys)
+        self.uuids = high is not None and bool(valid.all())
+
+        if self.uuids:
+            self.high = high
+            self.index = pd.Index(low)
+            # Two keys sharing their low half would need the high half to tell them apart, the string
+            # index is used then, which also catches keys that are really duplicated
+            self.uuids = self.index.is_unique
+
+        if not self.uuids:
+            self.index = pd.Index(_plain(keys))
+        self.unique = self.index.is_unique and not self.index.hasnans
+
+    def positions(self, keys: pd.Series) -> np.ndarray:
+        """Position of each key in the indexed side, -1 where it isn't there."""
+        if not self.uuids:
+            return self.index.get_indexer(_plain(keys))
+
+        high, low, valid = uuid_keys(keys)
+        if high is None:
+            return np.full(len(keys), -1, dtype=np.intp)
+
+        found = self.index.get_indexer(low)
+        hit = valid & (found >= 0) & (self.high[found] == high)
+        return np.where(hit, found, -1)
+
+
+def _side_by_side(chunk, matched, left_on, right_on, suffixes):
+    # The left rows next to the right rows they matched, named the way merge would
+    matched = matched.drop(columns=right_on) if left_on == right_on else matched
+
+    overlap = chunk.columns.intersection(matched.columns)
+    chunk = chunk.rename(columns={column: column + suffixes[0] for column in overlap})
+    matched = matched.rename(columns={column: column + suffixes[1] for column in overlap})
+
+    matched.index = chunk.index
+    return pd.concat([chunk, matched], axis=1)
+
+
+def iter_left_join(left_chunks, right: pd.DataFrame, left_on, right_on, suffixes=('_x', '_y')):
+    """
+    pd.merge(left, right, how='left') over left a chunk at a time. The index of right is built once,
+    so memory is bound by right plus one chunk of left and its joined rows.
+    """
+    right = _combine_chunks(right.reset_index(drop=True))
+    index = KeyIndex(right[right_on])
+    if not index.unique:
+        # Duplicate or null keys on the right fan rows out, which merge already gets right
+        logger.warning(f"{right_on} isn't unique, joining with pd.merge instead")
+        right = right.assign(**{right_on: _plain(right[right_on])})
+
+    for chunk in left_chunks:
+        if not index.unique:
+            chunk = chunk.assign(**{left_on: _plain(chunk[left_on])})
+            yield pd.merge(chunk, right, left_on=left_on, right_on=right_on, how='left', suffixes=suffixes)
+            continue
+
+        # Positions that aren't found come back as all-null rows, the same as merge's unmatched rows
+        yield _side_by_side(chunk, right.reindex(index.positions(chunk[left_on])), left_on, right_on, suffixes)
+
+
+def iter_left_join_streamed_right(left: pd.DataFrame, right_chunks, left_on, right_on, suffixes=('_x', '_y'),
+                                  chunk_size=100_000):
+    """
+    pd.merge(left, right, how='left') with right read a chunk at a time instead, for when left is the smaller
+    side. Each chunk of right is indexed and left's keys looked up in it, so memory is bound by left, the
+    right rows it matched and one chunk of right. A left row only has no match once every chunk has been
+    seen, so the joined rows come out at the end, chunk_size at a time in left's order.
+    """
+    left = _combine_chunks(left.reset_index(drop=True))
+    keys = left[left_on]
+    plain_keys = None
+
+    # Left positions and the right rows matching them, chunk by chunk
+    positions, rows, template = [], [], None
+    for chunk in right_chunks:
+        chunk = _combine_chunks(chunk.reset_index(drop=True))
+        template = chunk.iloc[:0]
+        index = KeyIndex(chunk[right_on])
+        if index.unique:
+            found = index.positions(keys)
+            hit = np.flatnonzero(found >= 0)
+            positions.append(hit)
+            rows.append(chunk.take(found[hit]))
+            continue
+
+        # Duplicate or null keys fan rows out, the same as merge
+        if plain_keys is None:
+            plain_keys = pd.DataFrame({'_position': np.arange(len(left)), '_key': _plain(keys).to_numpy()})
+        chunk = chunk.assign(**{right_on: _plain(chunk[right_on])})
+        pairs = plain_keys.merge(chunk.assign(_key=chunk[right_on]), on='_key', how='inner')
+        positions.append(pairs['_position'].to_numpy())
+        rows.append(pairs[chunk.columns])
+    if template is None:
+        raise ValueError(f"No chunks to join {left_on} to {right_on} with")
+
+    matched = np.concatenate(positions) if positions else np.array([], dtype=np.intp)
+    unmatched = np.flatnonzero(np.bincount(matched, minlength=len(left)) == 0)
+    right = pd.concat(rows + [template], ignore_index=True)
+
+    # Unmatched rows take position -1, which reindexes to all nulls like merge's unmatched rows
+    left_positions = np.concatenate([matched, unmatched])
+    right_positions = np.concatenate([np.arange(len(matched)), np.full(len(unmatched), -1)])
+    order = np.argsort(left_positions, kind='stable')
+    left_positions, right_positions = left_positions[order], right_positions[order]
+
+    for start in range(0, len(order), chunk_size):
+        end = start + chunk_size
+        chunk = left.take(left_positions[start:end])
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        yield _side_by_side(chunk, right.reindex(right_positions[start:end]), left_on, right_on, suffixes)
+
+
+def left_join(left: pd.DataFrame, right: pd.DataFrame, left_on, right_on, chunk_size=100_000) -> pd.DataFrame:
+    chunks = (left.iloc[start:start + chunk_size] for start in range(0, len(left), chunk_size))
+    joined = list(iter_left_join(chunks, right, left_on, right_on))
+    if not joined:
+        return pd.merge(left, right, left_on=left_on, right_on=right_on, how='left')
+    return pd.concat(joined, ignore_index=True)
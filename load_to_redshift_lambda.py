@@ -1,8 +1,15 @@
+import hashlib
+import json
 import os
-import psycopg2
-from dotenv import load_dotenv
-import boto3
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+# Every invocation reads the warehouse manifest on S3 and loads the delta over a Redshift connection
+import boto3
+import psycopg2
+
+from metrics import stage, format_report, reset as reset_metrics
 
 # load_dotenv('.env', verbose=True, override=True)
 
@@ -19,6 +26,45 @@ glue_database = 'cashback_db'
 glue_table_name = os.getenv('GLUE_TABLE_NAME')
 redshift_target_table = 'cashback'
 region_name = os.getenv('AWS_REGION', 'eu-west-1')
+# 'insert' only adds rewards that aren't loaded yet, 'upsert' also applies changes to ones that are
+load_mode = os.getenv('LOAD_MODE', 'insert')
+# 'spectrum' reads the delta through the external schema, 'copy' COPYs its parquet files straight from S3,
+# 'auto' picks COPY once the delta is at least COPY_MIN_BYTES
+load_source = os.getenv('LOAD_SOURCE', 'auto')
+copy_min_bytes = int(os.getenv('COPY_MIN_BYTES', str(64 * 2 ** 20)))
+# Where either engine publishes the warehouse and its manifest, and where the COPY manifests go, outside of it
+warehouse_bucket = os.getenv('WAREHOUSE_BUCKET', 'cashback-bucket')
+warehouse_prefix = os.getenv('WAREHOUSE_PREFIX', 'datawarehouse')
+load_manifest_prefix = os.getenv('LOAD_MANIFEST_PREFIX', 'load_manifests/')
+# The warehouse version each table was last loaded from. In Redshift, so it commits with the load itself
+load_state_table = os.getenv('LOAD_STATE_TABLE', 'warehouse_loads')
+# What SchemaManager keeps between runs, the fingerprint of the schema last applied. Next to the data it
+# describes, so it outlives the container
+schema_state_table = os.getenv('SCHEMA_STATE_TABLE', 'schema_state')
+# Seconds a warm container reuses the Glue column list before asking Glue again
+glue_schema_ttl = int(os.getenv('GLUE_SCHEMA_TTL', '300'))
+
+# Kept for as long as the container is warm
+_glue_client = None
+_s3_client = None
+
+
+def get_glue_client():
+    global _glue_client
+    if _glue_client is None:
+        _glue_client = boto3.client('glue', region_name=region_name)
+    return _glue_client
+
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3', region_name=region_name)
+    return _s3_client
+
+
+# Partition hive and Spark write rows with a null partition value to
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
 
 # Mapping from Glue data types to Redshift data types
 DATA_TYPE_MAPPING = {
@@ -30,24 +76,127 @@ DATA_TYPE_MAPPING = {
     'timestamp': 'TIMESTAMP'
 }
 
+# String columns whose width is known. Redshift sizes query memory by the declared width, so these
+# don't get the VARCHAR(256) every other string does
+STRING_COLUMN_TYPES = {
+    'reward_id': 'CHAR(36)',
+    'transaction_id': 'CHAR(36)',
+    'currency': 'CHAR(3)',
+    'reward_type': 'VARCHAR(64)',
+    'reference_type': 'VARCHAR(64)',
+    # A double the Glue job writes as a string
+    'fiat_amount_rewarded': 'VARCHAR(32)',
+    # The yyyy-MM-dd partition value, rewards without a transaction have none, see spectrum_select
+    'transaction_date': 'VARCHAR(10)',
+}
 
-def glue_schema_to_redshift_ddl(glue_client, glue_database, glue_table_name):
-    table = glue_client.get_table(DatabaseName=glue_database, Name=glue_table_name)
-    columns = table['Table']['StorageDescriptor']['Columns']
+# Upserts join the changed rewards to the table on reward_id, distributing on it keeps that join on each
+# slice. Dashboards filter on transaction_date and then created_at, so blocks are sorted that way
+DISTKEY = 'reward_id'
+SORTKEY = ['transaction_date', 'created_at']
 
+# Dashboard aggregates, kept as materialized views over the loaded table and refreshed after every
+# load. Rejected rewards are left out, the same as api.monthly_count
+COLLECTED = "(reason IS NULL OR reason <> 'Rejected by admin')"
+SUMMARY_VIEWS = {
+    'cashback_daily': """
+        SELECT transaction_date, COUNT(*) AS rewards, SUM(plu_amount) AS plu_amount,
+               SUM(CAST(fiat_amount_rewarded AS DOUBLE PRECISION)) AS cashback
+        FROM {table}
+        WHERE {collected}
+        GROUP BY transaction_date""",
+    'cashback_monthly': """
+        SELECT DATE_TRUNC('month', created_at) AS month, COUNT(*) AS rewards, SUM(plu_amount) AS plu_amount,
+               SUM(CAST(fiat_amount_rewarded AS DOUBLE PRECISION)) AS cashback
+        FROM {table}
+        WHERE {collected}
+        GROUP BY DATE_TRUNC('month', created_at)""",
+    'plu_price_monthly': """
+        SELECT DATE_TRUNC('month', created_at) AS month, COUNT(plu_price) AS prices, AVG(plu_price) AS plu_mean,
+               MIN(plu_price) AS plu_min, MAX(plu_price) AS plu_max
+        FROM {table}
+        WHERE {collected}
+        GROUP BY DATE_TRUNC('month', created_at)""",
+    'merchant_spend': """
+        SELECT description AS merchant, COUNT(*) AS rewards, SUM(transaction_amount) AS spend,
+               SUM(CAST(fiat_amount_rewarded AS DOUBLE PRECISION)) AS cashback
+        FROM {table}
+        WHERE {collected}
+        GROUP BY description""",
+}
+
+
+def table_columns(table):
+    """Columns of a Glue get_table description, partition keys last."""
     # Columns used for partitioning the data are not included in ColumnList
-    partition_keys = table['Table']['PartitionKeys']
+    return table['StorageDescriptor']['Columns'] + table.get('PartitionKeys', [])
+
+
+def glue_table_columns(glue_client, glue_database, glue_table_name):
+    return table_columns(glue_client.get_table(DatabaseName=glue_database, Name=glue_table_name)['Table'])
 
-    columns += partition_keys
 
-    column_ddl_parts = []
+def redshift_column_types(columns) -> list:
+    """(name, Redshift type) of each Glue column."""
+    column_types = []
     for col in columns:
         col_name = col['Name']
         glue_type = col['Type']
         redshift_type = DATA_TYPE_MAPPING.get(glue_type, 'VARCHAR(256)')
-        column_ddl_parts.append(f"{col_name} {redshift_type}")
+        if glue_type == 'string':
+            redshift_type = STRING_COLUMN_TYPES.get(col_name, redshift_type)
+        column_types.append((col_name, redshift_type))
+    return column_types
 
-    return ', '.join(column_ddl_parts)
+
+def glue_schema_to_redshift_ddl(columns):
+    return ', '.join(f"{col_name} {redshift_type}" for col_name, redshift_type in redshift_column_types(columns))
+
+
+def table_attributes(column_names):
+    """DISTKEY and SORTKEY for the key columns the table has."""
+    attributes = []
+    if DISTKEY in column_names:
+        attributes.append(f"DISTKEY({DISTKEY})")
+    sortkey = [column for column in SORTKEY if column in column_names]
+    if sortkey:
+        attributes.append(f"COMPOUND SORTKEY({', '.join(sortkey)})")
+    return ' '.join(attributes)
+
+
+def spectrum_select(column_names) -> str:
+    """
+    SELECT list over the Spectrum table. A row of the null partition can come back with the partition's name
+    as its transaction_date, which is made NULL rather than overflow the VARCHAR(10).
+    """
+    return ', '.join(f"NULLIF({column}, '{NULL_PARTITION}') AS {column}" if column == 'transaction_date'
+                     else column for column in column_names)
+
+
+def create_table_sql(redshift_table_name: str, column_ddl: str, attributes: str = '') -> str:
+    return f"""
+    CREATE TABLE IF NOT EXISTS public.{redshift_table_name} (
+        {column_ddl}
+    ){f' {attributes}' if attributes else ''};
+    """
+
+
+def summary_view_queries(redshift_table_name=redshift_target_table):
+    return {name: query.format(table=f'public.{redshift_table_name}', collected=COLLECTED)
+            for name, query in SUMMARY_VIEWS.items()}
+
+
+def redshift_ddl(table, redshift_table_name=redshift_target_table):
+    """
+    Every statement the loader creates its objects with, from a Glue get_table description alone, so
+    the DDL can be built and checked without AWS.
+    """
+    columns = table_columns(table)
+    statements = [create_table_sql(redshift_table_name, glue_schema_to_redshift_ddl(columns),
+                                   table_attributes([col['Name'] for col in columns]))]
+    statements += [f"CREATE MATERIALIZED VIEW public.{name} AS {query};"
+                   for name, query in summary_view_queries(redshift_table_name).items()]
+    return statements
 
 
 def create_spectrum_schema(cursor, iam_role, glue_database, glue_table_name):
@@ -75,20 +224,186 @@ def create_spectrum_schema(cursor, iam_role, glue_database, glue_table_name):
     #     print(row)
 
 
-def create_redshift_table_from_spectrum(cursor, redshift_table_name: str, column_ddl: str):
-    create_table_sql = f"""
-    CREATE TABLE IF NOT EXISTS public.{redshift_table_name} (
-        {column_ddl}
-    );
-    """
-    cursor.execute(create_table_sql)
+def create_redshift_table_from_spectrum(cursor, redshift_table_name: str, column_ddl: str, attributes: str = ''):
+    # An existing table keeps its layout, ALTER TABLE ... ALTER DISTKEY/SORTKEY moves it over in place
+    cursor.execute(create_table_sql(redshift_table_name, column_ddl, attributes))
     logger.info(f"Redshift table '{redshift_table_name}' created")
 
 
-def copy_data_to_redshift(cursor, redshift_table, glue_table_name):
+def create_summary_views(cursor, redshift_table_name=redshift_target_table):
+    # Redshift has no CREATE MATERIALIZED VIEW IF NOT EXISTS
+    cursor.execute("SELECT TRIM(name) FROM stv_mv_info WHERE TRIM(schema) = 'public';")
+    existing = {row[0] for row in cursor.fetchall()}
+
+    for name, query in summary_view_queries(redshift_table_name).items():
+        if name not in existing:
+            cursor.execute(f"CREATE MATERIALIZED VIEW public.{name} AS {query};")
+            logger.info(f"Materialized view '{name}' created")
+
+
+def refresh_summary_views(cursor):
+    # Redshift refreshes incrementally from the rows changed since the last refresh where the view allows it
+    for name in SUMMARY_VIEWS:
+        cursor.execute(f"REFRESH MATERIALIZED VIEW public.{name};")
+    logger.info(f"Refreshed {len(SUMMARY_VIEWS)} materialized view(s)")
+
+
+def table_key_statements(cursor, redshift_table_name, column_names) -> list:
+    """
+    ALTER TABLE statements that move an existing table onto DISTKEY and SORTKEY, CREATE TABLE only sets them
+    on a new one. None when it's laid out that way already.
+    """
+    cursor.execute(f"""
+    SELECT diststyle, sortkey1, sortkey_num FROM svv_table_info
+    WHERE "schema" = 'public' AND "table" = '{redshift_table_name}';
+    """)
+    row = cursor.fetchone()
+    if row is None:
+        return []
+    diststyle, sortkey1, sortkey_num = row
+
+    statements = []
+    if DISTKEY in column_names and diststyle != f'KEY({DISTKEY})':
+        statements.append(f"ALTER TABLE public.{redshift_table_name} ALTER DISTKEY {DISTKEY};")
+    sortkey = [column for column in SORTKEY if column in column_names]
+    if sortkey and (sortkey1 != sortkey[0] or sortkey_num != len(sortkey)):
+        statements.append(f"ALTER TABLE public.{redshift_table_name} ALTER COMPOUND SORTKEY ({', '.join(sortkey)});")
+    return statements
+
+
+def schema_fingerprint(columns) -> str:
+    return hashlib.sha256(json.dumps([[col['Name'], col['Type']] for col in columns]).encode()).hexdigest()
+
+
+def add_column_statements(redshift_table_name, columns, existing):
+    """ALTER TABLE ADD COLUMN for each of columns the table doesn't have, Redshift adds one per statement."""
+    return [f"ALTER TABLE public.{redshift_table_name} ADD COLUMN {name} {column_type};"
+            for name, column_type in redshift_column_types(columns) if name.lower() not in existing]
+
+
+class RedshiftStateStore(object):
+    """
+    state.StateStore's get and set over a key-value table in the database conn is connected to, so what's
+    kept survives cold starts. Each call runs on its own cursor, in whatever transaction conn is in.
+    """
+
+    def __init__(self, conn, table=schema_state_table):
+        self.conn = conn
+        self.table = table
+        self._created = False
+
+    def _cursor(self):
+        cursor = self.conn.cursor()
+        if not self._created:
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (name VARCHAR(256), value VARCHAR(256));")
+            self._created = True
+        return cursor
+
+    def get(self, key, default=None):
+        cursor = self._cursor()
+        cursor.execute(f"SELECT value FROM {self.table} WHERE name = '{key}';")
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row else default
+
+    def set(self, key, value) -> None:
+        cursor = self._cursor()
+        cursor.execute(f"DELETE FROM {self.table} WHERE name = '{key}';")
+        cursor.execute(f"INSERT INTO {self.table} VALUES ('{key}', '{value}');")
+        cursor.close()
+
+
+class SchemaManager(object):
+    """
+    Keeps the Redshift objects in step with the Glue table. The Glue column list is cached while the container
+    is warm, and the fingerprint of the one last applied is kept in state, e.g. a RedshiftStateStore, so a
+    run against an unchanged schema only issues the CREATE TABLE IF NOT EXISTS. When it changes, only the
+    columns the table is missing are added.
+    """
+
+    # CREATE EXTERNAL SCHEMA, the column lookup and the materialized view lookup, left out when unchanged
+    DDL_ROUND_TRIPS = 3
+
+    # Columns fetched from Glue, shared by every instance in the container: (fetched at, columns)
+    _cache = {}
+
+    def __init__(self, state, glue_client=None, ttl=glue_schema_ttl):
+        self.glue_client = glue_client
+        self.state = state
+        self.ttl = ttl
+        self.round_trips_saved = 0
+
+    def columns(self, glue_database, glue_table_name):
+        key = (glue_database, glue_table_name)
+        fetched_at, columns = self._cache.get(key, (None, None))
+        if fetched_at is not None and time.time() - fetched_at < self.ttl:
+            self.round_trips_saved += 1
+            return columns
+
+        columns = glue_table_columns(self.glue_client or get_glue_client(), glue_database, glue_table_name)
+        self._cache[key] = (time.time(), columns)
+        return columns
+
+    def _state_key(self, redshift_table_name):
+        # Per cluster and table, the state file could outlive a change of either
+        return f"redshift_schema:{redshift_endpoint}:{redshift_table_name}"
+
+    def is_current(self, redshift_table_name, columns) -> bool:
+        return self.state.get(self._state_key(redshift_table_name)) == schema_fingerprint(columns)
+
+    def ensure(self, cursor, redshift_table_name, columns, glue_database=glue_database,
+               glue_table_name=glue_table_name, spectrum=True, attributes=True):
+        """
+        Creates or alters the external schema, the table and the summary views so they match columns.
+        Returns the statements it ran, none if the schema is the one last applied. The fingerprint is only
+        saved by applied(), once the transaction they ran in has committed. spectrum and attributes leave out
+        the external schema and the DISTKEY/SORTKEY, for databases that only stand in for Redshift.
+        """
+        # Run whatever the fingerprint says, a table dropped since it was saved would otherwise stay gone
+        create_redshift_table_from_spectrum(cursor, redshift_table_name, glue_schema_to_redshift_ddl(columns),
+                                            table_attributes([col['Name'] for col in columns]) if attributes else '')
+        if self.is_current(redshift_table_name, columns):
+            self.round_trips_saved += self.DDL_ROUND_TRIPS
+            logger.info(f"Schema of '{redshift_table_name}' unchanged, skipping the rest of its DDL")
+            return []
+
+        statements = []
+        if spectrum:
+            create_spectrum_schema(cursor, iam_role, glue_database, glue_table_name)
+
+        cursor.execute(f"""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = '{redshift_table_name}';
+        """)
+        existing = {row[0].lower() for row in cursor.fetchall()}
+        # A new table already has them all. Columns Glue dropped, or whose type changed, are left as they are
+        for statement in add_column_statements(redshift_table_name, columns, existing):
+            cursor.execute(statement)
+            statements.append(statement)
+            logger.info(f"Added column: {statement}")
+        return statements
+
+    def align_keys(self, cursor, redshift_table_name, columns) -> list:
+        """
+        Moves the table onto the DISTKEY and SORTKEY, returns the statements it ran. Redshift redistributes
+        and re-sorts the table in place, which can take a while, so it runs once the load has committed.
+        """
+        statements = table_key_statements(cursor, redshift_table_name, [col['Name'] for col in columns])
+        for statement in statements:
+            cursor.execute(statement)
+            logger.info(f"Changed the table's layout: {statement}")
+        return statements
+
+    def applied(self, redshift_table_name, columns) -> None:
+        self.state.set(self._state_key(redshift_table_name), schema_fingerprint(columns))
+
+
+def copy_data_to_redshift(cursor, redshift_table, glue_table_name, column_names=None):
+    # Columns added since the table was created come after the partition key, so they're matched by name
+    columns = ', '.join(column_names) if column_names else '*'
     copy_query = f"""
-    INSERT INTO {redshift_table} 
-    SELECT * 
+    INSERT INTO {redshift_table} {f'({columns})' if column_names else ''}
+    SELECT {spectrum_select(column_names) if column_names else '*'}
     FROM spectrum_schema.{glue_table_name} s
     WHERE NOT EXISTS (
         SELECT 1 FROM {redshift_table} r WHERE r.reward_id = s.reward_id
@@ -98,16 +413,241 @@ def copy_data_to_redshift(cursor, redshift_table, glue_table_name):
     cursor.execute(copy_query)
     rows_inserted = cursor.rowcount
     logger.info(f"Inserted {rows_inserted} row(s) into Redshift table")
+    return rows_inserted
+
+
+def copy_from_parquet(cursor, raw_table, column_names, partition, manifest_urls):
+    """
+    Bulk loads the parquet files of partition, listed by its Redshift manifest in manifest_urls, straight
+    from S3 without Spectrum.
+    """
+    cursor.execute(f"""
+    COPY {raw_table} ({', '.join(column_names)})
+    FROM '{manifest_urls[partition]}'
+    IAM_ROLE '{iam_role}'
+    FORMAT AS PARQUET
+    MANIFEST;
+    """)
+
+
+def copy_from_stdin(cursor, raw_table, column_names, partition, paths):
+    """
+    The Postgres equivalent of copy_from_parquet for local testing, each file of partition is streamed
+    through COPY FROM STDIN as CSV a batch at a time. paths are each partition's local paths or s3:// URLs.
+    """
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+    from io import BytesIO
+
+    for path in paths[partition]:
+        buffer = BytesIO()
+        for batch in pq.ParquetFile(path).iter_batches(columns=column_names):
+            # Nulls come out unquoted and empty strings quoted, which is how CSV COPY tells them apart
+            pa_csv.write_csv(batch, buffer, pa_csv.WriteOptions(include_header=False))
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {raw_table} ({', '.join(column_names)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def read_warehouse_manifest(s3_client, bucket=warehouse_bucket, prefix=warehouse_prefix):
+    """The manifest of the warehouse version either engine last published, None before the first one."""
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=f'{prefix}/manifest.json')['Body'].read()
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return json.loads(body)
+
+
+def file_version(key) -> str:
+    # <prefix>/versions/<version>/transaction_date=<value>/<file>
+    return key.split('/versions/', 1)[1].split('/', 1)[0]
+
+
+def warehouse_delta(manifest, loaded_version=None) -> dict:
+    """
+    The files of each partition of manifest written by a version after loaded_version, every partition
+    without one. Versions are timestamps, and a manifest only points at versions whose files are all written.
+    """
+    return {value: files for value, files in manifest['partitions'].items()
+            if loaded_version is None or file_version(files[0]['key']) > loaded_version}
+
+
+def loaded_version(cursor, redshift_table_name):
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS {load_state_table} (table_name VARCHAR(128), version VARCHAR(32));")
+    cursor.execute(f"SELECT version FROM {load_state_table} WHERE table_name = '{redshift_table_name}';")
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def set_loaded_version(cursor, redshift_table_name, version) -> None:
+    # In the load's transaction, so the version only moves if the rows it describes are committed
+    cursor.execute(f"DELETE FROM {load_state_table} WHERE table_name = '{redshift_table_name}';")
+    cursor.execute(f"INSERT INTO {load_state_table} VALUES ('{redshift_table_name}', '{version}');")
+
+
+def redshift_manifest(bucket, files) -> dict:
+    # COPY needs content_length for parquet files, the same layout as the warehouse manifest's entries
+    return {'entries': [{'url': f"s3://{bucket}/{file['key']}", 'meta': {'content_length': file['size']},
+                         'mandatory': True} for file in files]}
+
+
+def put_load_manifest(s3_client, bucket, files, name) -> str:
+    key = f"{load_manifest_prefix}{name}.manifest"
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(redshift_manifest(bucket, files)).encode())
+    return f"s3://{bucket}/{key}"
+
+
+def put_load_manifests(s3_client, bucket, delta, name, max_workers=16) -> dict:
+    """A Redshift manifest of each partition's files in delta, its URL by partition."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        urls = executor.map(lambda item: put_load_manifest(s3_client, bucket, item[1], f"{name}/{item[0]}"),
+                            delta.items())
+        return dict(zip(delta, urls))
+
+
+def choose_load_source(delta_bytes, min_copy_bytes=copy_min_bytes):
+    """COPY pays off once the delta is big enough, smaller ones are cheaper to scan through Spectrum."""
+    if load_source in ('spectrum', 'copy'):
+        return load_source
+    return 'copy' if delta_bytes is not None and delta_bytes >= min_copy_bytes else 'spectrum'
+
+
+def partition_filter(partitions) -> str:
+    """transaction_date in partitions, for either Spectrum or the loaded table."""
+    dates = ', '.join(f"'{partition}'" for partition in partitions)
+    condition = f"transaction_date IN ({dates})" if dates else "FALSE"
+    # Both read the rows of hive's null partition with a NULL transaction_date
+    if NULL_PARTITION in partitions:
+        condition = f"({condition} OR transaction_date IS NULL)"
+    return condition
+
+
+def upsert_data_to_redshift(cursor, redshift_table, glue_table_name, column_names, partitions=None,
+                            copy_into=None, update=True):
+    """
+    Loads the new or changed rewards into a temp staging table, then applies them with a set based
+    delete + insert keyed on reward_id. With partitions, the staged rows are everything those partitions
+    hold now, so they replace whatever was loaded in them. Without, only the rows changed since the last
+    load are read, and a loaded row is only replaced by a copy with a later updated_at.
+
+    The delta is read through Spectrum, unless copy_into is given. It's called for each of partitions with
+    a temp table, the columns the warehouse files hold, every one but the transaction_date partition key,
+    and the partition, and copies its files into the table, e.g. with copy_from_parquet. Without update,
+    loaded rewards are left as they are.
+    """
+    staging_table = f"{redshift_table}_staging"
+    columns = ', '.join(column_names)
+    replace = update and partitions is not None
+
+    if copy_into is not None:
+        raw_table = f"{redshift_table}_raw"
+        cursor.execute(f"DROP TABLE IF EXISTS {raw_table};")
+        cursor.execute(f"CREATE TEMP TABLE {raw_table} AS SELECT {columns} FROM {redshift_table} WHERE 1 = 0;")
+        if partitions is None:
+            raise ValueError("Copying needs the partitions to copy")
+        # The files don't hold transaction_date, it's the partition's value from the manifest. So each
+        # partition is copied on its own, then moved into the raw table with it
+        file_columns = [column for column in column_names if column != 'transaction_date']
+        partition_table = f"{redshift_table}_partition"
+        cursor.execute(f"DROP TABLE IF EXISTS {partition_table};")
+        cursor.execute(f"CREATE TEMP TABLE {partition_table} AS "
+                       f"SELECT {', '.join(file_columns)} FROM {raw_table} WHERE 1 = 0;")
+        for partition in partitions:
+            copy_into(cursor, partition_table, file_columns, partition)
+            transaction_date = "NULL" if partition == NULL_PARTITION else f"'{partition}'"
+            cursor.execute(f"INSERT INTO {raw_table} ({', '.join(file_columns)}, transaction_date) "
+                           f"SELECT {', '.join(file_columns)}, {transaction_date} FROM {partition_table};")
+            cursor.execute(f"DELETE FROM {partition_table};")
+        cursor.execute(f"DROP TABLE {partition_table};")
+        source, source_filter, select = raw_table, "TRUE", columns
+    # Only read the partitions that were just written, or failing that the rows changed since the last load
+    elif partitions is not None:
+        source, source_filter = f"spectrum_schema.{glue_table_name}", partition_filter(partitions)
+        select = spectrum_select(column_names)
+    else:
+        cursor.execute(f"SELECT MAX(updated_at) FROM {redshift_table};")
+        last_updated_at = cursor.fetchone()[0]
+        source = f"spectrum_schema.{glue_table_name}"
+        source_filter = f"updated_at > '{last_updated_at}'" if last_updated_at else "TRUE"
+        select = spectrum_select(column_names)
+
+    cursor.execute(f"DROP TABLE IF EXISTS {staging_table};")
+    cursor.execute(f"CREATE TEMP TABLE {staging_table} AS SELECT {columns} FROM {redshift_table} WHERE 1 = 0;")
+    cursor.execute(f"""
+    INSERT INTO {staging_table}
+    SELECT {columns}
+    FROM (
+        SELECT {select}, ROW_NUMBER() OVER (PARTITION BY reward_id ORDER BY updated_at DESC) AS version
+        FROM {source}
+        WHERE {source_filter}
+    ) s
+    WHERE version = 1;
+    """)
+    if copy_into is not None:
+        cursor.execute(f"DROP TABLE {source};")
+
+    newer = "TRUE" if replace else \
+        "(s.updated_at > r.updated_at OR (r.updated_at IS NULL AND s.updated_at IS NOT NULL))"
+    cursor.execute(f"""
+    SELECT
+        SUM(CASE WHEN r.reward_id IS NULL THEN 1 ELSE 0 END),
+        SUM(CASE WHEN r.reward_id IS NOT NULL AND {newer} THEN 1 ELSE 0 END)
+    FROM {staging_table} s
+    LEFT JOIN {redshift_table} r ON r.reward_id = s.reward_id;
+    """)
+    rows_inserted, rows_updated = (count or 0 for count in cursor.fetchone())
+
+    if replace:
+        # Every loaded copy of a staged reward goes, wherever it was, and so does the rest of the partitions,
+        # e.g. a reward whose transaction moved to another day
+        cursor.execute(f"""
+        DELETE FROM {redshift_table}
+        USING {staging_table} s
+        WHERE {redshift_table}.reward_id = s.reward_id;
+        """)
+        cursor.execute(f"DELETE FROM {redshift_table} WHERE {partition_filter(partitions)};")
+    elif update:
+        cursor.execute(f"""
+        DELETE FROM {redshift_table}
+        USING {staging_table} s
+        WHERE {redshift_table}.reward_id = s.reward_id
+        AND (s.updated_at > {redshift_table}.updated_at
+             OR ({redshift_table}.updated_at IS NULL AND s.updated_at IS NOT NULL));
+        """)
+    else:
+        rows_updated = 0
+    cursor.execute(f"""
+    INSERT INTO {redshift_table} ({columns})
+    SELECT {', '.join(f's.{column}' for column in column_names)}
+    FROM {staging_table} s
+    LEFT JOIN {redshift_table} r ON r.reward_id = s.reward_id
+    WHERE r.reward_id IS NULL;
+    """)
+    cursor.execute(f"DROP TABLE {staging_table};")
+
+    logger.info(f"Upserted into Redshift table: {rows_inserted} inserted, {rows_updated} updated")
+    return rows_inserted, rows_updated
+
+
+def drop_unpublished_partitions(cursor, redshift_table, published) -> int:
+    """Deletes the loaded rows of partitions the warehouse no longer has, which no delta will ever replace."""
+    dates = ', '.join(f"'{partition}'" for partition in published)
+    cursor.execute(f"DELETE FROM {redshift_table} WHERE "
+                   + (f"COALESCE(transaction_date, '{NULL_PARTITION}') NOT IN ({dates});" if dates else "TRUE;"))
+    return cursor.rowcount
 
 
 def lambda_handler(event, context):
-    # Initialize a Glue client
-    glue_client = boto3.client('glue', region_name=region_name)
+    reset_metrics()
 
-    # Retrieve the DDL from Glue
-    column_ddl = glue_schema_to_redshift_ddl(glue_client, glue_database, glue_table_name)
+    # The warehouse version the engines last published. Its manifest only exists once all its files do
+    with stage('read_manifest'):
+        manifest = read_warehouse_manifest(get_s3_client())
+    if manifest is None:
+        logger.info("Nothing published to the warehouse yet")
+        return {'statusCode': 200, 'body': 'Nothing to copy to Redshift yet!'}
 
     conn = None
+    rows_inserted = rows_updated = None
     try:
         conn = psycopg2.connect(
             dbname=redshift_dbname,
@@ -116,11 +656,52 @@ def lambda_handler(event, context):
             host=redshift_endpoint,
             port=redshift_port
         )
+        # Retrieve the columns from Glue, or from the last run while the container is warm
+        schema = SchemaManager(state=RedshiftStateStore(conn))
+        columns = schema.columns(glue_database, glue_table_name)
+        column_names = [col['Name'] for col in columns]
+        schema_changed = not schema.is_current(redshift_target_table, columns)
+
         with conn.cursor() as cursor:
-            create_spectrum_schema(cursor, iam_role, glue_database, glue_table_name)
-            create_redshift_table_from_spectrum(cursor, redshift_target_table, column_ddl)
-            copy_data_to_redshift(cursor, redshift_target_table, glue_table_name)
-        conn.commit()
+            with stage('ensure_schema') as current:
+                current.record(rows_out=len(schema.ensure(cursor, redshift_target_table, columns)))
+
+            # The partitions rewritten since the version last loaded, their size decides how they're loaded
+            with stage('list_delta') as current:
+                loaded = loaded_version(cursor, redshift_target_table)
+                delta = warehouse_delta(manifest, loaded)
+                files = [file for partition_files in delta.values() for file in partition_files]
+                delta_bytes = sum(file['size'] for file in files)
+                current.record(rows_out=len(files))
+            source = choose_load_source(delta_bytes) if files else 'spectrum'
+            logger.info(f"{len(delta)} partition(s), {delta_bytes:,} byte(s) written since version {loaded}, "
+                        f"loading version {manifest['version']} through {source}")
+
+            with stage(f'{load_mode}_data_to_redshift') as current:
+                copy_into = None
+                if source == 'copy':
+                    manifest_urls = put_load_manifests(get_s3_client(), warehouse_bucket, delta,
+                                                       f"{redshift_target_table}-{int(time.time())}")
+                    copy_into = partial(copy_from_parquet, manifest_urls=manifest_urls)
+
+                if not delta:
+                    rows_inserted = rows_updated = 0
+                elif load_mode == 'upsert' or copy_into is not None:
+                    rows_inserted, rows_updated = upsert_data_to_redshift(cursor, redshift_target_table,
+                                                                          glue_table_name, column_names,
+                                                                          sorted(delta), copy_into=copy_into,
+                                                                          update=load_mode == 'upsert')
+                    current.record(rows_out=rows_inserted + rows_updated)
+                else:
+                    rows_inserted = copy_data_to_redshift(cursor, redshift_target_table, glue_table_name,
+                                                          column_names)
+                    # Drivers that can't tell report -1
+                    current.record(rows_out=rows_inserted if rows_inserted >= 0 else None)
+                if load_mode == 'upsert':
+                    drop_unpublished_partitions(cursor, redshift_target_table, manifest['partitions'])
+                set_loaded_version(cursor, redshift_target_table, manifest['version'])
+            with stage('commit'):
+                conn.commit()
     except Exception as error:
         if conn:
             conn.rollback()
@@ -130,15 +711,43 @@ def lambda_handler(event, context):
             'statusCode': 500,
             'body': 'Error copying data to Redshift!'
         }
+
+    # The load has committed by now, so a failure past here leaves the data loaded and is reported as itself.
+    # Views are refreshed outside the load's transaction, refreshes can't run inside one
+    views_refreshed = True
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            if schema_changed:
+                with stage('align_table_keys') as current:
+                    current.record(rows_out=len(schema.align_keys(cursor, redshift_target_table, columns)))
+            with stage('refresh_summary_views'):
+                # They exist already if the schema they were created with hasn't changed
+                if schema_changed:
+                    create_summary_views(cursor, redshift_target_table)
+                refresh_summary_views(cursor)
+        # Only once the views are there, so a run after a failed one creates them again
+        schema.applied(redshift_target_table, columns)
+    except Exception as error:
+        logger.error(f"Data copied to Redshift, but refreshing the summary views failed: {error}")
+        views_refreshed = False
     finally:
-        if conn and not conn.closed:
-            conn.close()
+        conn.close()
 
-    logger.info("Data successfully copied to Redshift!")
-    return {
-        'statusCode': 200,
-        'body': 'Data successfully copied to Redshift!'
+    logger.info(f"Saved {schema.round_trips_saved} Glue/DDL round trip(s)")
+    logger.info(f"Stage report:\n{format_report()}")
+    result = {
+        'rows_inserted': rows_inserted,
+        'rows_updated': rows_updated,
+        'load_source': source,
+        'ddl_round_trips_saved': schema.round_trips_saved,
+        'views_refreshed': views_refreshed,
     }
+    if not views_refreshed:
+        return {'statusCode': 500, 'body': 'Data copied to Redshift, refreshing the summary views failed!', **result}
+
+    logger.info("Data successfully copied to Redshift!")
+    return {'statusCode': 200, 'body': 'Data successfully copied to Redshift!', **result}
 
 #
 # if not os.getenv('AWS_LAMBDA_FUNCTION_NAME'):
@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = os.getenv('METRICS_NAMESPACE', 'CashbackPipeline')
+# Set to false to keep the EMF lines off stdout, e.g. for local runs
+EMF = os.getenv('METRICS_EMF', 'true').lower() == 'true'
+
+# (metric, unit) in the order they're reported
+METRICS = [
+    ('Duration', 'Milliseconds'),
+    ('RowsIn', 'Count'),
+    ('RowsOut', 'Count'),
+    ('BytesWritten', 'Bytes'),
+    # ru_maxrss, the peak of the whole process up to the end of the stage, not of the stage alone. A warm
+    # lambda carries it over from earlier invocations too
+    ('ProcessPeakRSS', 'Megabytes'),
+]
+
+# Every stage run in this process, oldest first
+_stages = []
+
+
+class Stage(object):
+    """What a stage moved, filled in by the code inside the stage block."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_written = None
+
+    def record(self, rows_in=None, rows_out=None, bytes_written=None):
+        if rows_in is not None:
+            self.rows_in = rows_in
+        if rows_out is not None:
+            self.rows_out = rows_out
+        if bytes_written is not None:
+            self.bytes_written = (self.bytes_written or 0) + bytes_written
+        return self
+
+
+def _peak_rss_mb():
+    # ru_maxrss is the peak of the whole process so far, in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def emf(entry) -> str:
+    """The entry as a CloudWatch embedded metric format line, dimensioned by pipeline and stage."""
+    values = {metric: entry[metric] for metric, _ in METRICS if entry[metric] is not None}
+    return json.dumps({
+        '_aws': {
+            'Timestamp': int(entry['Timestamp'] * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Pipeline', 'Stage']],
+                'Metrics': [{'Name': metric, 'Unit': unit} for metric, unit in METRICS if metric in values],
+            }],
+        },
+        'Pipeline': entry['Pipeline'],
+        'Stage': entry['Stage'],
+        **values,
+    })
+
+
+@contextmanager
+def stage(name, pipeline=None, budget_ms=None):
+    """
+    Times the block as one pipeline stage. The yielded Stage takes the rows and bytes it moved, the entry
+    is printed as an EMF line, which CloudWatch turns into metrics when it's on its own on stdout, and
+    kept for report(). A stage that goes over budget_ms is logged as a warning.
+    """
+    current = Stage(name)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        entry = {
+            'Pipeline': pipeline or os.getenv('AWS_LAMBDA_FUNCTION_NAME') or os.path.basename(sys.argv[0]),
+            'Stage': name,
+            'Timestamp': time.time(),
+            'Duration': round((time.perf_counter() - start) * 1000, 1),
+            'RowsIn': current.rows_in,
+            'RowsOut': current.rows_out,
+            'BytesWritten': current.bytes_written,
+            'ProcessPeakRSS': round(_peak_rss_mb(), 1),
+        }
+        _stages.append(entry)
+        if EMF:
+            print(emf(entry), flush=True)
+
+        if budget_ms is not None and entry['Duration'] > budget_ms:
+            logger.warning(f"Stage {name} took {entry['Duration']:.0f} ms, over its {budget_ms:.0f} ms budget")
+
+
+def report() -> list:
+    return list(_stages)
+
+
+def reset() -> None:
+    # A warm lambda keeps the module, so each invocation clears the stages of the one before
+    _stages.clear()
+
+
+def format_report(stages=None) -> str:
+    stages = report() if stages is None else stages
+    total = sum(entry['Duration'] for entry in stages) or 1
+
+    def value(number, suffix=''):
+        return '-' if number is None else f'{number:,.0f}{suffix}'
+
+    lines = [f"{'stage':<36} {'ms':>10} {'share':>6} {'rows in':>10} {'rows out':>10} {'bytes':>12} {'process peak MB':>16}"]
+    for entry in stages:
+        lines.append(f"{entry['Stage']:<36} {entry['Duration']:>10,.1f} {entry['Duration'] / total:>6.0%} "
+                     f"{value(entry['RowsIn']):>10} {value(entry['RowsOut']):>10} "
+                     f"{value(entry['BytesWritten']):>12} {entry['ProcessPeakRSS']:>16,.0f}")
+    return '\n'.join(lines)
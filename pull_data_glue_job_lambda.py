@@ -1,15 +1,31 @@
 import json
 import os
 import logging
-from api import PlutusApi
-from common_shared_library import AWSConnector
-from io import StringIO
+import time
+from functools import partial
+
 import pandas as pd
-import boto3
 
-from dotenv import load_dotenv
+from accounts import AccountExtractor, load_accounts, plutus_api
+from api import PlutusApi
+from fingerprints import DELTA, NO_CHANGES, ChangeDetector, change_result
+from ingest import records_to_frame
+from metrics import stage, format_report, reset as reset_metrics
+from rewards import flatten_nested_fields, normalize_rewards
+from schema import TRANSACTION_FIELDS, REWARD_FIELDS, TRANSACTION_SCHEMA, REWARD_SCHEMA, compact
+from staging import get_storage, read_parquet_bytes, write_csv, write_parquet
+from state import StateStore
+from transform_spec import PANDAS_MAX_ROWS, choose_engine
+from warehouse import TOUCHED_PARTITIONS_KEY
+
+# Every run extracts, frames and stages records, so pandas, pyarrow and the modules doing that are loaded
+# with the module. boto3 is only imported by start_glue_job, which the state machine has taken over
+
+# The function's environment comes from its configuration, .env is only for running it locally
+if not os.getenv('AWS_LAMBDA_FUNCTION_NAME'):
+    from dotenv import load_dotenv
 
-load_dotenv('.env', verbose=True, override=True)
+    load_dotenv('.env', verbose=True, override=True)
 
 AUTH_SECRET = os.getenv('AUTH_SECRET')
 USER_ID = os.getenv('USER_ID')
@@ -17,41 +33,119 @@ PASS_ID = os.getenv('PASS_ID')
 CLIENT_ID = os.getenv('CLIENT_ID')
 AWS_ACCESS_KEY = os.getenv('AWS_ACCESS_KEY')
 AWS_SECRET_KEY = os.getenv('AWS_SECRET_KEY')
+INCREMENTAL = os.getenv('INCREMENTAL', 'false').lower() == 'true'
+# Staged rows up to which the transform runs on pandas in a lambda rather than in the Glue job
+TRANSFORM_PANDAS_MAX_ROWS = int(os.getenv('TRANSFORM_PANDAS_MAX_ROWS', PANDAS_MAX_ROWS))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-def to_s3(df, bucket_name, file_name):
-    # Connect to S3
-    aws_connector = AWSConnector()
-    s3 = aws_connector.connect_to_s3()
+# Staged rows are grouped by user so one account's can be read, or kept, without the others'
+PARTITION_BY = 'user_id'
+BUCKET_NAME = 'cashback-bucket'
+# Cached id_tokens, in the bucket so a cold start can skip the captcha login too
+TOKEN_STATE_KEY = 'state/plutus_tokens.json'
 
-    # Convert DataFrame to CSV
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=False)
+# Kept for as long as the container is warm
+_api = None
+_glue_client = None
 
-    # Upload the file
-    bucket = s3.Bucket(bucket_name)
-    bucket.put_object(Key=file_name, Body=csv_buffer.getvalue())
 
-    logger.info(f"Successfully uploaded {file_name} to S3")
+def get_api():
+    global _api
+    if _api is None:
+        _api = PlutusApi(USER_ID, PASS_ID, AUTH_SECRET, CLIENT_ID, token_store=bucket_state(TOKEN_STATE_KEY))
+    return _api
 
 
-def fetch_data(api: PlutusApi):
+def bucket_state(path=None) -> StateStore:
+    """StateStore kept in the bucket rather than under /tmp, so it outlives the container."""
+    return StateStore(path, storage=get_storage(BUCKET_NAME))
 
-    if os.getenv('USER_ID') and os.getenv('PASS_ID') and os.getenv('AUTH_SECRET') and os.getenv('CLIENT_ID'):
-        try:
-            transactions = api.get_transactions()
-            transactions_df = pd.read_json(json.dumps(transactions))
-            rewards = api.get_rewards()
-            rewards_df = pd.read_json(json.dumps(rewards))
-        except Exception as e:
-            logger.error(f"Error fetching data from Plutus API: {str(e)}")
-            transactions_df = pd.read_csv('transactions.csv')
-            rewards_df = pd.read_csv('rewards.csv')
-    else:
-        transactions_df = pd.read_csv('transactions.csv')
-        rewards_df = pd.read_csv('rewards.csv')
+
+def get_glue_client():
+    global _glue_client
+    if _glue_client is None:
+        import boto3
+
+        _glue_client = boto3.client('glue', aws_access_key_id=AWS_ACCESS_KEY,
+                                    aws_secret_access_key=AWS_SECRET_KEY)
+    return _glue_client
+
+
+def to_s3(df, bucket_name, file_name, schema=None, partition_by=None):
+    storage = get_storage(bucket_name)
+
+    with stage(f'to_s3 {file_name}') as current:
+        start = time.perf_counter()
+        # Serialized a chunk at a time straight into the upload, so neither the whole file nor a second
+        # copy of it is ever held
+        with storage.open_writer(file_name) as writer:
+            # Parquet is written against the declared schema so readers don't have to infer types
+            if file_name.endswith('.parquet'):
+                write_parquet(df, schema, writer, partition_by=partition_by)
+            else:
+                write_csv(df, writer, compress=file_name.endswith('.gz'))
+        size = writer.tell()
+        seconds = time.perf_counter() - start
+        current.record(rows_in=len(df), bytes_written=size)
+
+    logger.info(f"Successfully uploaded {file_name} ({size} bytes in {max(len(writer.parts), 1)} part(s), "
+                f"{size / 2 ** 20 / max(seconds, 1e-9):.1f} MiB/s) to S3")
+
+
+def read_staged(bucket_name, file_name, filters=None):
+    storage = get_storage(bucket_name)
+
+    try:
+        body = storage.get(file_name)
+    except Exception as e:
+        logger.warning(f"Could not read previously staged {file_name}: {str(e)}")
+        return None
+
+    return read_parquet_bytes(body, filters)
+
+
+def merge_delta(previous_df, delta_df, key):
+    if previous_df is None:
+        return delta_df
+
+    # Rows that changed since the last run replace their staged version
+    merged_df = pd.concat([previous_df, delta_df], ignore_index=True)
+    return merged_df.drop_duplicates(subset=key, keep='last').reset_index(drop=True)
+
+
+def watermark(df, column):
+    if df.empty or column not in df:
+        return None
+
+    return pd.to_datetime(df[column], utc=True, format='ISO8601').max().isoformat()
+
+
+def save_watermarks(state: StateStore, transactions_df, rewards_df) -> None:
+    state.set('transactions_watermark', watermark(transactions_df, 'date'))
+    state.set('rewards_watermark', watermark(rewards_df, 'updatedAt'))
+    logger.info(f"Saved watermarks transactions={state.get('transactions_watermark')} "
+                f"rewards={state.get('rewards_watermark')}")
+
+
+def save_account_watermarks(state: StateStore, extractor: AccountExtractor) -> None:
+    # Each account's from the records it returned. One that failed or had nothing new keeps its own, so
+    # its next delta starts where its last good one ended
+    for result in extractor.results:
+        if not result.ok:
+            continue
+        for key, df, column in (('transactions_watermark', result.transactions_df, 'date'),
+                                ('rewards_watermark', result.rewards_df, 'updatedAt')):
+            value = watermark(df, column)
+            if value is not None:
+                state.set(result.account.state_key(key), value)
+    logger.info(f"Saved the watermarks of {len(extractor.results) - len(extractor.failed)} account(s)")
+
+
+def read_sample_data():
+    transactions_df = pd.read_csv('transactions.csv')
+    rewards_df = pd.read_csv('rewards.csv')
 
     transactions_df.drop(columns=['is_debit', '__typename'], inplace=True)
     transactions_df.rename(columns={'id': 'transaction_id'}, inplace=True)
@@ -60,47 +154,176 @@ def fetch_data(api: PlutusApi):
     rewards_df.rename(columns={'amount': 'plu_amount', 'type': 'reward_type',
                                'id': 'reward_id'}, inplace=True)
 
-    return transactions_df, rewards_df
-
-
-def clear_data_warehouse() -> None:
-    aws_connector = AWSConnector()
-    s3 = aws_connector.connect_to_s3()
+    # Typed and held the same way as frames built from the API, the nested blobs are left for flattening
+    return compact(transactions_df, TRANSACTION_SCHEMA), compact(rewards_df, REWARD_SCHEMA)
+
+
+def fetch_data(api: PlutusApi = None, state: StateStore = None, bucket_name='cashback-bucket',
+               extractor: AccountExtractor = None, incremental=True):
+    previous_transactions_df = previous_rewards_df = None
+    transactions_since = rewards_since = None
+
+    if state and incremental:
+        previous_transactions_df = read_staged(bucket_name, 'staging/transactions.parquet')
+        previous_rewards_df = read_staged(bucket_name, 'staging/rewards.parquet')
+
+        # A delta is only safe to use when there is a staged history to merge it into
+        if previous_transactions_df is not None and previous_rewards_df is not None:
+            transactions_since = state.get('transactions_watermark')
+            rewards_since = state.get('rewards_watermark')
+            logger.info(f"Incremental extract from transactions={transactions_since} rewards={rewards_since}")
+
+    with stage('extract') as current:
+        if extractor is not None:
+            # Every account at once, each from its own watermarks once there's a staged history
+            history = previous_transactions_df is not None and previous_rewards_df is not None
+            transactions_df, rewards_df = extractor.extract(state if history else None)
+            if extractor.failed and not history:
+                # A full run replaces the staged files, so the accounts that failed keep what was staged for
+                # them rather than drop out of it. Only their users' row groups are read
+                failed_user_ids = extractor.failed_user_ids(state) if state else set()
+                if failed_user_ids:
+                    filters = [(PARTITION_BY, 'in', sorted(failed_user_ids))]
+                    previous_transactions_df = read_staged(bucket_name, 'staging/transactions.parquet', filters)
+                    previous_rewards_df = read_staged(bucket_name, 'staging/rewards.parquet', filters)
+                else:
+                    logger.warning("No staged user_ids are known for the accounts that failed, their rows "
+                                   "drop out of this run")
+        elif api is not None:
+            try:
+                # Built chunk by chunk from the records, is_debit/__typename are dropped and ids renamed on the way
+                transactions_df = records_to_frame(api.iter_transactions(since=transactions_since),
+                                                   TRANSACTION_FIELDS)
+                rewards = api.get_rewards(since=rewards_since)
+                # get_rewards hands back the failed response rather than raising
+                if isinstance(rewards, dict):
+                    raise RuntimeError(f"Fetching rewards failed with status {rewards.get('statusCode')}")
+                rewards_df = records_to_frame(rewards, REWARD_FIELDS)
+            except Exception as e:
+                # With credentials configured the sample CSVs would be staged over the real data, so the run
+                # fails instead and the staged files stay as they are
+                logger.error(f"Error fetching data from Plutus API: {str(e)}")
+                raise
+        else:
+            transactions_df, rewards_df = read_sample_data()
+        current.record(rows_out=len(transactions_df) + len(rewards_df))
+
+    logger.info(f"Fetched {len(transactions_df)} transaction(s) and {len(rewards_df)} reward(s)")
+
+    with stage('merge_delta') as current:
+        current.record(rows_in=len(transactions_df) + len(rewards_df))
+        transactions_df = merge_delta(previous_transactions_df, transactions_df, 'transaction_id')
+        rewards_df = merge_delta(previous_rewards_df, rewards_df, 'reward_id')
+        # Categoricals with different categories concatenate to plain strings, so they're encoded again
+        transactions_df = compact(transactions_df, TRANSACTION_SCHEMA)
+        rewards_df = compact(rewards_df, REWARD_SCHEMA)
+        current.record(rows_out=len(transactions_df) + len(rewards_df))
+
+    with stage('flatten_nested_fields') as current:
+        current.record(rows_in=len(rewards_df))
+        # The sample CSVs and stages written before the blobs were dropped still carry them in full
+        rewards_df = flatten_nested_fields(rewards_df)
+        current.record(rows_out=len(rewards_df))
+
+    with stage('normalize_rewards') as current:
+        current.record(rows_in=len(rewards_df))
+        # Runs on the merged set so a delta can back-fill from rewards staged in earlier runs
+        rewards_df = normalize_rewards(rewards_df)
+        current.record(rows_out=len(rewards_df))
 
-    BUCKET = 'cashback-bucket'
-    PREFIX = 'datawarehouse/'
+    return transactions_df, rewards_df
 
-    bucket = s3.Bucket(BUCKET)
 
-    logger.info(f"Deleting existing files in {BUCKET}/{PREFIX}")
-    for obj in bucket.objects.filter(Prefix=PREFIX):
-        obj.delete()
-    logger.info("Data warehouse cleared successfully!")
+def detect_changes(transactions_df, rewards_df, bucket_name='cashback-bucket', incremental=INCREMENTAL):
+    """
+    Compares what's about to be staged with what the last run staged. Returns the detector, whose
+    digests are saved once the frames are staged, and what the downstream steps have to do.
+    """
+    with stage('detect_changes') as current:
+        current.record(rows_in=len(transactions_df) + len(rewards_df))
+        detector = ChangeDetector(get_storage(bucket_name))
+        change_sets = [detector.diff('transactions', transactions_df), detector.diff('rewards', rewards_df)]
+        current.record(rows_out=sum(change_set.added for change_set in change_sets))
+
+    return detector, change_result(change_sets, incremental), change_sets
+
+
+def save_touched_partitions(detector, transactions_df, rewards_df, changes, bucket_name='cashback-bucket'):
+    """
+    Writes the partitions the incremental transform rewrites next to the staged files, found from the rows
+    the warehouse gets on both sides of the join. None outside of a delta, so the whole warehouse is.
+    """
+    with stage('touched_partitions') as current:
+        current.record(rows_in=len(rewards_df))
+        touched = detector.touched_partitions(transactions_df, rewards_df)
+        if changes != DELTA:
+            touched = None
+        get_storage(bucket_name).put(TOUCHED_PARTITIONS_KEY, json.dumps({'partitions': touched}))
+        detector.save('warehouse')
+        current.record(rows_out=len(touched) if touched is not None else None)
+    return touched
 
 
 def start_glue_job(glue_job_name):
 
-    glue_client = boto3.client('glue', aws_access_key_id=AWS_ACCESS_KEY,
-                               aws_secret_access_key=AWS_SECRET_KEY)
     try:
-        glue_client.start_job_run(JobName=glue_job_name)
+        get_glue_client().start_job_run(JobName=glue_job_name)
         logger.info(f"Glue job '{glue_job_name}' started successfully")
     except Exception as e:
         logger.error(f"Error starting Glue job {glue_job_name}: {str(e)}")
 
 
 def lambda_handler(event, context):
-    api = PlutusApi(USER_ID, PASS_ID, AUTH_SECRET, CLIENT_ID)
-    bucket_name = 'cashback-bucket'
-    transactions_df, rewards_df = fetch_data(api)
+    reset_metrics()
+
+    # Several accounts, from ACCOUNTS, are extracted side by side. Without credentials the shipped sample
+    # CSVs stand in for the API
+    accounts = load_accounts()
+    if os.getenv('ACCOUNTS'):
+        tokens = bucket_state(TOKEN_STATE_KEY)
+        extractor = AccountExtractor(accounts, api_factory=partial(plutus_api, token_store=tokens))
+    else:
+        extractor = None
+    api = get_api() if accounts and extractor is None else None
+    bucket_name = BUCKET_NAME
+    # In the bucket rather than under /tmp, so a cold start still extracts only since the watermarks
+    state = bucket_state()
+    transactions_df, rewards_df = fetch_data(api, state, bucket_name, extractor, incremental=INCREMENTAL)
+    failed_accounts = [result.account.name for result in extractor.failed] if extractor else []
+
+    # Nothing new or changed since the last run, so the staged files, the warehouse and Redshift are all
+    # current already. The state machine ends the run here
+    detector, changes, change_sets = detect_changes(transactions_df, rewards_df, bucket_name)
+    summary = {**{f'changed_{change_set.name}': change_set.added for change_set in change_sets},
+              'accounts': len(accounts), 'failed_accounts': failed_accounts}
+    if changes == NO_CHANGES:
+        logger.info("No records changed since the last run, nothing to stage")
+        logger.info(f"Stage report:\n{format_report()}")
+        return {
+            'statusCode': 200,
+            'body': 'No changes since the last run',
+            'changes': changes,
+            **summary
+        }
 
     # transactions_json = transactions_df.to_json(orient='records')[1:-1]
     # rewards_json = rewards_df.to_json(orient='records')[1:-1]
 
-    to_s3(transactions_df, bucket_name, 'staging/transactions.csv')
-    to_s3(rewards_df, bucket_name, 'staging/rewards.csv')
+    to_s3(transactions_df, bucket_name, 'staging/transactions.parquet', TRANSACTION_SCHEMA, PARTITION_BY)
+    to_s3(rewards_df, bucket_name, 'staging/rewards.parquet', REWARD_SCHEMA, PARTITION_BY)
 
-    clear_data_warehouse()
+    # Only move the watermarks and digests once the merged data is safely staged
+    if extractor:
+        save_account_watermarks(state, extractor)
+        extractor.save_user_ids(state)
+    else:
+        save_watermarks(state, transactions_df, rewards_df)
+    detector.save('transactions')
+    detector.save('rewards')
+    save_touched_partitions(detector, transactions_df, rewards_df, changes, bucket_name)
+
+    # A full run publishes a whole new version of the warehouse, which replaces the current one once it's
+    # complete, so nothing is cleared beforehand. See warehouse.WarehousePublisher
 
     # glue_job_name = 'Cashback project'  # Replace with your actual Glue job name
     # start_glue_job(glue_job_name)
@@ -117,11 +340,21 @@ def lambda_handler(event, context):
     # # rewards_json = rewards_json[1:-1]
     # s3.Object(bucket_name, 'staging/rewards.json').put(Body=rewards_json.encode('UTF-8'))
 
+    # The transform reads everything staged, so that's what decides where it runs. The state machine
+    # branches on engine
+    staged_rows = len(transactions_df) + len(rewards_df)
+    engine = choose_engine(staged_rows, TRANSFORM_PANDAS_MAX_ROWS)
+    logger.info(f"{staged_rows} row(s) staged, transforming on {engine}")
+    logger.info(f"Stage report:\n{format_report()}")
+
     return {
         'statusCode': 200,
-        'body': 'Data successfully uploaded to S3'
+        'body': 'Data successfully uploaded to S3',
+        'changes': changes,
+        'engine': engine,
+        **summary
     }
 
 
-if not os.getenv('AWS_LAMBDA_FUNCTION_NAME'):
+if __name__ == '__main__':
     print(lambda_handler(None, None))
@@ -0,0 +1,176 @@
+import ast
+import re
+
+import pandas as pd
+import pyarrow as pa
+
+from schema import REWARD_NESTED_FIELDS
+
+# A python repr scalar: quoted string, number, None or bool
+_VALUE = r"""(?:'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|[^,{}\[\]]+)"""
+
+
+def _parse(blob) -> dict:
+    try:
+        return ast.literal_eval(blob)
+    except (ValueError, SyntaxError):
+        return {}
+
+
+def _document_order(blob, paths, prefix=()):
+    # Wanted paths in the order their keys appear in the object
+    order = []
+    if not isinstance(blob, dict):
+        return order
+    for key, value in blob.items():
+        path = prefix + (key,)
+        if path in paths:
+            order.append(path)
+        elif isinstance(value, dict):
+            order += _document_order(value, paths, path)
+    return order
+
+
+def _ordered_pattern(order):
+    """
+    One regex that walks the repr to every path in order, so each blob is scanned once. Between two
+    fields only flat keys may be skipped, a nested object in the way fails the match and the row is
+    parsed in full instead. That keeps a match on the right path without tracking depth.
+    """
+    pattern = r"^\{"
+    current = ()
+    for group, path in enumerate(order):
+        common = 0
+        while common < min(len(current), len(path) - 1) and current[common] == path[common]:
+            common += 1
+        # Close out of the objects the previous field was in, then open the ones this field is in
+        pattern += r"[^{}]*?\}" * (len(current) - common)
+        pattern += ''.join(rf"[^{{}}]*?'{re.escape(key)}': \{{" for key in path[common:-1])
+        pattern += rf"[^{{}}]*?'{re.escape(path[-1])}': (?P<f{group}>{_VALUE})"
+        current = path[:-1]
+    return pattern
+
+
+def _literal(token):
+    token = token.strip()
+    if token[0] in '\'"':
+        return token[1:-1] if '\\' not in token else ast.literal_eval(token)
+    return None if token == 'None' else token
+
+
+def _walk(blob, path):
+    for key in path:
+        if not isinstance(blob, dict):
+            return None
+        blob = blob.get(key)
+    return blob
+
+
+def _typed(values: pd.Series, arrow_type) -> pd.Series:
+    if pa.types.is_floating(arrow_type):
+        return pd.to_numeric(values, errors='coerce').astype('float64')
+    return values.where(values.notna(), None)
+
+
+def extract_nested(blobs: pd.Series, paths: dict, sample_size=100) -> pd.DataFrame:
+    """
+    Pulls {column: (path, arrow type)} out of a column of nested objects into flat typed columns.
+    Objects that are still the python repr the staged CSVs held are matched with a single regex built
+    from the key order of a parsed sample, a full ast.literal_eval is only done for rows that don't match.
+    """
+    values = {column: pd.Series(None, index=blobs.index, dtype=object) for column in paths}
+
+    if pd.api.types.is_string_dtype(blobs.dtype) and not blobs.dtype == object:
+        is_dict = pd.Series(False, index=blobs.index)
+        is_repr = blobs.notna()
+    else:
+        is_dict = blobs.map(lambda blob: isinstance(blob, dict))
+        is_repr = blobs.map(lambda blob: isinstance(blob, str))
+
+    for column, (path, _) in paths.items():
+        if is_dict.any():
+            values[column][is_dict] = blobs[is_dict].map(lambda blob: _walk(blob, path))
+
+    reprs = blobs[is_repr].astype(object)
+    if len(reprs):
+        wanted = {path: column for column, (path, _) in paths.items()}
+
+        order = []
+        for blob in reprs.head(sample_size):
+            sample_order = _document_order(_parse(blob), wanted)
+            if len(sample_order) > len(order):
+                order = sample_order
+            if len(order) == len(wanted):
+                break
+
+        matched = pd.Series(False, index=reprs.index)
+        if order:
+            tokens = reprs.str.extract(_ordered_pattern(order), expand=True)
+            matched = tokens.notna().all(axis=1)
+            for group, path in enumerate(order):
+                column = tokens[f'f{group}'][matched]
+                values[wanted[path]][column.index] = column.map(_literal)
+
+        # Rows laid out differently, or missing some of the fields, are parsed in full
+        leaves = [f"'{path[-1]}'" for path in wanted]
+        for index, blob in reprs[~matched].items():
+            if any(leaf in blob for leaf in leaves):
+                parsed = _parse(blob)
+                for path, column in wanted.items():
+                    values[column][index] = _walk(parsed, path)
+
+    return pd.DataFrame({column: _typed(values[column], arrow_type) for column, (_, arrow_type) in paths.items()},
+                        index=blobs.index)
+
+
+def flatten_nested_fields(rewards_df: pd.DataFrame, fields=REWARD_NESTED_FIELDS) -> pd.DataFrame:
+    """
+    Replaces the contis_transaction/fiat_transaction blobs with the flat columns declared in schema.py.
+    Rows that already have the flat columns, e.g. straight from the API, keep them.
+    """
+    for blob in {source[0] for source, _, _ in fields}:
+        if blob not in rewards_df:
+            continue
+
+        paths = {column: (source[1:], arrow_type) for source, column, arrow_type in fields if source[0] == blob}
+        extracted = extract_nested(rewards_df[blob], paths)
+
+        for column in paths:
+            rewards_df[column] = rewards_df[column].fillna(extracted[column]) if column in rewards_df \
+                else extracted[column]
+
+        rewards_df = rewards_df.drop(columns=blob)
+
+    return rewards_df
+
+
+def normalize_rewards(rewards_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    The back-fill that used to live commented out in PlutusApi.get_rewards, on the flat nested columns. Every
+    reward is kept: card details fill in for missing contis ones, and rewards still without a transaction
+    amount take the description and currency of the first of the user's rewards paid at the same exchange
+    rate that has one.
+    """
+    rewards_df = rewards_df.copy()
+
+    rewards_df['contis_description'] = rewards_df['contis_description'].fillna(rewards_df['card_description'])
+    # TransactionAmount is in pounds, contis amounts are in pence
+    rewards_df['contis_transaction_amount'] = rewards_df['contis_transaction_amount'].fillna(
+        rewards_df['card_transaction_amount'].mul(100))
+
+    nas = rewards_df['contis_transaction_amount'].isna() & (rewards_df['reward_type'] != 'REBATE_BONUS')
+
+    # First reward with an amount per exchange_rate_id, in frame order, built once and looked up by hash
+    # instead of scanning the frame for every missing row. Rates are shared between users, so with several
+    # accounts in the frame a reward only takes details from the same user's
+    keys = ['user_id', 'exchange_rate_id']
+    rebates = rewards_df[rewards_df['contis_transaction_amount'].notna() & rewards_df['exchange_rate_id'].notna()]
+    rebates = rebates.drop_duplicates(subset=keys, keep='first')[keys + ['contis_description', 'contis_currency']]
+
+    filled = rewards_df.loc[nas, keys].merge(rebates, on=keys, how='left').set_axis(rewards_df.index[nas])
+    # Maybe keep as na because perk transaction includes total cost?
+    rewards_df.loc[nas, 'contis_transaction_amount'] = rewards_df.loc[nas, 'fiat_amount_rewarded']
+    rewards_df.loc[nas, 'contis_description'] = filled['contis_description']
+    rewards_df.loc[nas, 'contis_currency'] = filled['contis_currency']
+
+    return rewards_df
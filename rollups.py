@@ -0,0 +1,181 @@
+import logging
+from io import BytesIO
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from warehouse import NULL_PARTITION, PARTITION_COLUMN
+
+logger = logging.getLogger(__name__)
+
+# Rewards turned down don't count towards what was collected
+REJECTED = 'Rejected by admin'
+
+# Key of each warehouse row at every grain the rollups are kept at
+GRAINS = {
+    'month': lambda df: df['created_at'].dt.strftime('%Y-%m'),
+    'day': lambda df: df['created_at'].dt.strftime('%Y-%m-%d'),
+    'merchant': lambda df: df['description'],
+}
+
+# Warehouse columns the rollups are built from
+COLUMNS = ['created_at', 'description', 'reason', 'plu_amount', 'plu_price', PARTITION_COLUMN]
+
+# Partial aggregates, each one merges with the same aggregate of another set of rows
+STATES = {
+    'rewards': 'sum',
+    'plu_amount_sum': 'sum',
+    'plu_price_sum': 'sum',
+    'plu_price_count': 'sum',
+    'plu_price_min': 'min',
+    'plu_price_max': 'max',
+}
+
+
+def partial_states(df: pd.DataFrame, grains=GRAINS) -> pd.DataFrame:
+    """
+    Mergeable states of the rewards in df that weren't rejected, per transaction_date partition, grain and key.
+    A partition's states only depend on its own rows, so a rewritten partition can replace them whole.
+    """
+    df = df[df['reason'] != REJECTED]
+    if not pd.api.types.is_datetime64_any_dtype(df['created_at']):
+        df = df.assign(created_at=pd.to_datetime(df['created_at'], utc=True, format='ISO8601'))
+
+    values = pd.DataFrame({
+        'partition': df[PARTITION_COLUMN].fillna(NULL_PARTITION) if PARTITION_COLUMN in df else NULL_PARTITION,
+        'plu_amount': pd.to_numeric(df['plu_amount'], errors='coerce').astype('float64'),
+        'plu_price': pd.to_numeric(df['plu_price'], errors='coerce').astype('float64'),
+    }, index=df.index)
+
+    states = []
+    for grain in grains:
+        grouped = values.assign(grain=grain, key=GRAINS[grain](df)).groupby(['partition', 'grain', 'key'],
+                                                                           dropna=False, sort=False)
+        states.append(grouped.agg(rewards=('plu_amount', 'size'), plu_amount_sum=('plu_amount', 'sum'),
+                                  plu_price_sum=('plu_price', 'sum'), plu_price_count=('plu_price', 'count'),
+                                  plu_price_min=('plu_price', 'min'), plu_price_max=('plu_price', 'max'))
+                      .reset_index())
+
+    return pd.concat(states, ignore_index=True) if states else pd.DataFrame(
+        columns=['partition', 'grain', 'key'] + list(STATES))
+
+
+def merge_states(states: pd.DataFrame, grain) -> pd.DataFrame:
+    """The partial states of one grain merged per key, with the plu_price mean they give."""
+    merged = states[states['grain'] == grain].groupby('key', dropna=False).agg(STATES)
+    merged['plu_price_mean'] = merged['plu_price_sum'] / merged['plu_price_count'].where(
+        merged['plu_price_count'] > 0)
+    return merged
+
+
+def _merge_grains(states: pd.DataFrame) -> pd.DataFrame:
+    return pd.concat([merge_states(states, grain).reset_index().assign(grain=grain) for grain in GRAINS],
+                     ignore_index=True)
+
+
+class RollupStore(object):
+    """
+    Per month, day and merchant aggregates of the warehouse. The partial states are kept per partition in
+    one parquet file, stamped with the warehouse version they reflect, so a run only has to fold in the
+    partitions it rewrote. They're merged per grain and key into a second, much smaller file that queries
+    read, so a query never touches the states or the warehouse rows.
+    """
+
+    def __init__(self, storage, prefix='rollups'):
+        self.storage = storage
+        self.prefix = prefix
+        # What's been read, kept for as long as the store is
+        self._states = None
+        self._version = None
+        self._merged = None
+
+    @property
+    def states_key(self):
+        return f'{self.prefix}/states.parquet'
+
+    @property
+    def merged_key(self):
+        return f'{self.prefix}/merged.parquet'
+
+    def _read(self, key):
+        if key not in self.storage.keys(key):
+            return None, None
+        table = pq.read_table(BytesIO(self.storage.get(key)))
+        return table.to_pandas(), (table.schema.metadata or {}).get(b'version', b'').decode() or None
+
+    def _write(self, key, df: pd.DataFrame, version) -> None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'version': version.encode()})
+        buffer = BytesIO()
+        pq.write_table(table, buffer, compression='snappy')
+        self.storage.put(key, buffer.getvalue())
+
+    def _load(self):
+        if self._states is None:
+            self._states, self._version = self._read(self.states_key)
+            if self._states is None:
+                self._states = partial_states(pd.DataFrame(columns=COLUMNS))
+
+    def version(self):
+        self._load()
+        return self._version
+
+    def states(self) -> pd.DataFrame:
+        self._load()
+        return self._states
+
+    def _save(self, states: pd.DataFrame, version) -> None:
+        merged = _merge_grains(states)
+        self._write(self.states_key, states, version)
+        self._write(self.merged_key, merged, version)
+
+        self._states, self._version, self._merged = states, version, merged
+        logger.info(f"Rollups at version {version}, {len(states)} partial state(s) merged to {len(merged)}")
+
+    def rebuild(self, df: pd.DataFrame, version) -> pd.DataFrame:
+        """Replaces every state with the ones of df, the whole warehouse at version."""
+        states = partial_states(df)
+        self._save(states, version)
+        return states
+
+    def update(self, df: pd.DataFrame, version, touched=()) -> pd.DataFrame:
+        """
+        Replaces the states of the partitions df holds, the ones a run at version rewrote, and drops those
+        of the touched partitions it no longer has any rows for.
+        """
+        states = partial_states(df)
+        replaced = set(states['partition'].unique()) | set(touched)
+        kept = self.states()[~self.states()['partition'].isin(replaced)]
+        states = pd.concat([kept, states], ignore_index=True) if len(kept) else states
+        self._save(states, version)
+        return states
+
+    def query(self, grain) -> pd.DataFrame:
+        """rewards, plu_amount_sum and the plu_price mean/min/max per key of grain, e.g. per month."""
+        if self._merged is None:
+            self._merged, _ = self._read(self.merged_key)
+            if self._merged is None:
+                self._merged = _merge_grains(self.states())
+        return self._merged[self._merged['grain'] == grain].drop(columns='grain').set_index('key')
+
+
+def update_rollups(store: RollupStore, publisher, df: pd.DataFrame, manifest, previous=None,
+                   touched=()) -> pd.DataFrame:
+    """
+    Brings the rollups up to the published manifest. df is what was published, the whole warehouse
+    unless previous, the manifest it was published on top of, is given, with touched the partitions
+    it rewrote.
+    """
+    if store.version() == manifest['version']:
+        return store.states()
+
+    if previous is not None and store.version() == previous['version']:
+        return store.update(df, manifest['version'], touched)
+
+    if previous is not None:
+        # Never built, or a run was missed, so the rows published this time aren't enough
+        logger.warning(f"Rollups are at version {store.version()}, not {previous['version']}, "
+                       f"rebuilding from the whole warehouse")
+        df = publisher.read(manifest, columns=COLUMNS)
+    return store.rebuild(df, manifest['version'])
@@ -0,0 +1,252 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Staged columns as (field in the API response, staged column name, type).
+# A tuple field is a path into a nested object in the response.
+# Fields that aren't listed, e.g. is_debit and __typename, are dropped on ingestion.
+
+TIMESTAMP = pa.timestamp('us', tz='UTC')
+
+TRANSACTION_FIELDS = [
+    ('id', 'transaction_id', pa.string()),
+    ('model', 'model', pa.string()),
+    ('user_id', 'user_id', pa.string()),
+    ('currency', 'currency', pa.string()),
+    ('amount', 'amount', pa.int64()),
+    ('date', 'date', TIMESTAMP),
+    ('type', 'type', pa.string()),
+    ('description', 'description', pa.string()),
+]
+
+REWARD_FIELDS = [
+    ('id', 'reward_id', pa.string()),
+    ('user_id', 'user_id', pa.string()),
+    ('amount', 'plu_amount', pa.float64()),
+    ('rebate_rate', 'rebate_rate', pa.float64()),
+    ('type', 'reward_type', pa.string()),
+    ('reference_type', 'reference_type', pa.string()),
+    ('reference_id', 'reference_id', pa.string()),
+    ('available', 'available', pa.bool_()),
+    ('reason', 'reason', pa.string()),
+    ('base_rate', 'base_rate', pa.float64()),
+    ('staking_rate', 'staking_rate', pa.float64()),
+    ('subscription_plan', 'subscription_plan', pa.string()),
+    ('exchange_rate_id', 'exchange_rate_id', pa.string()),
+    ('fiat_amount_rewarded', 'fiat_amount_rewarded', pa.float64()),
+    ('approved_by', 'approved_by', pa.string()),
+    ('createdAt', 'createdAt', TIMESTAMP),
+    ('updatedAt', 'updatedAt', TIMESTAMP),
+]
+
+# The few fields used out of the nested contis_transaction/fiat_transaction objects, the objects
+# themselves are several KB per reward and aren't staged
+REWARD_NESTED_FIELDS = [
+    (('contis_transaction', 'transaction_amount'), 'contis_transaction_amount', pa.float64()),
+    (('contis_transaction', 'description'), 'contis_description', pa.string()),
+    (('contis_transaction', 'currency'), 'contis_currency', pa.string()),
+    (('fiat_transaction', 'card_transactions', 'description'), 'card_description', pa.string()),
+    (('fiat_transaction', 'card_transactions', 'api_response', 'TransactionAmount'), 'card_transaction_amount',
+     pa.float64()),
+    (('fiat_transaction', 'card_transactions', 'api_response', 'TransactionCurrency'), 'card_currency',
+     pa.string()),
+    (('fiat_transaction', 'card_transactions', 'api_response', 'MerchantDetails', 'merchantName'), 'merchant_name',
+     pa.string()),
+]
+
+REWARD_FIELDS += REWARD_NESTED_FIELDS
+
+
+def to_arrow_schema(fields) -> pa.Schema:
+    return pa.schema([(name, arrow_type) for _, name, arrow_type in fields])
+
+
+TRANSACTION_SCHEMA = to_arrow_schema(TRANSACTION_FIELDS)
+REWARD_SCHEMA = to_arrow_schema(REWARD_FIELDS)
+
+
+# How the frames are held in memory, on top of the staged types above. UUIDs are their 16 bytes instead of
+# a 36 character string, low cardinality strings are categoricals and money is int64 minor units. The
+# staged parquet keeps the plain types, so Glue and Spectrum read it as before.
+UUID = pa.binary(16)
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+MINOR_UNITS = pa.int64()
+
+COMPACT_TYPES = {
+    'transaction_id': UUID,
+    'reward_id': UUID,
+    'user_id': UUID,
+    'reference_id': UUID,
+    'exchange_rate_id': UUID,
+    'model': CATEGORY,
+    'type': CATEGORY,
+    'currency': CATEGORY,
+    'reward_type': CATEGORY,
+    'reference_type': CATEGORY,
+    'reason': CATEGORY,
+    'subscription_plan': CATEGORY,
+    # Pence, sent as a float
+    'fiat_amount_rewarded': MINOR_UNITS,
+}
+
+_UUID_LENGTH = 36
+_DASHES = [8, 13, 18, 23]
+_HEX_POSITIONS = [position for position in range(_UUID_LENGTH) if position not in _DASHES]
+_PLACEHOLDER = '00000000-0000-0000-0000-000000000000'
+
+# Value of each lower case hex digit, 255 for anything else. Upper case isn't taken so that every UUID
+# that's parsed turns back into the exact string it came from
+_NIBBLES = np.full(256, 255, dtype=np.uint8)
+for _digit, _value in zip(b'0123456789abcdef', range(16)):
+    _NIBBLES[_digit] = _value
+_HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+
+def uuid_bytes(array: pa.Array):
+    """
+    The UUID strings in a string array as a binary(16) array, with a numpy mask of the values that were
+    UUIDs. The rest are null in the result.
+    """
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    array = array.cast(pa.string())
+
+    shaped = pc.fill_null(pc.equal(pc.binary_length(array), _UUID_LENGTH), False)
+    if not pc.all(shaped).as_py():
+        array = pc.if_else(shaped, array, _PLACEHOLDER)
+
+    # Every value is now 36 bytes, so the string data is one (n, 36) block
+    start = np.frombuffer(array.buffers()[1], dtype=np.int32)[array.offset]
+    text = np.frombuffer(array.buffers()[2], dtype=np.uint8)[start:start + _UUID_LENGTH * len(array)] \
+        .reshape(-1, _UUID_LENGTH)
+    nibbles = _NIBBLES[text[:, _HEX_POSITIONS]]
+
+    valid = shaped.to_numpy(zero_copy_only=False) & (text[:, _DASHES] == ord('-')).all(axis=1) & \
+        (nibbles.max(axis=1) != 255)
+    nibbles[~valid] = 0
+
+    packed = np.ascontiguousarray((nibbles[:, 0::2] << 4) | nibbles[:, 1::2])
+    validity = None if valid.all() else pa.py_buffer(np.packbits(valid, bitorder='little'))
+    return pa.FixedSizeBinaryArray.from_buffers(UUID, len(packed), [validity, pa.py_buffer(packed)]), valid
+
+
+def uuid_strings(array: pa.Array) -> pa.Array:
+    """binary(16) UUIDs back as their 36 character strings."""
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+
+    data = np.frombuffer(array.buffers()[1], dtype=np.uint8)[16 * array.offset:16 * (array.offset + len(array))]
+    data = data.reshape(-1, 16)
+
+    text = np.full((len(array), _UUID_LENGTH), ord('-'), dtype=np.uint8)
+    text[:, _HEX_POSITIONS[0::2]] = _HEX_DIGITS[data >> 4]
+    text[:, _HEX_POSITIONS[1::2]] = _HEX_DIGITS[data & 15]
+
+    offsets = np.arange(0, _UUID_LENGTH * (len(array) + 1), _UUID_LENGTH, dtype=np.int32)
+    strings = pa.StringArray.from_buffers(len(array), pa.py_buffer(offsets), pa.py_buffer(text))
+    return pc.if_else(array.is_valid(), strings, pa.scalar(None, pa.string())) if array.null_count else strings
+
+
+def compact_array(array: pa.Array, compact_type) -> pa.Array:
+    """
+    array held as compact_type, or unchanged if it doesn't fit, e.g. ids that aren't all UUIDs or
+    amounts with a fraction of a penny.
+    """
+    if compact_type is None or array.type == compact_type:
+        return array
+
+    if compact_type == UUID and pa.types.is_string(array.type):
+        uuids, valid = uuid_bytes(array)
+        return uuids if uuids.null_count == array.null_count else array
+
+    if compact_type == CATEGORY and pa.types.is_string(array.type):
+        return pc.dictionary_encode(array).cast(CATEGORY)
+
+    if compact_type == MINOR_UNITS and (pa.types.is_floating(array.type) or pa.types.is_integer(array.type)):
+        try:
+            # A safe cast fails on anything that isn't a whole number
+            return array.cast(MINOR_UNITS)
+        except pa.ArrowInvalid:
+            return array
+
+    return array
+
+
+def _uuid_dtype(arrow_type):
+    return pd.ArrowDtype(UUID) if arrow_type == UUID else None
+
+
+def _to_series(array: pa.Array, compact_type, index=None) -> pd.Series:
+    series = pd.Series(array.to_pandas(types_mapper=_uuid_dtype), index=index)
+    if compact_type == MINOR_UNITS and array.type == MINOR_UNITS:
+        # Nullable, so a missing amount doesn't turn the column into float64
+        series = series.astype(pd.Int64Dtype())
+    return series
+
+
+def _is_compact(series: pd.Series, compact_type) -> bool:
+    if compact_type == UUID:
+        return series.dtype == pd.ArrowDtype(UUID)
+    if compact_type == CATEGORY:
+        return isinstance(series.dtype, pd.CategoricalDtype)
+    return compact_type == MINOR_UNITS and series.dtype == pd.Int64Dtype()
+
+
+def to_frame(table: pa.Table, types=COMPACT_TYPES) -> pd.DataFrame:
+    """The table as a frame, with the columns types names held the way it says."""
+    minor_units = []
+    for position, name in enumerate(table.column_names):
+        if name in types:
+            array = compact_array(table.column(name).combine_chunks(), types[name])
+            table = table.set_column(position, name, array)
+            if array.type == MINOR_UNITS:
+                minor_units.append(name)
+
+    # self_destruct frees each Arrow column as soon as it's converted, so the two copies don't coexist
+    df = table.to_pandas(self_destruct=True, split_blocks=True, types_mapper=_uuid_dtype)
+    for name in minor_units:
+        df[name] = df[name].astype(pd.Int64Dtype())
+    return df
+
+
+def to_arrow(series: pd.Series, arrow_type) -> pa.Array:
+    """series, compact or not, as an array of the staged arrow_type."""
+    try:
+        array = pa.array(series, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed columns, e.g. timestamps from the API merged with strings from an older CSV stage
+        array = pa.array([None if pd.isna(value) else str(value) for value in series], type=pa.string())
+
+    if array.type == UUID and pa.types.is_string(arrow_type):
+        return uuid_strings(array)
+    return array if array.type == arrow_type else array.cast(arrow_type)
+
+
+def compact(df: pd.DataFrame, schema: pa.Schema, types=COMPACT_TYPES) -> pd.DataFrame:
+    """
+    df with the columns that are in schema cast to their staged type and held the way types says.
+    Columns that already are, and columns the schema doesn't have, are left as they are.
+    """
+    df = df.copy(deep=False)
+    for field in schema:
+        if field.name not in df or _is_compact(df[field.name], types.get(field.name)):
+            continue
+
+        array = compact_array(to_arrow(df[field.name], field.type), types.get(field.name))
+        df[field.name] = _to_series(array, types.get(field.name), df.index)
+    return df
+
+
+def expand(df: pd.DataFrame) -> pd.DataFrame:
+    """df with its compact columns back as plain strings and float64 amounts."""
+    df = df.copy(deep=False)
+    for column in df.columns:
+        dtype = df[column].dtype
+        if dtype == pd.ArrowDtype(UUID):
+            df[column] = pd.Series(uuid_strings(pa.array(df[column])).to_pandas(), index=df.index)
+        elif isinstance(dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(str).where(df[column].notna())
+        elif dtype == pd.Int64Dtype() and COMPACT_TYPES.get(column) == MINOR_UNITS:
+            df[column] = df[column].astype('float64')
+    return df
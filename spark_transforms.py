@@ -0,0 +1,91 @@
+# The Spark executor of transform_spec.TransformSpec, run by glue_job/glue_script.py. transforms.py is the
+# pandas one. pyspark is only imported when called, the Glue job is the only place it's installed
+
+
+def column(expression):
+    """A transform_spec expression as a Spark column."""
+    from pyspark.sql import functions as F
+
+    op, *args = expression
+    if op == 'col':
+        return F.col(args[0])
+    if op == 'lit':
+        return F.lit(args[0])
+
+    values = [column(arg) for arg in args]
+    if op == 'abs':
+        return F.abs(values[0])
+    if op == 'mul':
+        return values[0] * values[1]
+    if op == 'div':
+        # Null on a division by zero, with ANSI mode off as it is on Glue
+        return values[0] / values[1]
+    if op == 'eq':
+        return values[0] == values[1]
+    if op == 'when':
+        return F.when(values[0], values[1]).otherwise(values[2])
+    if op == 'to_timestamp':
+        return values[0].cast('timestamp')
+    if op == 'date_string':
+        return F.date_format(values[0].cast('timestamp'), 'yyyy-MM-dd')
+    raise ValueError(f'Unknown expression {op}')
+
+
+def join(rewards_df, transactions_df, spec):
+    """
+    Every reward with its transaction. No join strategy is forced: Spark broadcasts the projected transactions
+    when they're under spark.sql.autoBroadcastJoinThreshold, and otherwise shuffles both sides rather than
+    ship the bigger one to every executor. A left join can only build its hash table on the right side.
+    """
+    rewards_df = rewards_df.select(*spec.rewards)
+    transactions_df = transactions_df.select(*spec.transactions)
+    left_on, right_on = spec.join
+    return rewards_df.join(transactions_df, rewards_df[left_on] == transactions_df[right_on], 'left')
+
+
+def rename_columns(df, spec):
+    for old, new in spec.renames.items():
+        df = df.withColumnRenamed(old, new)
+    return df
+
+
+def derive_columns(df, spec):
+    for name, expression in spec.derived:
+        df = df.withColumn(name, column(expression))
+    return df
+
+
+def cast_columns(df, spec):
+    from pyspark.sql.functions import col
+
+    return df.select(*[col(name).cast(data_type).alias(name) for name, data_type in spec.casts.items()])
+
+
+def touched_partitions(df, partitions, partition_by):
+    """warehouse.touched_partitions on Spark: the rows of the partitions the pull found touched."""
+    from pyspark.sql.functions import coalesce, col, lit
+    from warehouse import NULL_PARTITION
+
+    return df.filter(coalesce(col(partition_by), lit(NULL_PARTITION)).isin(list(partitions)))
+
+
+def publish(df, publisher, partition_by, incremental=False, touched=()) -> dict:
+    """
+    warehouse.WarehousePublisher.publish for a Spark frame: df is written under a new version of the
+    warehouse, partitioned the same way, and the manifest pointed at it once every file is there.
+    """
+    from pyspark.sql.functions import max as spark_max
+    from staging import storage_path
+
+    current = publisher.current() if incremental else None
+    if current and not touched and df.isEmpty():
+        return current
+
+    version = publisher.new_version()
+    df.write.partitionBy(partition_by).parquet(
+        storage_path(publisher.storage.bucket_name, publisher.version_prefix(version)))
+
+    # Spark's type names are the ones Glue uses
+    columns = [{'Name': name, 'Type': data_type} for name, data_type in df.dtypes if name != partition_by]
+    max_updated_at = df.agg(spark_max('updated_at')).first()[0]
+    return publisher.commit(version, publisher.written_files(version), columns, max_updated_at, current, touched)
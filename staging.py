@@ -0,0 +1,364 @@
+import gzip
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from schema import to_arrow, to_frame
+
+logger = logging.getLogger(__name__)
+
+
+# One S3 resource per container, reused by every storage and invocation while it stays warm
+_s3 = None
+
+# S3 takes parts of at least 5 MiB, apart from the last, and up to 10,000 of them
+MIN_PART_SIZE = 5 * 2 ** 20
+MAX_PARTS = 10_000
+PART_SIZE = int(os.getenv('UPLOAD_PART_SIZE', str(8 * 2 ** 20)))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '4'))
+# Codec the staged parquet files are written with
+STAGING_COMPRESSION = os.getenv('STAGING_COMPRESSION', 'snappy')
+
+
+def _s3_resource():
+    global _s3
+    if _s3 is None:
+        # Imported here so the glue scripts can use the rest of this module without the shared library
+        from common_shared_library import AWSConnector
+
+        _s3 = AWSConnector().connect_to_s3()
+    return _s3
+
+
+class MultipartWriter(object):
+    """
+    A write-only file that uploads to S3 a part at a time as it fills. Up to max_workers parts upload in
+    parallel while the next one fills, and a part waits for a free worker before it's handed over, so
+    memory stays around (max_workers + 1) * part_size however big the object gets. An object smaller
+    than one part goes up in a single put_object. Closing completes the upload, a failure aborts it so
+    no parts are left behind.
+    """
+
+    def __init__(self, client, bucket_name, key, part_size=PART_SIZE, max_workers=UPLOAD_WORKERS):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.max_workers = max_workers
+        self.buffer = bytearray()
+        self.size = 0
+        self.upload_id = None
+        self.parts = []
+        self.closed = False
+        self._executor = None
+        self._slots = threading.Semaphore(max_workers)
+        self._failed = None
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self) -> None:
+        pass
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError(f"Write to closed upload of {self.key}")
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.part_size:
+            with memoryview(self.buffer) as view:
+                part = bytes(view[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def _send(self, number, body):
+        try:
+            response = self.client.upload_part(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+                                               PartNumber=number, Body=body)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+        except Exception as e:
+            self._failed = e
+            raise
+        finally:
+            self._slots.release()
+
+    def _upload_part(self, body) -> None:
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key)['UploadId']
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        if len(self.parts) == MAX_PARTS:
+            raise ValueError(f"{self.key} needs more than {MAX_PARTS} parts, raise UPLOAD_PART_SIZE")
+        # Stop at the first part that failed rather than sending the rest of the object
+        if self._failed is not None:
+            raise self._failed
+
+        # Blocks while every worker is busy, which is what bounds the memory held by pending parts
+        self._slots.acquire()
+        self.parts.append(self._executor.submit(self._send, len(self.parts) + 1, body))
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket_name, Key=self.key, Body=bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self._upload_part(bytes(self.buffer))
+                parts = [part.result() for part in self.parts]
+                self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                                      UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.buffer = bytearray()
+            self.closed = True
+            if self._executor is not None:
+                self._executor.shutdown()
+
+    def abort(self) -> None:
+        if self.upload_id is not None:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+            logger.warning(f"Aborted the upload of {self.key} after {len(self.parts)} part(s)")
+            self.upload_id = None
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class LocalWriter(object):
+    """What MultipartWriter is to S3 for LocalStorage, the file only appears under its key once closed."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(f"{path}.tmp", 'wb')
+        self.size = 0
+        self.parts = []
+
+    @property
+    def closed(self) -> bool:
+        return self.file.closed
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        return self.file.write(data)
+
+    def close(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+            os.replace(f"{self.path}.tmp", self.path)
+
+    def abort(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+            os.remove(f"{self.path}.tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class S3Storage(object):
+    def __init__(self, bucket_name, resource=None):
+        # The Glue job passes its own boto3 resource, it doesn't have the shared library
+        self.bucket_name = bucket_name
+        self.bucket = (resource or _s3_resource()).Bucket(bucket_name)
+
+    def put(self, key, body) -> None:
+        self.bucket.put_object(Key=key, Body=body)
+
+    def get(self, key) -> bytes:
+        return self.bucket.Object(key).get()['Body'].read()
+
+    def open_writer(self, key, **kwargs) -> MultipartWriter:
+        return MultipartWriter(self.bucket.meta.client, self.bucket_name, key, **kwargs)
+
+    def keys(self, prefix) -> list:
+        return [obj.key for obj in self.bucket.objects.filter(Prefix=prefix)]
+
+    def sizes(self, prefix) -> dict:
+        return {obj.key: obj.size for obj in self.bucket.objects.filter(Prefix=prefix)}
+
+    def delete_batch(self, keys) -> list:
+        # One request for up to 1000 keys, returns the keys S3 couldn't delete
+        response = self.bucket.delete_objects(Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+        return [error['Key'] for error in response.get('Errors', [])]
+
+
+class LocalStorage(object):
+    """Stands in for S3 when running offline, keys are laid out as files under <root>/<bucket>/."""
+
+    def __init__(self, root, bucket_name):
+        self.bucket_name = bucket_name
+        self.root = os.path.join(root, bucket_name)
+
+    def path(self, key) -> str:
+        return os.path.join(self.root, key)
+
+    def put(self, key, body) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body.encode() if isinstance(body, str) else body)
+
+    def get(self, key) -> bytes:
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def open_writer(self, key, **kwargs) -> LocalWriter:
+        return LocalWriter(self.path(key))
+
+    def keys(self, prefix) -> list:
+        keys = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def sizes(self, prefix) -> dict:
+        return {key: os.path.getsize(self.path(key)) for key in self.keys(prefix)}
+
+    def delete_batch(self, keys) -> list:
+        failed = []
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                failed.append(key)
+                continue
+            # S3 has no directories, so don't leave empty ones behind either
+            directory = os.path.dirname(self.path(key))
+            while directory != self.root and not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+        return failed
+
+
+def get_storage(bucket_name):
+    # LOCAL_STORAGE_PATH swaps S3 for the local filesystem
+    root = os.getenv('LOCAL_STORAGE_PATH')
+    return LocalStorage(root, bucket_name) if root else S3Storage(bucket_name)
+
+
+def delete_keys(storage, keys, batch_size=1000, max_workers=4) -> int:
+    """
+    Deletes keys in delete_objects batches of up to 1000, the most S3 takes per request, a few
+    batches at a time. Returns the number of keys deleted.
+    """
+    batches = [keys[start:start + batch_size] for start in range(0, len(keys), batch_size)]
+    if not batches:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+        failed = [key for batch_failed in executor.map(storage.delete_batch, batches) for key in batch_failed]
+
+    if failed:
+        logger.error(f"Failed to delete {len(failed)} object(s), e.g. {failed[:5]}")
+    logger.info(f"Deleted {len(keys) - len(failed)} object(s) in {len(batches)} request(s)")
+    return len(keys) - len(failed)
+
+
+def storage_path(bucket_name, key) -> str:
+    root = os.getenv('LOCAL_STORAGE_PATH')
+    return LocalStorage(root, bucket_name).path(key) if root else f's3://{bucket_name}/{key}'
+
+
+def conform(df: pd.DataFrame, schema: pa.Schema) -> pa.Table:
+    """
+    Casts df to the declared schema. Columns missing from df are written as nulls,
+    columns that aren't in the schema are dropped.
+    """
+    extra = [column for column in df.columns if column not in schema.names]
+    if extra:
+        logger.warning(f"Dropping columns not in the staging schema: {extra}")
+
+    arrays = [to_arrow(df[field.name], field.type) if field.name in df
+              else pa.nulls(len(df), type=field.type) for field in schema]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def to_parquet_bytes(df: pd.DataFrame, schema: pa.Schema) -> bytes:
+    buffer = BytesIO()
+    pq.write_table(conform(df, schema), buffer, compression='snappy')
+    return buffer.getvalue()
+
+
+def _row_groups(df: pd.DataFrame, chunk_size, partition_by=None):
+    if partition_by is None or df.empty:
+        for start in range(0, max(len(df), 1), chunk_size):
+            yield df.iloc[start:start + chunk_size]
+        return
+
+    # Positions of each value's rows, values in order, without sorting a copy of the whole frame
+    codes, _ = pd.factorize(df[partition_by], sort=True, use_na_sentinel=False)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes))
+    for start, end in zip(np.concatenate([[0], bounds[:-1]]), bounds):
+        for chunk_start in range(start, end, chunk_size):
+            yield df.take(order[chunk_start:min(chunk_start + chunk_size, end)])
+
+
+def write_parquet(df: pd.DataFrame, schema: pa.Schema, writer, chunk_size=100_000,
+                  compression=STAGING_COMPRESSION, partition_by=None) -> None:
+    """
+    Streams df to writer as parquet against the declared schema, a row group per chunk_size rows, so
+    only one chunk is ever converted at a time. With partition_by, the rows are grouped by that column
+    and no row group holds more than one of its values, so a read filtering on it skips the others'.
+    """
+    with pq.ParquetWriter(writer, schema, compression=compression) as parquet_writer:
+        for chunk in _row_groups(df, chunk_size, partition_by):
+            parquet_writer.write_table(conform(chunk, schema), row_group_size=chunk_size)
+
+
+def write_csv(df: pd.DataFrame, writer, chunk_size=100_000, compress=True) -> None:
+    """Streams df to writer as CSV a chunk at a time, gzipped unless compress is off."""
+    stream = gzip.GzipFile(fileobj=writer, mode='wb') if compress else writer
+    try:
+        for start in range(0, max(len(df), 1), chunk_size):
+            stream.write(df.iloc[start:start + chunk_size].to_csv(index=False, header=start == 0).encode())
+    finally:
+        if compress:
+            # Writes the gzip trailer, the writer itself is left open
+            stream.close()
+
+
+def read_parquet_bytes(body: bytes, filters=None) -> pd.DataFrame:
+    return to_frame(pq.read_table(BytesIO(body), filters=filters))
@@ -0,0 +1,63 @@
+import json
+import os
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# set() reads, changes and swaps the whole file, so threads sharing a store, e.g. accounts extracted
+# concurrently saving their tokens, take turns
+_write_lock = threading.Lock()
+
+
+class StateStore(object):
+    """
+    Small JSON key-value store for state that has to survive between runs, e.g. extraction watermarks.
+    Given a storage, e.g. staging.S3Storage, the state is the object at path in it and outlives the
+    container. Otherwise it's a local file, and as Lambda only allows writes under /tmp that only lasts
+    while the container is warm.
+    """
+
+    def __init__(self, path=None, storage=None):
+        self.storage = storage
+        if storage is not None:
+            self.path = path or 'state/cashback_state.json'
+        else:
+            self.path = path or os.getenv('STATE_PATH') or '/tmp/cashback_state.json'
+
+    def _read(self) -> str:
+        if self.storage is None:
+            with open(self.path) as f:
+                return f.read()
+        if self.path not in self.storage.keys(self.path):
+            raise FileNotFoundError(self.path)
+        return self.storage.get(self.path)
+
+    def _load(self) -> dict:
+        try:
+            return json.loads(self._read())
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError:
+            logger.warning(f"State file {self.path} is corrupt, starting from empty state")
+            return {}
+
+    def get(self, key, default=None):
+        return self._load().get(key, default)
+
+    def set(self, key, value) -> None:
+        with _write_lock:
+            state = self._load()
+            state[key] = value
+
+            # A put replaces the whole object at once
+            if self.storage is not None:
+                self.storage.put(self.path, json.dumps(state))
+                return
+
+            # Write to a temp file and swap it in so a crash mid-write can't leave half a file behind
+            tmp_path = f"{self.path}.tmp"
+            # Owner only, it can hold credentials such as the cached id_token
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
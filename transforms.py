@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+
+# The pandas executor of transform_spec.TransformSpec, spark_transforms.py is the Spark one. Values that
+# don't parse are null, a division by zero is null rather than inf, and nulls are NaN, NaT or NA depending
+# on the column and come out of every operation as they do in Spark
+
+def to_float(values) -> np.ndarray:
+    return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+
+
+def spark_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = numerator / denominator
+    return np.where(denominator == 0, np.nan, result)
+
+
+def _numeric(value):
+    return float(value) if np.isscalar(value) else to_float(value)
+
+
+def evaluate(df: pd.DataFrame, expression):
+    """The values of a transform_spec expression over df, a column or a scalar for a literal."""
+    op, *args = expression
+    if op == 'col':
+        return df[args[0]]
+    if op == 'lit':
+        return args[0]
+
+    values = [evaluate(df, arg) for arg in args]
+    if op == 'abs':
+        return np.abs(_numeric(values[0]))
+    if op == 'mul':
+        return _numeric(values[0]) * _numeric(values[1])
+    if op == 'div':
+        return spark_divide(_numeric(values[0]), _numeric(values[1]))
+    if op == 'eq':
+        # A null on either side isn't equal, so when() falls through to otherwise
+        return _numeric(values[0]) == _numeric(values[1])
+    if op == 'when':
+        return np.where(values[0], values[1], values[2])
+    if op == 'to_timestamp':
+        return to_timestamp(values[0])
+    if op == 'date_string':
+        return to_timestamp(values[0]).dt.strftime('%Y-%m-%d')
+    raise ValueError(f'Unknown expression {op}')
+
+
+def to_timestamp(values) -> pd.Series:
+    # Unparseable values are null, as when Spark casts a string
+    return pd.to_datetime(pd.Series(values), utc=True, errors='coerce', format='ISO8601')
+
+
+def _java_double(value) -> str:
+    if np.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    mantissa, exponent = np.format_float_scientific(value, unique=True, trim='0').split('e')
+    return f'{mantissa}E{int(exponent)}'
+
+
+def spark_string(values) -> pd.Series:
+    """
+    Doubles as Spark casts them to strings, which is Java's Double.toString: the same as python's repr from
+    1e-3 up to 1e7, e.g. 2.11 and 100.0, and 1.0E-4 or 1.2345678E7 outside of it.
+    """
+    numbers = to_float(values)
+    strings = pd.Series(numbers, index=getattr(values, 'index', None)).astype(str)
+    magnitude = np.abs(numbers)
+    scientific = (magnitude != 0) & ~np.isnan(numbers) & ((magnitude < 1e-3) | (magnitude >= 1e7))
+    strings[scientific] = [_java_double(value) for value in numbers[scientific]]
+    return strings
+
+
+def cast(values, data_type: str):
+    if data_type == 'string':
+        if pd.api.types.is_float_dtype(values.dtype):
+            return spark_string(values)
+        return values.astype(str)
+    if data_type == 'double':
+        return pd.Series(to_float(values), index=values.index)
+    if data_type == 'int':
+        # Truncated towards zero, the way Spark casts a double
+        return pd.Series(pd.array(np.trunc(to_float(values)), dtype='Int32'), index=values.index)
+    if data_type == 'boolean':
+        return values.astype('boolean')
+    if data_type == 'timestamp':
+        return to_timestamp(values)
+    raise ValueError(f'Unknown type {data_type}')
+
+
+def rename_columns(df: pd.DataFrame, spec) -> pd.DataFrame:
+    return df.rename(columns=spec.renames)
+
+
+def derive_columns(df: pd.DataFrame, spec) -> pd.DataFrame:
+    """df with the spec's derived columns added or replaced, in the spec's order."""
+    df = df.copy()
+    for column, expression in spec.derived:
+        df[column] = evaluate(df, expression)
+    return df
+
+
+def cast_columns(df: pd.DataFrame, spec) -> pd.DataFrame:
+    """The spec's output columns of df, each cast to its type, in the spec's order."""
+    return pd.DataFrame({column: cast(df[column], data_type) for column, data_type in spec.casts.items()},
+                        index=df.index)
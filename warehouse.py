@@ -0,0 +1,225 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from staging import delete_keys
+
+logger = logging.getLogger(__name__)
+
+# Both engines publish the warehouse under it, see WarehousePublisher
+WAREHOUSE_PREFIX = 'datawarehouse'
+PARTITION_COLUMN = 'transaction_date'
+# Written by the pull next to the staged files, the partitions an incremental transform rewrites
+TOUCHED_PARTITIONS_KEY = 'staging/touched_partitions.json'
+# Where hive puts rows with a null partition value
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+# Glue type of each arrow type the warehouse is written with, the ones a crawler would register
+GLUE_TYPES = {'string': 'string', 'large_string': 'string', 'double': 'double', 'float': 'double',
+              'int64': 'bigint', 'int32': 'int', 'int16': 'int', 'int8': 'int', 'bool': 'boolean'}
+
+
+def glue_columns(schema: pa.Schema) -> list:
+    """The Glue catalog columns of schema, in its order."""
+    columns = []
+    for field in schema:
+        arrow_type = str(field.type)
+        glue_type = 'timestamp' if arrow_type.startswith('timestamp') else GLUE_TYPES.get(arrow_type, 'string')
+        columns.append({'Name': field.name, 'Type': glue_type})
+    return columns
+
+
+def touched_partitions(df: pd.DataFrame, partitions) -> pd.DataFrame:
+    """
+    Rows of the partitions the pull found touched, see fingerprints.ChangeDetector.touched_partitions.
+    Each of those partitions is rewritten whole, the others are left as they are.
+    """
+    partition_df = df[df[PARTITION_COLUMN].fillna(NULL_PARTITION).isin(partitions)]
+    logger.info(f"{len(partitions)} partition(s) touched, {len(partition_df)} row(s) to rewrite")
+    return partition_df
+
+
+def read_touched_partitions(storage):
+    """The partitions the last pull touched, None when the whole warehouse has to be rewritten."""
+    try:
+        return json.loads(storage.get(TOUCHED_PARTITIONS_KEY))['partitions']
+    except Exception:
+        return None
+
+
+class WarehousePublisher(object):
+    """
+    Writes each run under <prefix>/versions/<version>/ and only then replaces <prefix>/manifest.json
+    to point at it. A PUT swaps the manifest whole, so anything reading through it sees either the
+    previous run or the new one, never a half written or half deleted warehouse. glue_job/elt.py
+    publishes a pandas frame with publish, the Glue job writes its version with Spark and commits it.
+
+    The manifest lists the files of each partition, a single one from pandas and as many as Spark wrote,
+    and its entries are in the Redshift manifest format, so Spectrum and COPY can read it as is.
+    """
+
+    def __init__(self, storage, prefix=WAREHOUSE_PREFIX, keep=2, max_workers=4):
+        self.storage = storage
+        self.prefix = prefix
+        # Versions to keep around after the current one, for readers still on an older manifest
+        self.keep = keep
+        self.max_workers = max_workers
+
+    @property
+    def manifest_key(self):
+        return f'{self.prefix}/manifest.json'
+
+    @staticmethod
+    def new_version() -> str:
+        # Timestamps, so versions sort in the order they were published
+        return datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+
+    def version_prefix(self, version) -> str:
+        return f'{self.prefix}/versions/{version}/'
+
+    def current(self):
+        try:
+            return json.loads(self.storage.get(self.manifest_key))
+        except Exception:
+            return None
+
+    def _write_partition(self, version, value, partition_df):
+        key = f'{self.version_prefix(version)}{PARTITION_COLUMN}={value}/part-0.parquet'
+        buffer = BytesIO()
+        # The partition value lives in the path, same as a hive/Spark write
+        pq.write_table(pa.Table.from_pandas(partition_df.drop(columns=PARTITION_COLUMN), preserve_index=False),
+                       buffer, compression='snappy')
+        body = buffer.getvalue()
+        self.storage.put(key, body)
+        return {'key': key, 'size': len(body)}
+
+    def written_files(self, version) -> dict:
+        """The parquet files under version, per partition value. How a version Spark wrote is found."""
+        prefix = self.version_prefix(version)
+        written = {}
+        for key, size in sorted(self.storage.sizes(prefix).items()):
+            directory, _, name = key[len(prefix):].rpartition('/')
+            # Leaves out Spark's _SUCCESS marker
+            if name.endswith('.parquet') and directory.startswith(f'{PARTITION_COLUMN}='):
+                written.setdefault(directory.split('=', 1)[1], []).append({'key': key, 'size': size})
+        return written
+
+    def publish(self, df: pd.DataFrame, incremental=False, touched=()) -> dict:
+        """
+        Writes df as a new version. With incremental the partitions df doesn't hold are carried
+        over from the current manifest, so only the touched ones are written. A touched partition
+        df has no rows for anymore is dropped rather than carried over.
+        """
+        current = self.current() if incremental else None
+        if current and df.empty and not touched:
+            logger.info(f"Nothing to publish, staying on version {current['version']}")
+            return current
+
+        version = self.new_version()
+        written = {value: [self._write_partition(version, value, partition_df)]
+                   for value, partition_df in df.groupby(df[PARTITION_COLUMN].fillna(NULL_PARTITION), sort=False)}
+
+        # The columns of the files, the partition key is in their path
+        columns = glue_columns(pa.Schema.from_pandas(df.drop(columns=PARTITION_COLUMN), preserve_index=False))
+        manifest = self.commit(version, written, columns, pd.to_datetime(df['updated_at'], utc=True).max(), current,
+                               touched)
+
+        logger.info(f"Published version {version}, {len(df)} row(s) written to "
+                    f"{len(written)} of {len(manifest['partitions'])} partition(s)")
+        return manifest
+
+    def commit(self, version, written, columns, max_updated_at, current=None, touched=()) -> dict:
+        """
+        Points the manifest at version, whose files are written already. written is the files of each
+        partition value the version holds, current the manifest whose other partitions, the touched
+        ones aside, are carried over.
+        """
+        touched = set(touched)
+        partitions = {value: files for value, files in current['partitions'].items()
+                      if value not in touched} if current else {}
+        partitions.update(written)
+
+        updated_at = [pd.Timestamp(max_updated_at)] if max_updated_at is not None else []
+        if current and current['max_updated_at']:
+            updated_at.append(pd.Timestamp(current['max_updated_at']))
+        # Spark hands back naive timestamps, in the session's UTC
+        updated_at = [value.tz_localize('UTC') if value.tzinfo is None else value
+                      for value in updated_at if not pd.isna(value)]
+        max_updated_at = max(updated_at) if updated_at else None
+
+        manifest = {
+            'version': version,
+            'max_updated_at': max_updated_at.isoformat() if max_updated_at is not None else None,
+            'columns': columns,
+            'partitions': partitions,
+            'entries': [{'url': f"s3://{self.storage.bucket_name}/{file['key']}",
+                         'meta': {'content_length': file['size']}, 'mandatory': True}
+                        for files in partitions.values() for file in files],
+        }
+        self.storage.put(self.manifest_key, json.dumps(manifest, indent=2))
+        return manifest
+
+    @staticmethod
+    def written_by(manifest) -> dict:
+        """The files of the partitions the manifest's version wrote, rather than carried over."""
+        return {value: files for value, files in manifest['partitions'].items()
+                if f"/{manifest['version']}/" in files[0]['key']}
+
+    def _locations(self, partitions) -> dict:
+        return {value: f"s3://{self.storage.bucket_name}/{files[0]['key'].rsplit('/', 1)[0]}/"
+                for value, files in partitions.items()}
+
+    def written_partitions(self, manifest) -> dict:
+        """
+        The partitions the manifest's version wrote, with the directory each is in, and the columns they
+        hold. What glue_crawler_lambda.py registers in the catalog, every published partition when the
+        columns changed.
+        """
+        return {'columns': manifest.get('columns', []),
+                'partitions': self._locations(self.written_by(manifest)),
+                'published': self._locations(manifest['partitions'])}
+
+    def _read_partition(self, value, files, columns=None) -> pd.DataFrame:
+        columns = [column for column in columns if column != PARTITION_COLUMN] if columns else None
+        table = pa.concat_tables([pq.read_table(BytesIO(self.storage.get(file['key'])), columns=columns)
+                                  for file in files])
+        return table.to_pandas().assign(**{PARTITION_COLUMN: None if value == NULL_PARTITION else value})
+
+    def read(self, manifest=None, columns=None) -> pd.DataFrame:
+        """Every row of the manifest's version, the current one by default, a few partitions at a time."""
+        manifest = manifest or self.current()
+        if not manifest or not manifest['partitions']:
+            return pd.DataFrame(columns=columns)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            frames = list(executor.map(lambda item: self._read_partition(*item, columns=columns),
+                                       manifest['partitions'].items()))
+        return pd.concat(frames, ignore_index=True)
+
+    def collect_garbage(self) -> int:
+        """
+        Deletes the versions the current manifest doesn't reference, apart from the latest few.
+        Versions are timestamps, so they sort in the order they were published.
+        """
+        manifest = self.current()
+        if manifest is None:
+            return 0
+
+        versions_prefix = f'{self.prefix}/versions/'
+        keys = self.storage.keys(versions_prefix)
+        versions = sorted({key[len(versions_prefix):].split('/', 1)[0] for key in keys})
+
+        live = {file['key'][len(versions_prefix):].split('/', 1)[0]
+                for files in manifest['partitions'].values() for file in files}
+        live.add(manifest['version'])
+        live.update(versions[-(self.keep + 1):])
+
+        stale = [key for key in keys if key[len(versions_prefix):].split('/', 1)[0] not in live]
+        logger.info(f"Collecting {len(stale)} object(s) from {len(set(versions) - live)} old version(s)")
+        return delete_keys(self.storage, stale, max_workers=self.max_workers)